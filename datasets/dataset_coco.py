@@ -1,4 +1,5 @@
 import os
+import random
 import shutil
 import urllib.request
 import zipfile
@@ -389,6 +390,13 @@ class COCODataset(torch.utils.data.Dataset):
         # self.image_ids = np.copy(self.dataset.image_ids)
         self.config = config
         self.augment = augment
+        if config.RPN.TARGET_IN_LOADER:
+            self.anchors = generate_pyramid_priors(config.RPN.ANCHOR_SCALES, config.RPN.ANCHOR_RATIOS,
+                                                   config.MODEL.BACKBONE_SHAPES, config.MODEL.BACKBONE_STRIDES,
+                                                   config.RPN.ANCHOR_STRIDE)
+        if config.RPN.MATCH_CACHE_DIR:
+            self.match_setting = utils.rpn_match_setting(config)
+            os.makedirs(config.RPN.MATCH_CACHE_DIR, exist_ok=True)
 
     def __getitem__(self, image_index):
 
@@ -402,9 +410,11 @@ class COCODataset(torch.utils.data.Dataset):
         # Get GT bounding boxes and masks for image.
         image_id = self.dataset.image_ids[image_index]
 
+        # the flip state is drawn here since it is part of the key of the rpn match cache
+        flip = bool(random.randint(0, 1)) if self.augment else False
         image, image_metas, gt_class_ids, gt_boxes, gt_masks = \
             utils.load_image_and_gt(self.dataset, self.config, image_id, augment=self.augment,
-                                    use_mini_mask=self.config.MRCNN.USE_MINI_MASK)
+                                    use_mini_mask=self.config.MRCNN.USE_MINI_MASK, flip=flip)
 
         # Skip images that have no instances. This can happen in cases
         # where we train on a subset of classes and the image doesn't
@@ -414,20 +424,43 @@ class COCODataset(torch.utils.data.Dataset):
             return None
 
         # If more instances than fits in the array, sub-sample from them.
-        if gt_boxes.shape[0] > self.config.DATA.MAX_GT_INSTANCES:
+        gt_subsampled = gt_boxes.shape[0] > self.config.DATA.MAX_GT_INSTANCES
+        if gt_subsampled:
             ids = np.random.choice(
                 np.arange(gt_boxes.shape[0]), self.config.DATA.MAX_GT_INSTANCES, replace=False)
             gt_class_ids = gt_class_ids[ids]
             gt_boxes = gt_boxes[ids]
             gt_masks = gt_masks[:, :, ids]
 
+        if self.config.RPN.TARGET_IN_LOADER:
+            if self.config.RPN.MATCH_CACHE_DIR and not gt_subsampled:
+                match = self.rpn_match(image_id, flip, gt_class_ids, gt_boxes)
+            else:
+                match = utils.match_rpn_anchors(self.anchors, gt_class_ids, gt_boxes, self.config)
+            rpn_match, rpn_bbox = utils.sample_rpn_targets(match, self.anchors, gt_boxes, self.config)
+
         image = image.astype(np.float32) - self.config.DATA.MEAN_PIXEL
         image = torch.from_numpy(image.transpose(2, 0, 1)).float()
         image_metas = torch.from_numpy(image_metas)
-        gt_masks = gt_masks.astype(int).transpose(2, 0, 1)
+        # uint8 (not int64/float) through the worker IPC and the host-to-device copy
+        gt_masks = gt_masks.astype(np.uint8).transpose(2, 0, 1)
 
+        if self.config.RPN.TARGET_IN_LOADER:
+            return image, gt_class_ids, gt_boxes, gt_masks, \
+                   torch.from_numpy(rpn_match), torch.from_numpy(rpn_bbox), image_metas
         return image, gt_class_ids, gt_boxes, gt_masks, image_metas
 
+    def rpn_match(self, image_id, flip, gt_class_ids, gt_boxes):
+        """anchor-gt match of (image, flip) from RPN.MATCH_CACHE_DIR; computed and cached on a miss.
+        The file name carries the hash of the match settings (see utils.rpn_match_setting)."""
+        file_name = os.path.join(self.config.RPN.MATCH_CACHE_DIR, '{}_flip_{:d}_{:s}.npz'.format(
+            self.dataset.image_info[image_id]['id'], flip, self.match_setting))
+        match = utils.load_rpn_match(file_name, self.anchors.shape[0], gt_class_ids.shape[0])
+        if match is None:
+            match = utils.match_rpn_anchors(self.anchors, gt_class_ids, gt_boxes, self.config)
+            utils.save_rpn_match(file_name, match)
+        return match
+
     def __len__(self):
         return self.dataset.image_ids.shape[0]
 
@@ -435,20 +468,28 @@ class COCODataset(torch.utils.data.Dataset):
 def detection_collate(batch):
     """Custom collate function for dealing with batches of images that have a different
     number of associated object annotations (bounding boxes).
+    With RPN.TARGET_IN_LOADER, the stacked rpn_match [bs, num_anchors] and rpn_bbox
+    [bs, TRAIN_ANCHORS_PER_IMAGE, 4] come before the image metas.
     """
     imgs = []
     imgs_metas = []
-    # rpn_match, rpn_bbox = [], []
+    rpn_match, rpn_bbox = [], []
     gt_class_ids, gt_boxes, gt_masks = [], [], []
     for sample in batch:
         imgs.append(sample[0])
-        # rpn_match.append(sample[2])
-        # rpn_bbox.append(sample[3])
         gt_class_ids.append(sample[1])
         gt_boxes.append(sample[2])
         gt_masks.append(sample[3])
-        imgs_metas.append(sample[4])
-
+        if len(sample) == 7:
+            rpn_match.append(sample[4])
+            rpn_bbox.append(sample[5])
+        imgs_metas.append(sample[-1])
+
+    if rpn_match:
+        return torch.stack(imgs, 0), \
+               gt_class_ids, gt_boxes, gt_masks, \
+               torch.stack(rpn_match, 0), torch.stack(rpn_bbox, 0), \
+               torch.stack(imgs_metas, 0)
     return torch.stack(imgs, 0), \
            gt_class_ids, gt_boxes, gt_masks, \
            torch.stack(imgs_metas, 0)
@@ -1,76 +1,57 @@
 import os
 import random
+import argparse
 
 import matplotlib.pyplot as plt
 import skimage.io
 import torch
 
-import main
-from lib import workflow as modellib
+from lib.config import CocoConfig, CLASS_NAMES
+from lib.model import MaskRCNN
+from tools.utils import to_device
 from tools import visualize
 
 # Root directory of the project
 ROOT_DIR = os.getcwd()
 
-# Directory to save results and trained model
-MODEL_DIR = os.path.join(ROOT_DIR, "results")
-
 # Path to trained weights file
 # Download this file and place in the root of your
 # project (See README file for details)
-COCO_MODEL_PATH = os.path.join(ROOT_DIR, 'datasets', 'mask_rcnn_coco.pth')
+COCO_MODEL_PATH = os.path.join(ROOT_DIR, 'datasets', 'pretrain_model', 'mask_rcnn_coco.pth')
 
 # Directory of images to run detection on
-IMAGE_DIR = os.path.join(ROOT_DIR, "images")
-
+IMAGE_DIR = os.path.join(ROOT_DIR, 'demo', 'images')
 
-class InferenceConfig(main.CocoConfig):
-    # Set batch size to 1 since we'll be running inference on
-    # one image at a time. Batch size = GPU_COUNT * IMAGES_PER_GPU
-    # GPU_COUNT = 0 for CPU
-    GPU_COUNT = 1
-    IMAGES_PER_GPU = 1
 
-config = InferenceConfig()
-config.display()
+if __name__ == '__main__':
 
-# Create model object.
-model = modellib.MaskRCNN(model_dir=MODEL_DIR, config=config)
-if config.GPU_COUNT:
-    model = model.cuda()
+    parser = argparse.ArgumentParser(description='Mask R-CNN demo')
+    parser.add_argument('--model_path', default=COCO_MODEL_PATH)
+    parser.add_argument('--image_dir', default=IMAGE_DIR)
+    parser.add_argument('--config_name', default='demo')
+    parser.add_argument('--config_file', default=None)
+    parser.add_argument('--device_id', default='0', type=str)
+    parser.add_argument('opts', help='See lib/config.py for all options', default=None, nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+    args.phase, args.debug = 'inference', 0
 
-# Load weights trained on MS-COCO
-model.load_state_dict(torch.load(COCO_MODEL_PATH))
+    config = CocoConfig(args)
+    config.display(None)
 
-# COCO Class names
-# Index of the class in the list is its ID. For example, to get ID of
-# the teddy bear class, use: class_names.index('teddy bear')
-class_names = ['BG', 'person', 'bicycle', 'car', 'motorcycle', 'airplane',
-               'bus', 'train', 'truck', 'boat', 'traffic light',
-               'fire hydrant', 'stop sign', 'parking meter', 'bench', 'bird',
-               'cat', 'dog', 'horse', 'sheep', 'cow', 'elephant', 'bear',
-               'zebra', 'giraffe', 'backpack', 'umbrella', 'handbag', 'tie',
-               'suitcase', 'frisbee', 'skis', 'snowboard', 'sports ball',
-               'kite', 'baseball bat', 'baseball glove', 'skateboard',
-               'surfboard', 'tennis racket', 'bottle', 'wine glass', 'cup',
-               'fork', 'knife', 'spoon', 'bowl', 'banana', 'apple',
-               'sandwich', 'orange', 'broccoli', 'carrot', 'hot dog', 'pizza',
-               'donut', 'cake', 'chair', 'couch', 'potted plant', 'bed',
-               'dining table', 'toilet', 'tv', 'laptop', 'mouse', 'remote',
-               'keyboard', 'cell phone', 'microwave', 'oven', 'toaster',
-               'sink', 'refrigerator', 'book', 'clock', 'vase', 'scissors',
-               'teddy bear', 'hair drier', 'toothbrush']
+    # Create model object and load weights trained on MS-COCO
+    model = MaskRCNN(config)
+    checkpoints = torch.load(args.model_path, map_location=lambda storage, loc: storage)
+    model.load_state_dict(checkpoints.get('state_dict', checkpoints), strict=False)
+    model = to_device(model, config)
 
-# Load a random image from the images folder
-file_names = next(os.walk(IMAGE_DIR))[2]
-# image = skimage.io.imread(os.path.join(IMAGE_DIR, random.choice(file_names)))
-image = skimage.io.imread(os.path.join(IMAGE_DIR, random.choice(file_names)))
+    # Load a random image from the images folder
+    file_names = next(os.walk(args.image_dir))[2]
+    image = skimage.io.imread(os.path.join(args.image_dir, random.choice(file_names)))
 
-# Run detection
-results = model.detect([image])
+    # Run detection
+    results = model.detect([image])
 
-# Visualize results
-r = results[0]
-visualize.display_instances(image, r['rois'], r['masks'], r['class_ids'],
-                            class_names, r['scores'])
-plt.show()
+    # Visualize results
+    r = results[0]
+    visualize.display_instances(image, r['rois'], r['masks'], r['class_ids'], CLASS_NAMES, r['scores'])
+    plt.show()
@@ -1,6 +1,7 @@
 import torch
 import torch.nn as nn
 from torch.autograd import Variable
+from tools.utils import to_device
 EPS = 1e-20
 
 
@@ -116,8 +117,8 @@ class OptTrans(nn.Module):
 
         K = torch.exp(-self.epsilon*C)
         # Sinkhorn iterate
-        b = Variable(torch.ones(sample_num, 1)*(1./sample_num), requires_grad=True).cuda()
-        const = Variable(torch.ones(sample_num, 1)*(1./sample_num), requires_grad=False).cuda()
+        b = to_device(Variable(torch.ones(sample_num, 1)*(1./sample_num), requires_grad=True), self.config)
+        const = to_device(Variable(torch.ones(sample_num, 1)*(1./sample_num), requires_grad=False), self.config)
         for i in range(self.L):
             a = const / (torch.mm(K, b) + EPS)
             b = const / (torch.mm(K.permute(1, 0), a) + EPS)
@@ -94,6 +94,16 @@ class Config(object):
 
     RPN.TARGET_POS_THRES = .7
     RPN.TARGET_NEG_THRES = .3
+    # compute target_rpn_match/target_rpn_bbox in COCODataset.__getitem__ (numpy, in the data loader workers,
+    # overlapped with forward/backward) instead of in the forward pass on the device
+    RPN.TARGET_IN_LOADER = False
+    # match anchors to gt boxes via a grid index over the anchors: IoU is computed only for the anchors
+    # whose extent overlaps a gt/crowd box (all others are negative); same targets as the dense IoU
+    RPN.TARGET_SPARSE_MATCH = False
+    # with TARGET_IN_LOADER: folder of the per (image, flip) anchor-gt match cache (see COCODataset.rpn_match
+    # and tools/build_rpn_match_cache.py); only the random pos/neg balancing is left per iteration. '' = off.
+    # Cache files are keyed on a hash of the image size, anchor and threshold settings
+    RPN.MATCH_CACHE_DIR = ''
 
     # ==================================
     MRCNN = AttrDict()
@@ -157,7 +167,28 @@ class Config(object):
     TEST.DET_MIN_CONFIDENCE = 0
     # Non-maximum suppression threshold for detection
     TEST.DET_NMS_THRESHOLD = 0.3
+    # nms of the detection head: 'greedy' (exact, conduct_nms) or 'fast' (Fast NMS, one IoU matrix per image;
+    # approximate: a suppressed box may still suppress others). Compare with script/compare_nms_method.sh
+    TEST.NMS_METHOD = 'greedy'
     TEST.SAVE_IM = False
+    # 'masks' or 'boxes'; 'boxes' stops after detection_layer: no mask head, mask unmolding or RLE encoding
+    TEST.OUTPUT = 'masks'
+    # the mask head only runs on detections with score >= MASK_MIN_SCORE; the others get an empty mask
+    TEST.MASK_MIN_SCORE = 0.
+    # Sharded evaluation (see script/sharded_inference.sh): with SHARD_NUM > 1, a process with SHARD_ID >= 0
+    # runs inference on its slice of the val images and saves a result shard; SHARD_ID = -1 merges all shards
+    # and runs COCOeval once
+    TEST.SHARD_NUM = 1
+    TEST.SHARD_ID = -1
+    # Dynamic batching in tools/inference_server.py: a batch is run once it is full
+    # or the oldest queued request has waited SERVE_MAX_WAIT_MS
+    TEST.SERVE_MAX_BATCH_SIZE = 8
+    TEST.SERVE_MAX_WAIT_MS = 20
+    TEST.SERVE_CODEC_WORKERS = 4   # threads for image decoding and result rle encoding, off the event loop
+    # phase 'stream': comma-separated image folders and/or tar shards; see stream_model() in lib/workflow.py
+    TEST.STREAM_INPUT = ''
+    TEST.STREAM_DECODE_WORKERS = 4
+    TEST.STREAM_PREFETCH_BATCHES = 2   # max number of batches decoded ahead of the model
 
     # ==================================
     TRAIN = AttrDict()
@@ -205,6 +236,9 @@ class Config(object):
     DEV.MULTI_UPSAMPLER = False   # does not affect much
     # if 1, standard conv
     DEV.UPSAMPLE_FAC = 2.
+    # upsample a window around each small RoI instead of the whole feature map (ROIS.METHOD 'roi_align' only);
+    # same pooled values in eval mode; during train the BN statistics of the upsampler come from the windows
+    DEV.UPSAMPLE_ON_ROI = False
 
     DEV.LOSS_CHOICE = 'l1'
     DEV.OT_ONE_DIM_FORM = 'conv'   # effective if loss_choice is 'ot'
@@ -274,6 +308,14 @@ class Config(object):
     MISC.RESULT_FOLDER = None
     MISC.DEVICE_ID = []
     MISC.GPU_COUNT = -1
+    MISC.DEVICE = 'cuda'    # 'cuda' or 'cpu'; falls back to 'cpu' if no GPU is visible
+    # 'auto', 'ext' (compiled lib/nms/_ext) or 'torch' (tensor ops, no build needed); auto picks 'ext' if built
+    MISC.NMS_BACKEND = 'auto'
+    # IoU of anchors/proposals vs. gt boxes (bbox_overlaps) is computed this many boxes at a time to bound
+    # the peak memory; 0 = all at once
+    MISC.IOU_CHUNK_SIZE = 65536
+    # threads of the cpu crop_and_resize (roi align) kernels; 0 = OpenMP default (OMP_NUM_THREADS)
+    MISC.CPU_ROI_THREADS = 0
 
     def display(self, log_file, quiet=False):
         """Display *final* configuration values."""
@@ -354,6 +396,19 @@ class Config(object):
             if self.TRAIN.FPN_OT_LOSS:
                 self.MISC.VIS.LOSS_LEGEND.append('fpn_ot_loss')
 
+        assert -1 <= self.TEST.SHARD_ID < self.TEST.SHARD_NUM, 'TEST.SHARD_ID out of range'
+        if self.RPN.MATCH_CACHE_DIR:
+            assert self.RPN.TARGET_IN_LOADER, 'RPN.MATCH_CACHE_DIR needs RPN.TARGET_IN_LOADER'
+        assert self.TEST.NMS_METHOD in ['greedy', 'fast'], 'unknown TEST.NMS_METHOD {}'.format(self.TEST.NMS_METHOD)
+        assert self.TEST.OUTPUT in ['masks', 'boxes'], 'unknown TEST.OUTPUT {}'.format(self.TEST.OUTPUT)
+        assert self.MISC.DEVICE in ['cuda', 'cpu'], 'unknown MISC.DEVICE {}'.format(self.MISC.DEVICE)
+        if self.MISC.DEVICE == 'cuda' and not torch.cuda.is_available():
+            print_log('WARNING: cuda is not available, fall back to cpu mode.', self.MISC.LOG_FILE)
+            self.MISC.DEVICE = 'cpu'
+        if self.MISC.DEVICE == 'cpu':
+            self.MISC.DEVICE_ID = []
+            self.MISC.GPU_COUNT = 0
+
         if self.MISC.GPU_COUNT == 8:
             self.DATA.LOADER_WORKER_NUM = 32
         elif self.MISC.GPU_COUNT == 4:
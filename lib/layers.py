@@ -1,6 +1,6 @@
-from lib.roi_align.crop_and_resize import CropAndResizeFunction
+from lib.roi_align.crop_and_resize import CropAndResizeFunction, MultiLevelCropAndResizeFunction
 from lib.roi_pooling.functions.roi_pool import RoIPoolFunction
-from lib.nms.nms_wrapper import nms
+from lib.nms.nms_wrapper import nms_batch, nms_grouped
 from lib.workflow import SEE_ONE_EXAMPLE, EXAMPLE_COCO_IND
 from tools.box_utils import *
 from tools.utils import *
@@ -83,34 +83,40 @@ def proposal_layer(inputs, proposal_count, nms_threshold, priors, config=None):
         priors:             anchors
         config:             configuration
     Returns:
-        Proposals in normalized coordinates [batch, rois, (y1, x1, y2, x2)]
+        normalized_boxes:   Proposals in normalized coordinates [batch, proposal_count, (y1, x1, y2, x2)],
+                                zero padded if an image has fewer proposals after nms
+        proposal_num:       [batch] LongTensor, number of valid (non-padded) proposals per image
     """
-    anchors = Variable(priors.cuda(), requires_grad=False)
+    anchors = Variable(to_device(priors, config), requires_grad=False)
     bs, prior_num = inputs[0].size(0), anchors.size(0)
     # Box Scores. Use the foreground class confidence. [Batch, num_rois, 1]
     scores = inputs[0][:, :, 1]
 
     # Box deltas [batch, num_rois, 4]
     deltas = inputs[1]
-    std_dev = Variable(torch.from_numpy(np.reshape(config.DATA.BBOX_STD_DEV, [1, 1, 4])).float(),
-                       requires_grad=False).cuda()
+    std_dev = to_device(Variable(torch.from_numpy(np.reshape(config.DATA.BBOX_STD_DEV, [1, 1, 4])).float(),
+                                 requires_grad=False), config)
     deltas = deltas * std_dev
 
-    anchors = anchors.expand(bs, anchors.size(0), anchors.size(1))
-
     # Improve performance by trimming to top anchors by score
     # and doing the rest on the smaller subset.
+    # Partial top-k per pyramid level, then over the merged level candidates: it selects the same anchors as a
+    # global top-k, without sorting all anchors (P2 alone holds 3/4 of them)
     pre_nms_limit = min(config.RPN.PRE_NMS_LIMIT, prior_num)
-    scores, order = scores.sort(descending=True)
-    scores = scores[:, :pre_nms_limit]
-    order = order[:, :pre_nms_limit]
-
-    deltas_trim = Variable(torch.FloatTensor(bs, pre_nms_limit, 4).cuda())
-    anchors_trim = Variable(torch.FloatTensor(bs, pre_nms_limit, 4).cuda())
-    # index two-dim (out_of_mem if directly index order.data)
-    for i in range(bs):
-        deltas_trim[i] = deltas[i][order.data[i], :]
-        anchors_trim[i] = anchors[i][order.data[i], :]
+    level_scores, level_order, start = [], [], 0
+    for num in _anchor_num_per_level(config, prior_num):
+        curr_scores, curr_order = scores[:, start:start+num].topk(min(pre_nms_limit, num), dim=1, sorted=False)
+        level_scores.append(curr_scores)
+        level_order.append(curr_order + start)
+        start += num
+    scores, order = torch.cat(level_scores, dim=1), torch.cat(level_order, dim=1)
+    scores, _ix = scores.topk(pre_nms_limit, dim=1, sorted=True)
+    order = order.gather(1, _ix).data
+
+    # gather the whole batch at once through flattened indices, [bs, pre_nms_limit, 4]
+    flat_order = order + torch.arange(0, bs).type_as(order).unsqueeze(1).expand_as(order) * prior_num
+    deltas_trim = deltas.view(-1, 4)[flat_order.view(-1)].view(bs, pre_nms_limit, 4)
+    anchors_trim = anchors[order.view(-1)].view(bs, pre_nms_limit, 4)
 
     # Apply deltas to anchors to get refined anchors.
     # [batch, N, (y1, x1, y2, x2)]
@@ -120,53 +126,75 @@ def proposal_layer(inputs, proposal_count, nms_threshold, priors, config=None):
     # Clip to image boundaries. [batch, N, (y1, x1, y2, x2)]
     height, width = config.DATA.IMAGE_SHAPE[:2]
     window = np.array([0, 0, height, width]).astype(np.float32)
-    window = Variable(torch.from_numpy(window).cuda(), requires_grad=False)
+    window = Variable(to_device(torch.from_numpy(window), config), requires_grad=False)
     boxes = clip_boxes(boxes, window)
 
     # Filter out small boxes
     # According to Xinlei Chen's paper, this reduces detection accuracy
     # for small objects, so we're skipping it.
 
-    # Non-max suppression
-    keep = nms(torch.cat((boxes, scores.unsqueeze(2)), 2).data, nms_threshold)
-    keep = keep[:, :proposal_count]
-    boxes_keep = Variable(torch.FloatTensor(bs, keep.shape[1], 4).cuda())  # bs, proposal_count(1000), 4
-    for i in range(bs):
-        boxes_keep[i] = boxes[i][keep[i], :]
+    # Non-max suppression, one call for the whole batch
+    keep = nms_batch(torch.cat((boxes, scores.unsqueeze(2)), 2).data, nms_threshold)
+    keep_im = keep / pre_nms_limit
+    order, rank, keep_num = _rank_per_image(keep_im, bs)
+    keep, keep_im = keep[order], keep_im[order]
+
+    # keep at most proposal_count boxes per image; pad the rest with zeros
+    top = torch.nonzero(rank < proposal_count).squeeze(1)
+    boxes_keep = boxes.data.new(bs * proposal_count, 4).zero_()
+    boxes_keep.index_copy_(0, keep_im[top] * proposal_count + rank[top], boxes.data.view(-1, 4)[keep[top]])
+    boxes_keep = Variable(boxes_keep.view(bs, proposal_count, 4), requires_grad=False)
+    proposal_num = keep_num.clamp(max=proposal_count)
 
     # Normalize dimensions to range of 0 to 1.
-    norm = Variable(torch.from_numpy(np.array([height, width, height, width])).float(), requires_grad=False).cuda()
+    norm = to_device(Variable(torch.from_numpy(np.array([height, width, height, width])).float(), requires_grad=False),
+                     config)
     normalized_boxes = boxes_keep / norm
 
-    return normalized_boxes   # proposals
+    return normalized_boxes, proposal_num   # proposals
+
+
+def _rank_per_image(keep_im, bs):
+    """Group the output of a batched nms by image.
+    Args:
+        keep_im:    [K] image index of each kept box, in descending score order (as returned by nms)
+        bs:         batch size
+    Returns:
+        order:      [K] permutation that groups the kept boxes by image, in descending score order inside each image
+        rank:       [K] rank of each (permuted) box within its image
+        keep_num:   [bs] number of kept boxes per image
+    """
+    pos = torch.arange(0, keep_im.size(0)).type_as(keep_im)
+    order = (keep_im * keep_im.size(0) + pos).sort()[1]
+    keep_im = keep_im[order]
+    keep_num = (keep_im.unsqueeze(0) == torch.arange(0, bs).type_as(keep_im).unsqueeze(1)).long().sum(1)
+    im_start = torch.cumsum(keep_num, 0) - keep_num
+    rank = pos - im_start[keep_im]
+    return order, rank, keep_num
+
+
+def _anchor_num_per_level(config, prior_num):
+    """number of anchors on each pyramid level, in the order of generate_pyramid_priors()"""
+    stride = config.RPN.ANCHOR_STRIDE
+    level_num = [int(math.ceil(shape[0] / stride) * math.ceil(shape[1] / stride)) * len(config.RPN.ANCHOR_RATIOS)
+                 for shape in config.MODEL.BACKBONE_SHAPES]
+    if sum(level_num) != prior_num:
+        # unknown anchor layout; treat all anchors as one level
+        level_num = [prior_num]
+    return level_num
 
 
 ############################################################
 #  ROIAlign Layer (used in the "if not self.use_dev:" branch, which is parallel to "alpha" and "beta" version)
 ############################################################
-def pyramid_roi_align(inputs, pool_size, image_shape, base=224.):
-    """Implements ROI Pooling on multiple levels of the feature pyramid.
+def assign_roi_level(boxes, image_shape, base=224.):
+    """Assign each ROI to a level in the pyramid (P2 to P5) based on the ROI area.
     Args:
-        pool_size: [height, width] of the output pooled regions. Usually [7, 7]
-        image_shape: [height, width, channels]. Shape of input image in pixels
-
-        inputs:
-            - boxes: [batch, num_boxes, (y1, x1, y2, x2)] in normalized coordinates.
-            - Feature maps: List of feature maps from different levels of the pyramid.
-                        Each is [batch, channels, height, width]
-    Output:
-        Pooled regions in the shape: [num_boxes, height, width, channels].
-        The width and height are those specific in the pool_shape in the layer constructor.
+        boxes:          [batch, num_boxes, (y1, x1, y2, x2)] in normalized coordinates.
+        image_shape:    [height, width, channels]. Shape of input image in pixels
+    Returns:
+        roi_level:      [batch, num_boxes] IntTensor Variable, in 2 to 5
     """
-
-    # Crop boxes [batch, num_boxes, (y1, x1, y2, x2)] in normalized coordinates
-    boxes = inputs[0]   # aka ROIs
-
-    # Feature Maps. List of feature maps from different level of the
-    # feature pyramid. Each is [batch, height, width, channels]
-    feature_maps = inputs[1:]
-
-    # Assign each ROI to a level in the pyramid based on the ROI area.
     y1, x1, y2, x2 = boxes.chunk(4, dim=2)
     h = y2 - y1
     w = x2 - x1
@@ -174,228 +202,97 @@ def pyramid_roi_align(inputs, pool_size, image_shape, base=224.):
     # Equation 1 in the Feature Pyramid Networks paper. Account for
     # the fact that our coordinates are normalized here.
     # e.g. a 224x224 ROI (in pixels) maps to P4
-    image_area = Variable(torch.FloatTensor([float(image_shape[0]*image_shape[1])]), requires_grad=False)
-    if boxes.is_cuda:
-        image_area = image_area.cuda()
+    image_area = Variable(boxes.data.new([float(image_shape[0]*image_shape[1])]), requires_grad=False)
     roi_level = 4 + log2(torch.sqrt(h*w)/(base/torch.sqrt(image_area)))
     roi_level = roi_level.round().int()
     # in case batch size =1, we keep that dim
-    roi_level = roi_level.clamp(2, 5).squeeze(dim=-1)   # size: [bs, num_roi], say [3, 1000 or 2000]
-
-    # Loop through levels and apply ROI pooling to each. P2 to P5.
-    pooled = []
-    box_to_level = []
-    for i, level in enumerate(range(2, 6)):
-        ix = roi_level == level
-        if not ix.any():
-            continue
-        index = torch.nonzero(ix)    # ix: bs, 1000; index: say, 2670 x 2
-        level_boxes = boxes[index[:, 0].data, index[:, 1].data, :]    # from boxes: [bs, 1000, 4] -> [index[0], 4]
-
-        # Keep track of which box is mapped to which level
-        box_to_level.append(index.data)
-
-        # Stop gradient propagation to ROI proposals (_rois is already detached)
-        # level_boxes = level_boxes.detach()
-
-        # Crop and Resize
-        box_ind = index[:, 0].int()   # indicates which sample (along the batch dim) the box comes from
-        curr_feature_maps = feature_maps[i]
-        pooled_features = CropAndResizeFunction(pool_size, pool_size)(curr_feature_maps, level_boxes, box_ind)
-        pooled.append(pooled_features)
-
-    # Pack pooled features into one tensor
-    pooled = torch.cat(pooled, dim=0)
-    # Pack box_to_level mapping into one array and add another
-    # column representing the order of pooled boxes
-    box_to_level = torch.cat(box_to_level, dim=0)
-
-    # Rearrange pooled features to match the order of the original boxes
-    pooled_out = Variable(torch.zeros(
-        boxes.size(0), boxes.size(1), pooled.size(1), pooled.size(2), pooled.size(3)).cuda())
-    pooled_out[box_to_level[:, 0], box_to_level[:, 1], :, :, :] = pooled
-    # 3, 1000, 256, 7 (or 14), 7 -> 3000, 256, 7, 7
-    pooled_out = pooled_out.view(-1, pooled_out.size(2), pooled_out.size(3), pooled_out.size(4))
-
-    return pooled_out
+    return roi_level.clamp(2, 5).squeeze(dim=-1)   # size: [bs, num_roi], say [3, 1000 or 2000]
 
 
-############################################################
-#  Detection Target Layer (Train)
-############################################################
-def generate_roi(config, proposals, gt_class_ids, gt_boxes, gt_masks):
-    # PER SAMPLE OPERATION
-    # proposals: N, 4
-    # gt_class_ids: size MAX_GT_NUM
-
-    if torch.nonzero(gt_class_ids < 0).size():
-        # Handle COCO crowds
-        # A crowd box in COCO is a bounding box around several instances. Exclude
-        # them from training. A crowd box is given a negative class ID.
-        _ind_crowd = torch.nonzero(gt_class_ids < 0).squeeze()
-        _ind_non_crowd = torch.nonzero(gt_class_ids > 0).squeeze()
-        crowd_boxes = gt_boxes[_ind_crowd, :]
-
-        gt_class_ids = gt_class_ids[_ind_non_crowd]
-        gt_boxes = gt_boxes[_ind_non_crowd, :]
-        gt_masks = gt_masks[_ind_non_crowd, :, :]
-
-        # Compute overlaps with crowd boxes [anchors, crowds]
-        crowd_overlaps = bbox_overlaps(proposals, crowd_boxes)  # shape [N, num_crowd_boxes]
-        crowd_iou_max = torch.max(crowd_overlaps, dim=-1)[0]
-        no_crowd_bool = crowd_iou_max < 0.001
-    else:
-        no_crowd_bool = Variable(torch.ByteTensor(proposals.size(0)), requires_grad=False).cuda()
-        no_crowd_bool[:] = True
-
-    # Compute overlaps matrix [bs, proposals, gt_boxes]
-    # try:
-    overlaps = bbox_overlaps(proposals, gt_boxes)   # gt_boxes might be empty
-    # except:
-    #     print('proposals size: ', proposals.size())
-    #     print('gt_boxes size: ', gt_boxes.size())
-
-    # Determine positive and negative ROIs
-    # shape [bs, N], means the maximum overlap for each RoI (N) with GTs
-    roi_iou_max = torch.max(overlaps, dim=-1)[0]
-
-    # Positive ROIs are those with >= 0.5 IoU with a GT box
-    pos_roi_bool = roi_iou_max >= 0.5  # shape [bs, N]
-    # Negative ROIs are those with < 0.5 with every GT box. Skip crowds.
-    neg_roi_bool = roi_iou_max < 0.5
-    neg_roi_bool = neg_roi_bool & no_crowd_bool
-
-    # ============================================
-    ROIS, ROI_GT_CLASS_IDS, DELTAS, MASKS = None, None, None, None
-
-    if torch.nonzero(pos_roi_bool).size():
-        pos_ind = torch.nonzero(pos_roi_bool)[:, 0]
-
-        pos_cnt_per_im = int(config.ROIS.TRAIN_ROIS_PER_IMAGE*config.ROIS.ROI_POSITIVE_RATIO)
-        rand_idx = torch.randperm(pos_ind.size(0)).cuda()
-        rand_idx = rand_idx[:pos_cnt_per_im]
-        pos_ind = pos_ind[rand_idx]
-        pos_cnt = pos_ind.size(0)
-
-        POS_ROIS = proposals[pos_ind.data, :]
-
-        # ROI_GT_CLASS_IDS
-        # Assign positive ROIs to GT boxes.
-        pos_overlaps = overlaps[pos_ind.data, :]    # shape: pos_cnt, gt_num
-        roi_gt_box_assignment = torch.max(pos_overlaps, dim=1)[1]
-        roi_gt_boxes = gt_boxes[roi_gt_box_assignment, :]
-        ROI_GT_CLASS_IDS = gt_class_ids[roi_gt_box_assignment].int()
-
-        # DELTAS
-        # Compute bbox refinement for positive ROIs
-        DELTAS = Variable(box_refinement(POS_ROIS.data, roi_gt_boxes.data), requires_grad=False)
-        std_dev = Variable(torch.from_numpy(config.DATA.BBOX_STD_DEV).float(), requires_grad=False)
-        if config.MISC.GPU_COUNT:
-            std_dev = std_dev.cuda()
-        DELTAS /= std_dev
-
-        # MASKS
-        # Assign positive ROIs to GT masks
-        roi_masks = gt_masks[roi_gt_box_assignment, :, :]  # shape: pos_cnt, mask_shape, mask_shape
-
-        # Compute mask targets
-        boxes = POS_ROIS
-        if config.MRCNN.USE_MINI_MASK:
-            # Transform ROI coordinates from normalized image space
-            # to normalized mini-mask space.
-            y1, x1, y2, x2 = POS_ROIS.chunk(4, dim=1)
-            gt_y1, gt_x1, gt_y2, gt_x2 = roi_gt_boxes.chunk(4, dim=1)
-            gt_h = gt_y2 - gt_y1
-            gt_w = gt_x2 - gt_x1
-            y1 = (y1 - gt_y1) / gt_h
-            x1 = (x1 - gt_x1) / gt_w
-            y2 = (y2 - gt_y1) / gt_h
-            x2 = (x2 - gt_x1) / gt_w
-            boxes = torch.cat([y1, x1, y2, x2], dim=1)
-
-        # box_ids ranges from 0 to the number of masks
-        # UPDATE: no need to fixme if switched to roi_pool method; since mask branch is for segmentation
-        box_ids = Variable(torch.arange(roi_masks.size(0)), requires_grad=False).cuda().int()
-        masks = Variable(
-            CropAndResizeFunction(config.MRCNN.MASK_SHAPE[0], config.MRCNN.MASK_SHAPE[1])
-            (roi_masks.unsqueeze(1), boxes, box_ids).data,
-            requires_grad=False)
-        masks = masks.squeeze(1)
-        # Threshold mask pixels at 0.5 to have GT masks be 0 or 1 to use with
-        # binary cross entropy loss.
-        MASKS = torch.round(masks)
-    else:
-        pos_cnt = 0
-
-    # Negative ROIs. Add enough to maintain positive:negative ratio.
-    if torch.nonzero(neg_roi_bool).size() and pos_cnt > 0:
-        neg_ind = torch.nonzero(neg_roi_bool)[:, 0]
-        r = 1.0 / config.ROIS.ROI_POSITIVE_RATIO
-        neg_cnt = int(r * pos_cnt - pos_cnt)
-        rand_idx = torch.randperm(neg_ind.size(0)).cuda()
-        rand_idx = rand_idx[:neg_cnt]
-        if config.MISC.GPU_COUNT:
-            rand_idx = rand_idx.cuda()
-        neg_ind = neg_ind[rand_idx]
-        neg_cnt = neg_ind.size(0)
-        NEG_ROIS = proposals[neg_ind, :]
-    else:
-        neg_cnt = 0
-
-    # Append negative ROIs and pad bbox deltas and masks that
-    # are not used for negative ROIs with zeros.
-    if pos_cnt > 0 and neg_cnt > 0:
-
-        ROIS = torch.cat((POS_ROIS, NEG_ROIS), dim=0)
-
-        zeros = Variable(torch.zeros(neg_cnt).cuda(), requires_grad=False).int()
-        ROI_GT_CLASS_IDS = torch.cat([ROI_GT_CLASS_IDS, zeros], dim=0)
-
-        zeros = Variable(torch.zeros(neg_cnt, 4).cuda(), requires_grad=False)
-        DELTAS = torch.cat([DELTAS, zeros], dim=0)
-
-        zeros = Variable(torch.zeros(neg_cnt, config.MRCNN.MASK_SHAPE[0], config.MRCNN.MASK_SHAPE[1]).cuda(),
-                         requires_grad=False)
-        MASKS = torch.cat([MASKS, zeros], dim=0)
-
-    elif pos_cnt > 0:
-
-        ROIS = POS_ROIS
-
-    elif neg_cnt > 0:
-
-        ROIS = NEG_ROIS
-
-        zeros = Variable(torch.zeros(neg_cnt).cuda(), requires_grad=False).int()
-        ROI_GT_CLASS_IDS = zeros
-
-        zeros = Variable(torch.zeros(neg_cnt, 4).cuda(), requires_grad=False)
-        DELTAS = zeros
+def copy_in_roi_order(out, roi_index, pooled, roi_num, zero_fill=False):
+    """Write the pooled features of one level straight into their rows of the RoI-ordered output.
+    Used by the paths that still crop level by level (RoIPool, and RoI align on per-RoI upsampled windows in
+    the dev structures); multilevel_roi_align does not need it.
+    The output is allocated on the first call; it is left uninitialized unless zero_fill is set, which is
+    needed only when some RoIs may not be assigned to any level.
+    Args:
+        out:            [roi_num, C, P, P] Variable, or None on the first call
+        roi_index:      [n] LongTensor, flat RoI index (sample_id * num_boxes + box_id) of each pooled row
+        pooled:         [n, C, P, P] Variable
+        roi_num:        total RoI number, batch * num_boxes
+    Returns:
+        out:            [roi_num, C, P, P] Variable
+    """
+    if out is None:
+        out = Variable(pooled.data.new(roi_num, pooled.size(1), pooled.size(2), pooled.size(3)))
+        if zero_fill:
+            out.data.zero_()
+    return out.index_copy_(0, Variable(roi_index), pooled)
+
+
+def multilevel_roi_align(feature_maps, boxes, box_level, pool_size):
+    """RoI align over all pyramid levels in a single MultiLevelCropAndResizeFunction launch: each box is cropped
+    from the map of its own level and written to its own row, so the output is already in RoI order
+    (no per-level nonzero, crop or scatter).
+    Runs on cpu or gpu depending on where the feature maps are.
+    Args:
+        feature_maps:   list of [batch, channels, height, width], P2 to P5; the sizes may differ from the
+                            backbone's (e.g. upsampled maps)
+        boxes:          [batch, num_boxes, (y1, x1, y2, x2)] in normalized coordinates.
+        box_level:      [batch*num_boxes] IntTensor, index (0 to 3) into feature_maps of the map each box is
+                            cropped from; -1 leaves the row of that box zero
+        pool_size:      output height (and width) of the pooled regions, e.g. 7 or 14
+    Returns:
+        pooled_out:     [batch*num_boxes, channels, pool_size, pool_size]
+    """
+    num_boxes = boxes.size(1)
+    flat_boxes = boxes.contiguous().view(-1, 4)
+    # indicates which sample (along the batch dim) the box comes from
+    box_ind = torch.arange(0, flat_boxes.size(0)).type_as(box_level) / num_boxes
+    return MultiLevelCropAndResizeFunction(pool_size, pool_size)(
+        *feature_maps[:4], flat_boxes, Variable(box_ind), Variable(box_level.contiguous()))
 
-        zeros = Variable(torch.zeros(neg_cnt, config.MRCNN.MASK_SHAPE[0], config.MRCNN.MASK_SHAPE[1]).cuda(),
-                         requires_grad=False)
-        MASKS = zeros
 
-    # # updated: pad ROIS
-    # if ROIS.size(0) < config.TRAIN_ROIS_PER_IMAGE:
-    #     more_zero_num = config.TRAIN_ROIS_PER_IMAGE - ROIS.size(0)
-    #     zeros = Variable(torch.zeros(more_zero_num, 4).cuda())  # should require gradient
-    #     ROIS = torch.cat((ROIS, zeros), dim=0)
+def pyramid_roi_align(inputs, pool_size, image_shape, base=224., roi_level=None):
+    """Implements ROI Pooling on multiple levels of the feature pyramid.
+    Args:
+        pool_size: [height, width] of the output pooled regions. Usually [7, 7]
+        image_shape: [height, width, channels]. Shape of input image in pixels
+        roi_level: optional, [batch, num_boxes] level assignment from assign_roi_level
 
-    return ROIS, ROI_GT_CLASS_IDS, DELTAS, MASKS
+        inputs:
+            - boxes: [batch, num_boxes, (y1, x1, y2, x2)] in normalized coordinates.
+            - Feature maps: List of feature maps from different levels of the pyramid.
+                        Each is [batch, channels, height, width]
+    Output:
+        Pooled regions in the shape: [batch*num_boxes, channels, height, width].
+        The width and height are those specific in the pool_shape in the layer constructor.
+    """
+    boxes, feature_maps = inputs[0], inputs[1:]
+    if roi_level is None:
+        roi_level = assign_roi_level(boxes, image_shape, base=base)
+    # P2 to P5 -> index 0 to 3 of feature_maps
+    box_level = roi_level.data.contiguous().view(-1) - 2
+    return multilevel_roi_align(feature_maps, boxes, box_level, pool_size)
 
 
-def prepare_det_target(proposals, gt_class_ids, gt_boxes, gt_masks, config):
+############################################################
+#  Detection Target Layer (Train)
+############################################################
+def prepare_det_target(proposals, gt_class_ids, gt_boxes, gt_masks, config, proposal_num=None):
     """Sub-samples proposals and generates target box refinement, class_ids and masks.
         Note that proposal class IDs, gt_boxes, and gt_masks are zero padded.
         Equally, returned rois and targets are zero padded.
+        Batched op: the rois of all samples are sampled together, with one crop-and-resize for all mask targets.
     Args:
         proposals:          [batch, N, (y1, x1, y2, x2)] in normalized coordinates.
                                 Might be zero padded if there are not enough proposals.
         gt_class_ids:       [batch, MAX_GT_NUM] Integer class IDs.
         gt_boxes:           [batch, MAX_GT_NUM, (y1, x1, y2, x2)] in normalized coordinates.
-        gt_masks:           [batch, MAX_GT_NUM, height (or smaller), width] of boolean type (might be mini-masked)
+        gt_masks:           [batch, MAX_GT_NUM, height (or smaller), width] uint8 (might be mini-masked)
         config:             configuration
+        proposal_num:       optional, [batch] number of valid proposals per image (see proposal_layer);
+                                if not given, the zero-area proposals are deemed padding
 
     Notes:
         MAX_GT_NUM <= config.MAX_GT_INSTANCES: it's the max_gt_num within this batch
@@ -408,82 +305,294 @@ def prepare_det_target(proposals, gt_class_ids, gt_boxes, gt_masks, config):
         target_mask:        [batch, TRAIN_ROIS_PER_IMAGE, height (exactly MASK_SHAPE), width)
                                 Masks cropped to bbox boundaries and resized to neural network output size.
     """
-    bs = proposals.size(0)
-    # set up new variables
+    bs, roi_num, gt_num = proposals.size(0), proposals.size(1), gt_class_ids.size(1)
     num_rois = config.ROIS.TRAIN_ROIS_PER_IMAGE   # max_rois_per_image
-    mask_sz = config.MRCNN.MASK_SHAPE[0]
+    mask_h, mask_w = config.MRCNN.MASK_SHAPE[0], config.MRCNN.MASK_SHAPE[1]
+    proposals, gt_class_ids, gt_boxes = proposals.data, gt_class_ids.data, gt_boxes.data
 
-    rois_out = Variable(torch.zeros(bs, num_rois, 4).cuda())
-    # rois_out = []
-    target_class_ids = Variable(torch.IntTensor(bs, num_rois).zero_().cuda(), requires_grad=False)
-    target_deltas = Variable(torch.zeros(bs, num_rois, 4).cuda(), requires_grad=False)
-    target_mask = Variable(torch.zeros(bs, num_rois, mask_sz, mask_sz).cuda(), requires_grad=False)
+    rois_out = proposals.new(bs * num_rois, 4).zero_()
+    target_class_ids = gt_class_ids.new(bs * num_rois).zero_().int()
+    target_deltas = proposals.new(bs * num_rois, 4).zero_()
+    target_mask = proposals.new(bs * num_rois, mask_h, mask_w).zero_()
 
-    for i in range(bs):
-        # per sample
-        rois, roi_gt_class_ids, deltas, masks = \
-            generate_roi(config, proposals[i], gt_class_ids[i], gt_boxes[i], gt_masks[i])
-        if rois is not None:
-            curr_rois_num = rois.size(0)
-            # print('curr_rois_num: ', curr_rois_num)
-            # print('roi_gt_class_ids: ', roi_gt_class_ids.size())
-            rois_out[i, :curr_rois_num] = rois
-            # rois_out.append(rois)
-            target_class_ids[i, :curr_rois_num] = roi_gt_class_ids
-            target_deltas[i, :curr_rois_num] = deltas
-            target_mask[i, :curr_rois_num] = masks
-
-    return rois_out, target_class_ids, target_deltas, target_mask
+    def _output():
+        return Variable(rois_out.view(bs, num_rois, 4)), \
+               Variable(target_class_ids.view(bs, num_rois), requires_grad=False), \
+               Variable(target_deltas.view(bs, num_rois, 4), requires_grad=False), \
+               Variable(target_mask.view(bs, num_rois, mask_h, mask_w), requires_grad=False)
+
+    # Compute overlaps matrix [bs, proposals, gt_boxes]
+    overlaps = bbox_overlaps(proposals, gt_boxes, config.MISC.IOU_CHUNK_SIZE)
+    # Handle COCO crowds
+    # A crowd box in COCO is a bounding box around several instances. Exclude
+    # them from training. A crowd box is given a negative class ID.
+    is_gt = (gt_class_ids > 0).unsqueeze(1).expand_as(overlaps)
+    is_crowd = (gt_class_ids < 0).unsqueeze(1).expand_as(overlaps)
+    no_crowd_bool = overlaps.masked_fill(is_crowd == 0, 0).max(dim=2)[0] < 0.001
+    # shape [bs, N], the maximum overlap for each RoI (N) with the GTs (crowds and padding excluded) and its GT
+    roi_iou_max, roi_gt_box_assignment = overlaps.masked_fill(is_gt == 0, -1).max(dim=2)
+
+    # Positive ROIs are those with >= 0.5 IoU with a GT box
+    pos_roi_bool = roi_iou_max >= 0.5
+    # Negative ROIs are those with < 0.5 with every GT box. Skip crowds.
+    # zero-padded proposals (see proposal_layer) are never sampled
+    if proposal_num is not None:
+        is_valid = torch.arange(0, roi_num).type_as(proposal_num).unsqueeze(0) < proposal_num.unsqueeze(1)
+    else:
+        area = (proposals[:, :, 2] - proposals[:, :, 0]) * (proposals[:, :, 3] - proposals[:, :, 1])
+        is_valid = area > 0
+    neg_roi_bool = (roi_iou_max < 0.5) & no_crowd_bool & is_valid
+
+    # Random subsets: each roi draws a random key (-1 if not of the wanted type) and the top-k keys are kept,
+    # at most quota[i] in sample i. Returns [bs, max_quota] roi index, rank within the subset, keep flag.
+    _im = torch.arange(0, bs).type_as(roi_gt_box_assignment).unsqueeze(1)
+
+    def _sample(roi_bool, quota, max_quota):
+        key = proposals.new(bs, roi_num).uniform_().masked_fill_(roi_bool == 0, -1)
+        key, ids = key.topk(max_quota, dim=1)
+        rank = torch.arange(0, max_quota).type_as(quota).unsqueeze(0).expand(bs, max_quota)
+        keep = (key >= 0) & (rank < quota.unsqueeze(1))
+        return ids, rank, keep
+
+    pos_cnt_per_im = int(config.ROIS.TRAIN_ROIS_PER_IMAGE * config.ROIS.ROI_POSITIVE_RATIO)
+    pos_ids, pos_rank, pos_keep = _sample(pos_roi_bool, _im.new(bs).fill_(pos_cnt_per_im), pos_cnt_per_im)
+    pos_cnt = pos_keep.long().sum(1)
+    # Negative ROIs. Add enough to maintain positive:negative ratio.
+    r = 1.0 / config.ROIS.ROI_POSITIVE_RATIO
+    neg_cnt = torch.min((pos_cnt.double() * r - pos_cnt.double()).long(), num_rois - pos_cnt)
+    neg_ids, neg_rank, neg_keep = _sample(neg_roi_bool, neg_cnt, min(num_rois, roi_num))
+
+    # Positive ROIs first, then negative ROIs; bbox deltas and masks of the negative ROIs stay zero
+    pos_sel = torch.nonzero(pos_keep.view(-1))
+    if pos_sel.dim() == 0:
+        return _output()
+    pos_sel = pos_sel.squeeze(1)
+    pos_im = _im.expand_as(pos_ids).contiguous().view(-1)[pos_sel]
+    pos_roi = (_im * roi_num + pos_ids).view(-1)[pos_sel]
+    pos_out = (_im * num_rois + pos_rank).view(-1)[pos_sel]
+    pos_rois = proposals.view(-1, 4)[pos_roi]
+
+    # Assign positive ROIs to GT boxes.
+    gt_index = pos_im * gt_num + roi_gt_box_assignment.view(-1)[pos_roi]
+    roi_gt_boxes = gt_boxes.view(-1, 4)[gt_index]
+    rois_out.index_copy_(0, pos_out, pos_rois)
+    target_class_ids.index_copy_(0, pos_out, gt_class_ids.view(-1)[gt_index].int())
+
+    # Compute bbox refinement for positive ROIs
+    std_dev = to_device(torch.from_numpy(config.DATA.BBOX_STD_DEV).float(), config)
+    target_deltas.index_copy_(0, pos_out, box_refinement(pos_rois, roi_gt_boxes) / std_dev)
+
+    # Compute mask targets of all positive ROIs in one crop-and-resize
+    boxes = pos_rois
+    if config.MRCNN.USE_MINI_MASK:
+        # Transform ROI coordinates from normalized image space
+        # to normalized mini-mask space.
+        y1, x1, y2, x2 = pos_rois.chunk(4, dim=1)
+        gt_y1, gt_x1, gt_y2, gt_x2 = roi_gt_boxes.chunk(4, dim=1)
+        gt_h = gt_y2 - gt_y1
+        gt_w = gt_x2 - gt_x1
+        y1 = (y1 - gt_y1) / gt_h
+        x1 = (x1 - gt_x1) / gt_w
+        y2 = (y2 - gt_y1) / gt_h
+        x2 = (x2 - gt_x1) / gt_w
+        boxes = torch.cat([y1, x1, y2, x2], dim=1)
+
+    # only the gt masks of the sampled positive ROIs are expanded to float, one per ROI
+    # UPDATE: no need to fixme if switched to roi_pool method; since mask branch is for segmentation
+    roi_masks = gt_masks.data.view(bs * gt_num, gt_masks.size(2), gt_masks.size(3))[gt_index].float().unsqueeze(1)
+    box_ids = torch.arange(0, roi_masks.size(0)).type_as(gt_index).int()
+    masks = CropAndResizeFunction(mask_h, mask_w)(
+        Variable(roi_masks), Variable(boxes), Variable(box_ids)).data.squeeze(1)
+    # Threshold mask pixels at 0.5 to have GT masks be 0 or 1 to use with
+    # binary cross entropy loss.
+    target_mask.index_copy_(0, pos_out, torch.round(masks))
+
+    neg_sel = torch.nonzero(neg_keep.view(-1))
+    if neg_sel.dim() > 0:
+        neg_sel = neg_sel.squeeze(1)
+        neg_roi = (_im * roi_num + neg_ids).view(-1)[neg_sel]
+        neg_out = (_im * num_rois + pos_cnt.unsqueeze(1) + neg_rank).view(-1)[neg_sel]
+        rois_out.index_copy_(0, neg_out, proposals.view(-1, 4)[neg_roi])
+
+    return _output()
 
 
 ##############################################################################
 #  RPN target layer (previously in __get_item__ now in forward() Train phase)
 ##############################################################################
-def generate_target(config, anchors, gt_class_ids, gt_boxes, *args):
-    """per sample op."""
-    # sample_id is the id within each GPU
-    RARE_CASE = False
-    curr_sample_id = args[0]
-    coco_im_id = args[1].data.cpu().numpy()
-    curr_im_name = coco_im_id[curr_sample_id]
-
-    if SEE_ONE_EXAMPLE and EXAMPLE_COCO_IND == coco_im_id[curr_sample_id]:
-        print('this is the image you want to see: {}'.format(EXAMPLE_COCO_IND))
-        a = 1
-
-    # RPN Match: 1 = positive anchor, -1 = negative anchor, 0 = neutral
-    target_rpn_match = Variable(torch.zeros(anchors.size(0)).cuda(), requires_grad=False)
-    # RPN bounding boxes: [max anchors per image, (dy, dx, log(dh), log(dw))]
-    target_rpn_bbox = Variable(torch.zeros(config.RPN.TRAIN_ANCHORS_PER_IMAGE, 4).cuda(), requires_grad=False)
-
-    original_gt_full_size = gt_class_ids.size(0)
-    original_gt_num = torch.sum((gt_class_ids > 0).long()).data[0]
-    if torch.nonzero(gt_class_ids < 0).size():
-        # Filter out crowds from ground truth class IDs and boxes
-        _ind_crowd = torch.nonzero(gt_class_ids < 0).squeeze()
-        _ind_non_crowd = torch.nonzero(gt_class_ids > 0).squeeze()
-        crowd_boxes = gt_boxes[_ind_crowd]
-
-        # update gt_boxes
-        gt_boxes = gt_boxes[_ind_non_crowd]
-        gt_class_ids = gt_class_ids[_ind_non_crowd]
-
-        # Compute overlaps with crowd boxes [anchors, crowds]
-        crowd_overlaps = bbox_overlaps(anchors, crowd_boxes)
-        crowd_iou_max = torch.max(crowd_overlaps, dim=-1)[0]
-        no_crowd_bool = (crowd_iou_max < 0.001)
-        if config.CTRL.PROFILE_ANALYSIS:
-            print('\t\t[sample_id {}, im {}] 0. passed crowd reduction in generate_rpn_target'.
-                  format(curr_sample_id, coco_im_id[curr_sample_id]))
-    else:
-        # All anchors don't intersect a crowd
-        no_crowd_bool = Variable(torch.ByteTensor(anchors.size(0)), requires_grad=False).cuda()
-        no_crowd_bool[:] = True
-    actual_gt_num = torch.sum((gt_class_ids > 0).long()).data[0]
+def generate_prior_grid(scales, ratios, feature_shapes, feature_strides, anchor_stride):
+    """
+    EXECUTE ONLY ONCE (per image shape).
+    Index over the layout of generate_pyramid_priors(): within each (level, ratio) group the anchors have the
+    same size and their centers form a regular grid, so the anchors whose extent overlaps a box are the ones
+    in a rectangle of that grid; see _sparse_anchor_match().
+
+    Returns: dict of [num_groups] Tensors (do not assign cuda() here)
+        offset:     index of the first anchor (row 0, col 0) of the group
+        rows, cols: grid size of the group
+        step:       distance (in pixels) between neighbouring anchor centers
+        height, width: anchor size
+        and ratio_num (int): anchor index = offset + (row * cols + col) * ratio_num
+    """
+    groups = []
+    level_offset = 0
+    for i in range(len(scales)):
+        rows = int(np.ceil(feature_shapes[i][0] / anchor_stride))
+        cols = int(np.ceil(feature_shapes[i][1] / anchor_stride))
+        for j, ratio in enumerate(ratios):
+            groups.append([level_offset + j, rows, cols, feature_strides[i] * anchor_stride,
+                           scales[i] / np.sqrt(ratio), scales[i] * np.sqrt(ratio)])
+        level_offset += rows * cols * len(ratios)
+    groups = np.array(groups, dtype=np.float64)
+    prior_grid = {name: torch.from_numpy(groups[:, k]).long() for k, name in enumerate(['offset', 'rows', 'cols'])}
+    prior_grid.update({name: torch.from_numpy(groups[:, k]).float()
+                       for k, name in enumerate(['step', 'height', 'width'], 3)})
+    prior_grid['ratio_num'] = len(ratios)
+    return prior_grid
+
+
+def _max_per_key(key, value):
+    """For each distinct key: the position of its max value.
+    Args:
+        key:        [K] LongTensor
+        value:      [K] FloatTensor, in [0, 1]
+    Returns:
+        uniq_key:   [U] distinct keys (ascending)
+        max_pos:    [U] position (in key) of the max value of each key
+    """
+    # after sorting by key + value / 2, the last entry of each key holds its max value
+    order = (key.double() + value.double() * 0.5).sort()[1]
+    key = key[order]
+    next_pos = (torch.arange(1, key.size(0) + 1).type_as(key)).clamp(max=key.size(0) - 1)
+    is_last = key[next_pos] != key
+    is_last[key.size(0) - 1] = 1
+    last = torch.nonzero(is_last).squeeze(1)
+    return key[last], order[last]
+
+
+def _dense_anchor_match(anchors, gt_class_ids, gt_boxes, config):
+    """IoU of every anchor with every gt/crowd box. Args and Returns: see _sparse_anchor_match()"""
+    bs, anchor_num = gt_class_ids.size(0), anchors.size(0)
+
+    # Compute overlaps [bs, num_anchors, num_gt_boxes]
+    overlaps = bbox_overlaps(anchors, gt_boxes, config.MISC.IOU_CHUNK_SIZE)
+    is_gt = (gt_class_ids > 0).unsqueeze(1).expand_as(overlaps)
+    is_crowd = (gt_class_ids < 0).unsqueeze(1).expand_as(overlaps)
+
+    # Anchors overlapping a crowd are never negative
+    no_crowd_bool = overlaps.masked_fill(is_crowd == 0, 0).max(dim=2)[0] < 0.001
+    # crowds and padding never match an anchor
+    overlaps = overlaps.masked_fill(is_gt == 0, -1)
+    anchor_iou_max, anchor_iou_argmax = torch.max(overlaps, dim=2)
+
+    gt_iou_argmax = torch.max(overlaps, dim=1)[1]   # bs, num_gt_boxes
+    _batch_offset = torch.arange(0, bs).type_as(gt_iou_argmax).unsqueeze(1) * anchor_num
+    gt_anchor = (gt_iou_argmax + _batch_offset)[gt_class_ids > 0]
+    return anchor_iou_max, anchor_iou_argmax, no_crowd_bool, gt_anchor
+
+
+def _sparse_anchor_match(anchors, gt_class_ids, gt_boxes, prior_grid, config):
+    """IoU only of the (anchor, box) pairs whose extents overlap, found via the prior grid; every other
+    anchor has IoU 0 with all boxes (i.e., negative).
+    Args:
+        anchors:            [num_anchors, 4] Tensor, in the layout of generate_pyramid_priors()
+        gt_class_ids:       [bs, num_gt_boxes] Tensor; 0 = padding, < 0 = crowd
+        gt_boxes:           [bs, num_gt_boxes, 4] Tensor
+        prior_grid:         see generate_prior_grid()
+    Returns:
+        anchor_iou_max:     [bs, num_anchors] max IoU with the gt boxes of the image (crowds excluded)
+        anchor_iou_argmax:  [bs, num_anchors] index of that gt box
+        no_crowd_bool:      [bs, num_anchors] True if the anchor does not overlap a crowd
+        gt_anchor:          [num_valid_gt] the closest anchor of each gt box, as index into bs*num_anchors
+    """
+    bs, gt_num = gt_class_ids.size()
+    anchor_num = anchors.size(0)
+    anchor_iou_max = anchors.new(bs * anchor_num).zero_()
+    anchor_iou_argmax = gt_boxes.new(bs * anchor_num).zero_().long()
+    no_crowd_bool = gt_boxes.new(bs * anchor_num).fill_(1).byte()
+    box_ids = torch.nonzero(gt_class_ids.view(-1) != 0)
+    if box_ids.dim() == 0:
+        return anchor_iou_max.view(bs, -1), anchor_iou_argmax.view(bs, -1), no_crowd_bool.view(bs, -1), \
+               anchor_iou_argmax.new()
+    box_ids = box_ids.squeeze(1)
+    boxes = gt_boxes.view(-1, 4)[box_ids]   # all gt and crowd boxes of the batch
+
+    # 1. for each (box, group): the rectangle of grid cells whose anchors overlap the box; [box_num, group_num]
+    grid = {k: to_device(v, config) if torch.is_tensor(v) else v for k, v in prior_grid.items()}
+    group_num = grid['offset'].size(0)
+    step = grid['step'].unsqueeze(0)
+
+    def _grid_range(lo, hi, half_size, size):
+        start = ((lo.unsqueeze(1) - half_size.unsqueeze(0)) / step).ceil().clamp(min=0)
+        end = torch.min(((hi.unsqueeze(1) + half_size.unsqueeze(0)) / step).floor(),
+                        (size - 1).float().unsqueeze(0).expand(lo.size(0), group_num))
+        return start.long(), (end - start + 1).clamp(min=0).long()
+
+    row_start, row_num = _grid_range(boxes[:, 0], boxes[:, 2], grid['height'] / 2, grid['rows'])
+    col_start, col_num = _grid_range(boxes[:, 1], boxes[:, 3], grid['width'] / 2, grid['cols'])
+
+    # 2. enumerate the candidate (anchor, box) pairs of all rectangles
+    cell_num = (row_num * col_num).view(-1)
+    pair = torch.nonzero(cell_num).squeeze(1)
+    cell_num = cell_num[pair]
+    pair_start = torch.cumsum(cell_num, 0) - cell_num
+    pair_of = cell_num.new(cell_num.sum()).zero_()
+    pair_of[pair_start] = 1
+    pair_of = torch.cumsum(pair_of, 0) - 1   # candidate -> index into pair
+    local = torch.arange(0, pair_of.size(0)).type_as(pair_of) - pair_start[pair_of]
+    pair = pair[pair_of]
+    _box, _group = pair / group_num, pair % group_num
+    _col_num = col_num.view(-1)[pair]
+    row = row_start.view(-1)[pair] + local / _col_num
+    col = col_start.view(-1)[pair] + local % _col_num
+    anchor_ids = grid['offset'][_group] + (row * grid['cols'][_group] + col) * grid['ratio_num']
+
+    iou = compute_iou(anchors[anchor_ids].unsqueeze(1), boxes[_box].unsqueeze(1)).view(-1)
+    flat_anchor = (box_ids[_box] / gt_num) * anchor_num + anchor_ids
+    is_crowd = gt_class_ids.view(-1)[box_ids[_box]] < 0
+
+    # 3. Anchors overlapping a crowd are never negative
+    crowd_hit = torch.nonzero(is_crowd & (iou >= 0.001))
+    if crowd_hit.dim() > 0:
+        no_crowd_bool[flat_anchor[crowd_hit.squeeze(1)]] = 0
+
+    # 4. max / argmax over the gt boxes of each anchor, and over the anchors of each gt box
+    obj = torch.nonzero(is_crowd == 0)
+    if obj.dim() == 0:
+        # crowds only
+        return anchor_iou_max.view(bs, -1), anchor_iou_argmax.view(bs, -1), no_crowd_bool.view(bs, -1), \
+               anchor_iou_argmax.new()
+    obj = obj.squeeze(1)
+    iou, flat_anchor, _box = iou[obj], flat_anchor[obj], _box[obj]
+    uniq_anchor, max_pos = _max_per_key(flat_anchor, iou)
+    anchor_iou_max[uniq_anchor] = iou[max_pos]
+    anchor_iou_argmax[uniq_anchor] = box_ids[_box[max_pos]] % gt_num
+    gt_anchor = flat_anchor[_max_per_key(_box, iou)[1]]
+    return anchor_iou_max.view(bs, -1), anchor_iou_argmax.view(bs, -1), no_crowd_bool.view(bs, -1), gt_anchor
+
+
+def generate_target(config, anchors, gt_class_ids, gt_boxes, prior_grid=None):
+    """batched op: matches, pos/neg subsampling and bbox deltas of the whole batch in tensor ops,
+    with no per-sample / per-anchor loop.
+    Args:
+        anchors:            [num_anchors, 4] Tensor
+        gt_class_ids:       [bs, num_gt_boxes] Tensor; 0 = padding, < 0 = crowd
+        gt_boxes:           [bs, num_gt_boxes, 4] Tensor
+        prior_grid:         if given (see generate_prior_grid), IoU is only computed for the anchors near a box
+    Returns:
+        target_rpn_match:   [bs, num_anchors] Tensor; 1 = positive, -1 = negative, 0 = neutral
+        target_rpn_bbox:    [bs, TRAIN_ANCHORS_PER_IMAGE, 4] Tensor; deltas of the positive anchors
+                                (in anchor order), zero padded; not yet divided by BBOX_STD_DEV
+    """
+    bs, anchor_num = gt_class_ids.size(0), anchors.size(0)
+    anchors_per_image = config.RPN.TRAIN_ANCHORS_PER_IMAGE
 
-    # Compute overlaps
-    # previously known as "compute_overlaps"
-    overlaps = bbox_overlaps(anchors, gt_boxes)  # shape [num_anchors, num_gt_boxes]
+    if prior_grid is not None:
+        anchor_iou_max, anchor_iou_argmax, no_crowd_bool, gt_anchor = \
+            _sparse_anchor_match(anchors, gt_class_ids, gt_boxes, prior_grid, config)
+    else:
+        anchor_iou_max, anchor_iou_argmax, no_crowd_bool, gt_anchor = \
+            _dense_anchor_match(anchors, gt_class_ids, gt_boxes, config)
 
     # Match anchors to GT Boxes
     # If an anchor overlaps a GT box with IoU >= 0.7 then it's positive.
@@ -492,132 +601,48 @@ def generate_target(config, anchors, gt_class_ids, gt_boxes, *args):
     # and they don't influence the loss function.
     # However, don't keep any GT box unmatched (rare, but happens). Instead,
     # match it to the closest anchor (even if its max IoU is < 0.3).
+    target_rpn_match = anchors.new(bs, anchor_num).zero_()
 
     # 1. Set negative anchors first. They get overwritten below if a GT box is
     # matched to them. Skip boxes in crowd areas.
-    anchor_iou_max, anchor_iou_argmax = torch.max(overlaps, dim=-1)
     target_rpn_match[(anchor_iou_max < config.RPN.TARGET_NEG_THRES) & no_crowd_bool] = -1
 
     # 2. Set an anchor for each GT box (regardless of IoU value).
-    gt_iou_argmax = torch.max(overlaps, dim=0)[1]
-    target_rpn_match[gt_iou_argmax[:actual_gt_num]] = 1
+    if gt_anchor.dim() > 0:
+        target_rpn_match.view(-1)[gt_anchor] = 1
 
     # 3. Set anchors with high overlap as positive.
     target_rpn_match[anchor_iou_max >= config.RPN.TARGET_POS_THRES] = 1
 
-    if config.CTRL.PROFILE_ANALYSIS:
-        print('\t\t[sample_id {}, im {}] 1. passed initial assignment in generate_rpn_target'.
-              format(curr_sample_id, coco_im_id[curr_sample_id]))
-    try:
-        _pos_num_before = torch.sum((target_rpn_match == 1).long()).data[0]
-        _neg_num_before = torch.sum((target_rpn_match == -1).long()).data[0]
-        _neutral_num_before = torch.sum((target_rpn_match == 0).long()).data[0]
-    except RuntimeError:
-        # import pdb
-        # pdb.set_trace()
-        a = 1
-
-    # 4. Subsample to balance positive and negative anchors
-    # Don't let positives be more than half the anchors
-    pos_ids = torch.nonzero(target_rpn_match == 1).squeeze()
-    pos_extra = pos_ids.size(0) - (config.RPN.TRAIN_ANCHORS_PER_IMAGE // 2)
-    if pos_extra > 0:
-        if config.CTRL.PROFILE_ANALYSIS:
-            print('\t\t\t[sample_id {}, im {}] enter pos reduction ...'.
-                  format(curr_sample_id, coco_im_id[curr_sample_id]))
-        # Reset the extra ones to neutral
-        _tmp = torch.from_numpy(np.random.permutation(pos_ids.size(0))).cuda()
-        # _tmp = torch.randperm(pos_ids.size(0)).cuda()
-        _ids = pos_ids[_tmp[:pos_extra]]
-        target_rpn_match[_ids] = 0
-        pos_set_to_zero = _ids.size(0)
-        if config.CTRL.PROFILE_ANALYSIS:
-            print('\t\t\t[sample_id {}, im {}] set extra anchors of positive to neutral '
-                  'in generate_rpn_target'.format(curr_sample_id, coco_im_id[curr_sample_id]))
-    else:
-        pos_set_to_zero = -1
-
-    # Same for negative proposals
-    # TODO: bug here
-    try:
-        neg_ids = torch.nonzero(target_rpn_match == -1).squeeze()
-        neg_extra = neg_ids.size(0) - (config.RPN.TRAIN_ANCHORS_PER_IMAGE -
-                                   torch.sum((target_rpn_match == 1).long()).data[0])
-    except RuntimeError:
-        import pdb
-        pdb.set_trace()
-        a = 1
-
-    if neg_extra > 0:
-        # Reset the extra ones to neutral
-        _tmp = torch.from_numpy(np.random.permutation(neg_ids.size(0))).cuda()
-        _ids = neg_ids[_tmp[:neg_extra]]
-        _neg_set_to_zero = _ids.size(0)
-        target_rpn_match[_ids] = 0
-    else:
-        _neg_set_to_zero = -1
-        RARE_CASE = True
-        _pos_num = torch.sum((target_rpn_match == 1).long()).data[0]
-        _neg_num = torch.sum((target_rpn_match == -1).long()).data[0]
-        _neutral_num = torch.sum((target_rpn_match == 0).long()).data[0]
-        print_log('\n[im: {}][WARNING!!!], neg ids is smaller!'
-                  '\t\tpos_num: {}, neg_num: {}, neutral_num: {}, anchors_num: {}\n'
-                  .format(curr_im_name,
-                          _pos_num, _neg_num, _neutral_num, anchors.size(0)), config.MISC.LOG_FILE)
-    # ======= ABOVE DONE =======
-
-    # TODO: bug this line. RuntimeError: cuda runtime error (59) : device-side assert triggered at
-    # see issue here: https://github.com/pytorch/pytorch/issues/4144
-    try:
-        _pos_num = torch.sum((target_rpn_match == 1).long()).data[0]
-        _neg_num = torch.sum((target_rpn_match == -1).long()).data[0]
-        _neutral_num = torch.sum((target_rpn_match == 0).long()).data[0]
-    except RuntimeError:
-        a = 1
-
-    # check total number of anchor
-    if _pos_num + _neg_num != config.RPN.TRAIN_ANCHORS_PER_IMAGE and not RARE_CASE:
-        a = 1
-        # import pdb
-        # pdb.set_trace()
-        print_log('\n[im: {}][WARNING!!!]'
-                  '\t\tpos_num: {}, neg_num: {}, neutral_num: {}, anchors_num: {}\n'
-                  '\t\toriginal_gt_num: {}, actual_gt_num (after crowd): {}, original_gt_full_size: {}\n'
-                  '\t\tpos_ids size: {}, neg_ids size: {}\n'
-                  '\t\tpos_extra: {}, neg_extra: {}\n'
-                  '\t\tpos_set_to_zero size: {}, neg_set_to_zero size: {}\n'
-                  '\t\tbefore sub-sample: pos {}, neg {}, neutral {}'.
-                  format(curr_im_name,
-                         _pos_num, _neg_num, _neutral_num, anchors.size(0),
-                         original_gt_num, actual_gt_num, original_gt_full_size,
-                         pos_ids.size(0), neg_ids.size(0),
-                         pos_extra, neg_extra,
-                         pos_set_to_zero, _neg_set_to_zero,
-                         _pos_num_before, _neg_num_before, _neutral_num_before
-                         ), config.MISC.LOG_FILE)
-
-    if config.CTRL.PROFILE_ANALYSIS:
-        print('\t\t[sample_id {}, im {}] 2. passed rpn_target_match'.
-              format(curr_sample_id, coco_im_id[curr_sample_id]))
+    # 4. Subsample to balance positive and negative anchors: keep a random subset of at most
+    # anchors_per_image // 2 positives, then fill up to anchors_per_image with random negatives.
+    # Each anchor draws a random key (-1 for the other types); the kept ones are the top-k keys.
+    def _subsample(match_type, quota, max_quota):
+        key = anchors.new(bs, anchor_num).uniform_().masked_fill_(target_rpn_match != match_type, -1)
+        key, ids = key.topk(max_quota, dim=1)
+        pos = torch.arange(0, max_quota).type_as(quota).unsqueeze(0)
+        keep = (key >= 0) & (pos < quota.unsqueeze(1))
+        return target_rpn_match.new(bs, anchor_num).zero_().scatter_(1, ids, keep.type_as(target_rpn_match))
+
+    pos_bool = _subsample(1, anchor_iou_argmax.new(bs).fill_(anchors_per_image // 2), anchors_per_image // 2)
+    neg_bool = _subsample(-1, anchors_per_image - pos_bool.sum(1).long(), anchors_per_image)
+    target_rpn_match = pos_bool - neg_bool
 
     # For *positive* anchors, compute shift and scale needed to transform them
-    # to match the corresponding GT boxes.
-    ix = 0
-    pos_ids = torch.nonzero(target_rpn_match == 1).squeeze()
-    for pos_id in pos_ids:
-        # Closest gt box (it might have IoU < TARGET_POS_THRES)
-        gt = gt_boxes[anchor_iou_argmax[pos_id]]
-        anchor = anchors[pos_id]
-        target_rpn_bbox[ix] = box_refinement(anchor, gt)
-        ix += 1
-    # if config.CTRL.PROFILE_ANALYSIS:
-    #     print('\t\t[sample_id {}, im {}] passed rpn_target_bbox'.
-    #           format(curr_sample_id, coco_im_id[curr_sample_id]))
-
-    return target_rpn_match, target_rpn_bbox
-
-
-def prepare_rpn_target(anchors, gt_class_ids, gt_boxes, config, curr_coco_im_id=None):
+    # to match the corresponding GT boxes (the closest one; it might have IoU < TARGET_POS_THRES).
+    target_rpn_bbox = anchors.new(bs * anchors_per_image, 4).zero_()
+    pos_ids = torch.nonzero(pos_bool)
+    if pos_ids.dim() > 0:
+        _im, _anchor = pos_ids[:, 0], pos_ids[:, 1]
+        # positives are listed in anchor order within each image
+        rank = (torch.cumsum(pos_bool, dim=1) - 1).long()[_im, _anchor]
+        gt = gt_boxes[_im, anchor_iou_argmax[_im, _anchor]]
+        target_rpn_bbox.index_copy_(0, _im * anchors_per_image + rank, box_refinement(anchors[_anchor], gt))
+
+    return target_rpn_match, target_rpn_bbox.view(bs, anchors_per_image, 4)
+
+
+def prepare_rpn_target(anchors, gt_class_ids, gt_boxes, config, curr_coco_im_id=None, prior_grid=None):
     """Given the anchors and GT boxes, compute overlaps and identify positive
     anchors and deltas to refine them to match their corresponding GT boxes.
 
@@ -626,103 +651,105 @@ def prepare_rpn_target(anchors, gt_class_ids, gt_boxes, config, curr_coco_im_id=
         gt_class_ids:       [bs, num_gt_boxes] Variable (FloatTensor)
         gt_boxes:           [bs, num_gt_boxes, (y1, x1, y2, x2)]
         config:             configuration
+        curr_coco_im_id:    [bs] Variable, coco image ids (only for SEE_ONE_EXAMPLE debugging)
+        prior_grid:         index of the anchors (see generate_prior_grid); None = dense anchor-gt IoU
 
     Returns:
         target_rpn_match:   [bs, num_anchors] (int32) matches between anchors and GT boxes.
                                 1 = positive anchor, -1 = negative anchor, 0 = neutral
         target_rpn_bbox:    [bs, TRAIN_ANCHORS_PER_IMAGE, (dy, dx, log(dh), log(dw))] Anchor bbox deltas.
     """
-    # var_debug = {
-    #     'anchors': anchors,
-    #     'gt_class_ids': gt_class_ids,
-    #     'gt_boxes': gt_boxes,
-    #     'config': config,
-    #     'curr_coco_im_id': curr_coco_im_id,
-    # }
-    # torch.save(var_debug, 'var_debug')
-
-    # my_vars = torch.load('var_debug')
-    # anchors = my_vars['anchors']
-    # gt_class_ids = my_vars['gt_class_ids']
-    # gt_boxes = my_vars['gt_boxes']
-    # config = my_vars['config']
-    # curr_coco_im_id = my_vars['curr_coco_im_id']
-
-    bs = gt_class_ids.size(0)
-    anchors = Variable(anchors.cuda(), requires_grad=False)
-
-    rpn_match, rpn_bbox = [], []
-
-    for i in range(bs):
-        _rpn_match, _rpn_bbox = generate_target(
-            config, anchors, gt_class_ids[i], gt_boxes[i], i, curr_coco_im_id)
-        rpn_match.append(_rpn_match)
-        rpn_bbox.append(_rpn_bbox)
+    if SEE_ONE_EXAMPLE and curr_coco_im_id is not None and \
+            EXAMPLE_COCO_IND in curr_coco_im_id.data.cpu().numpy():
+        print('this is the image you want to see: {}'.format(EXAMPLE_COCO_IND))
 
-    rpn_match = torch.stack(rpn_match)
-    rpn_bbox = torch.stack(rpn_bbox)
-    rpn_bbox /= Variable(torch.from_numpy(config.DATA.BBOX_STD_DEV).float().cuda())
+    anchors = to_device(anchors, config)
+    rpn_match, rpn_bbox = generate_target(config, anchors, gt_class_ids.data, gt_boxes.data, prior_grid)
+    rpn_bbox /= to_device(torch.from_numpy(config.DATA.BBOX_STD_DEV).float(), config)
 
-    return rpn_match, rpn_bbox
+    return Variable(rpn_match, requires_grad=False), Variable(rpn_bbox, requires_grad=False)
 
 
 ############################################################
 #  Detection Layer (Inference)
 ############################################################
-def conduct_nms(class_ids, refined_rois, class_scores, keep, config):
-    """per SAMPLE operation; no batch size dim!
+def conduct_nms(class_ids, refined_rois, class_scores, keep, config, box_num_per_sample):
+    """Class-aware nms for the whole batch in ONE call: boxes are shifted apart per (image, class) pair
+    so that they only suppress boxes of the same class in the same image.
     Args:
-        class_ids       [say 1000]
-        refined_rois    [1000 4]
-        class_scores    [1000]
-        keep            [True, False, ...] altogether 1000
+        class_ids       [bs*1000]
+        refined_rois    [bs*1000 4], in image coordinates (rounded)
+        class_scores    [bs*1000]
+        keep            [True, False, ...] altogether bs*1000
         config          config
+        box_num_per_sample: 1000
     Returns:
-        detection:      [DET_MAX_INSTANCES, (y1, x1, y2, x2, class_id, class_score)]
+        final_index:    [K] indices (among the bs*1000 input boxes) of the kept detections,
+                            grouped by image and in descending score order inside each image
+        final_im:       [K] image index of each kept detection
+        final_rank:     [K] rank of each kept detection within its image (< DET_MAX_INSTANCES)
     """
-    pre_nms_class_ids = class_ids[keep]
-    pre_nms_scores = class_scores[keep]
-    pre_nms_rois = refined_rois[torch.nonzero(keep).squeeze(), :]
-    _indx = torch.nonzero(keep).squeeze()
-
-    # conduct nms per CLASS
-    for i, class_id in enumerate(unique1d(pre_nms_class_ids)):
-
-        # Pick detections of this class
-        ixs = torch.nonzero(class_id == pre_nms_class_ids).squeeze()
-
-        ix_scores = pre_nms_scores[ixs]
-        ix_rois = pre_nms_rois[ixs, :]
-
-        # Sort
-        ix_scores, order = ix_scores.sort(descending=True)
-        ix_rois = ix_rois[order, :]
-
-        class_keep = nms(torch.cat((ix_rois, ix_scores.unsqueeze(1)), dim=1).unsqueeze(0).data,
-                         config.TEST.DET_NMS_THRESHOLD)[0]
-
-        # Map indices
-        class_keep = _indx[ixs[order[class_keep.tolist()]]]  # TODO (low): why not order[class_keep] directly?
-
-        if i == 0:
-            nms_keep = class_keep
-        else:
-            nms_keep = unique1d(torch.cat((nms_keep, class_keep)))
-
-    nms_indx = intersect1d(_indx, nms_keep)
-
-    # Keep top detections
-    roi_count = config.TEST.DET_MAX_INSTANCES
-    top_ids = class_scores[nms_indx].sort(descending=True)[1][:roi_count]
-    # final_index is the true index among the input samples (say 1000)
-    final_index = nms_indx[top_ids].squeeze()
-
-    # Arrange output as [DET_MAX_INSTANCES, (y1, x1, y2, x2, class_id, score)]
-    # Coordinates are in image domain.
-    detections = torch.cat((refined_rois[final_index],
-                            class_ids[final_index].unsqueeze(1).float(),
-                            class_scores[final_index].unsqueeze(1)), dim=1)
-    return detections, final_index
+    bs = class_ids.size(0) // box_num_per_sample
+    _indx = torch.nonzero(keep.data).squeeze(1)
+    # descending score order, as the greedy nms visits the boxes
+    _indx = _indx[class_scores.data[_indx].sort(descending=True)[1]]
+    pre_nms_im = _indx / box_num_per_sample
+    groups = pre_nms_im * config.DATASET.NUM_CLASSES + class_ids.data[_indx]
+
+    dets = torch.cat((refined_rois.data[_indx], class_scores.data[_indx].unsqueeze(1)), dim=1)
+    nms_keep = nms_grouped(dets, groups, config.TEST.DET_NMS_THRESHOLD)
+
+    # Keep top detections per image
+    order, rank, _ = _rank_per_image(pre_nms_im[nms_keep], bs)
+    nms_keep = nms_keep[order]
+    top = torch.nonzero(rank < config.TEST.DET_MAX_INSTANCES).squeeze(1)
+    final_index = _indx[nms_keep[top]]
+    return final_index, final_index / box_num_per_sample, rank[top]
+
+
+def conduct_fast_nms(class_ids, refined_rois, class_scores, keep, config, box_num_per_sample):
+    """Approximate, fully parallel class-aware nms ("Fast NMS"; TEST.NMS_METHOD='fast'): for each image,
+    boxes are sorted by score and a box is dropped if its IoU with ANY higher-scored box of the same class
+    is >= DET_NMS_THRESHOLD, even if that box was dropped itself. One IoU matrix per image, no sequential loop.
+    Args and Returns: same as conduct_nms()
+    """
+    bs = class_ids.size(0) // box_num_per_sample
+    _indx = torch.nonzero(keep.data).squeeze(1)
+    # group by image, descending score inside each image; pad to [bs, max_num]
+    _indx = _indx[class_scores.data[_indx].sort(descending=True)[1]]
+    pre_nms_im = _indx / box_num_per_sample
+    order, rank, pre_nms_num = _rank_per_image(pre_nms_im, bs)
+    _indx, pre_nms_im = _indx[order], pre_nms_im[order]
+    max_num = pre_nms_num.max()
+    flat_pos = pre_nms_im * max_num + rank
+
+    boxes = refined_rois.data.new(bs * max_num, 4).zero_()
+    boxes.index_copy_(0, flat_pos, refined_rois.data[_indx])
+    boxes = boxes.view(bs, max_num, 4)
+    cls = class_ids.data.new(bs * max_num).fill_(-1)
+    cls.index_copy_(0, flat_pos, class_ids.data[_indx])
+    cls = cls.view(bs, max_num)
+
+    # IoU of every pair, same convention (+1 pixel) as the greedy nms; [bs, max_num, max_num]
+    y1, x1, y2, x2 = [boxes[:, :, k] for k in range(4)]
+    area = (y2 - y1 + 1) * (x2 - x1 + 1)
+    inter_h = torch.min(y2.unsqueeze(2), y2.unsqueeze(1)) - torch.max(y1.unsqueeze(2), y1.unsqueeze(1)) + 1
+    inter_w = torch.min(x2.unsqueeze(2), x2.unsqueeze(1)) - torch.max(x1.unsqueeze(2), x1.unsqueeze(1)) + 1
+    inter = inter_h.clamp(min=0) * inter_w.clamp(min=0)
+    iou = inter / (area.unsqueeze(2) + area.unsqueeze(1) - inter)
+    # only higher-scored (row i < column j) boxes of the same class suppress
+    upper = boxes.new(max_num, max_num).fill_(1).triu(1).unsqueeze(0).expand_as(iou)
+    same_cls = (cls.unsqueeze(2) == cls.unsqueeze(1)).type_as(iou)
+    max_iou = (iou * upper * same_cls).max(dim=1)[0]   # bs, max_num
+
+    # Keep top detections per image
+    # (padding sits after the real boxes of each image, so it does not shift their rank)
+    kept = max_iou < config.TEST.DET_NMS_THRESHOLD
+    kept_rank = (torch.cumsum(kept.long(), dim=1) - 1).view(-1)[flat_pos]
+    kept = kept.view(-1)[flat_pos]
+    top = torch.nonzero(kept & (kept_rank < config.TEST.DET_MAX_INSTANCES)).squeeze(1)
+    final_index = _indx[top]
+    return final_index, pre_nms_im[top], kept_rank[top]
 
 
 def detection_layer(rois, probs, deltas, windows, config, feature=None, small_feat_gt=None):
@@ -740,38 +767,38 @@ def detection_layer(rois, probs, deltas, windows, config, feature=None, small_fe
         DEPRECATED small_feat_gt: [bs*1000]
     Returns:
         detections:             [batch, num_detections, (y1, x1, y2, x2, class_id, class_score)]
+        output_feat:            [batch, num_detections, 1024]; None if feature is not provided
     """
     bs = rois.size(0)
     box_num_per_sample = rois.size(1)
     # init detections (result) all zeros
-    detections = Variable(torch.zeros(bs, config.TEST.DET_MAX_INSTANCES, 6).cuda(), volatile=True)
+    detections = Variable(to_device(torch.zeros(bs, config.TEST.DET_MAX_INSTANCES, 6), config), volatile=True)
     output_feat = None
     if feature is not None:
         feat_dim = feature.size(1)
-        output_feat = Variable(torch.zeros(bs, config.TEST.DET_MAX_INSTANCES, feat_dim).cuda(), volatile=True)
+        output_feat = Variable(to_device(torch.zeros(bs, config.TEST.DET_MAX_INSTANCES, feat_dim),
+                                         config), volatile=True)
 
     # Class IDs per ROI
     class_scores, class_ids = torch.max(probs, dim=1)
 
     # Class probability of the top class of each ROI
     # Class-specific bounding box deltas
-    _idx = torch.arange(class_ids.size(0)).cuda().long()
+    _idx = to_device(torch.arange(class_ids.size(0)), config).long()
     deltas_specific = deltas[_idx, class_ids]   # TODO (important): good example of 2D index
 
     # Apply bounding box deltas
     # Shape: [boxes, (y1, x1, y2, x2)] in normalized coordinates
-    std_dev = Variable(torch.from_numpy(np.reshape(config.DATA.BBOX_STD_DEV, [1, 4])).float(), requires_grad=False)
-    if config.MISC.GPU_COUNT:
-        std_dev = std_dev.cuda()
+    std_dev = to_device(Variable(torch.from_numpy(np.reshape(config.DATA.BBOX_STD_DEV, [1, 4])).float(),
+                                 requires_grad=False), config)
     deltas_specific *= std_dev
 
     rois = rois.view(-1, 4)
     refined_rois = apply_box_deltas(rois.unsqueeze(0), deltas_specific.unsqueeze(0))
     # Convert coordinates to image domain
     height, width = config.DATA.IMAGE_SHAPE[:2]
-    scale = Variable(torch.from_numpy(np.array([height, width, height, width])).float(), requires_grad=False)
-    if config.MISC.GPU_COUNT:
-        scale = scale.cuda()
+    scale = to_device(Variable(torch.from_numpy(np.array([height, width, height, width])).float(),
+                               requires_grad=False), config)
     refined_rois *= scale
     # Clip boxes to image window
     refined_rois = clip_boxes(refined_rois, windows)
@@ -784,28 +811,23 @@ def detection_layer(rois, probs, deltas, windows, config, feature=None, small_fe
 
     if torch.nonzero(keep_bool).dim() == 0:
         # indicate no detected boxes!
-        return detections
+        return detections, output_feat
 
-    # conduct nms per sample
-    for i in range(bs):
-        curr_start = i*box_num_per_sample
-        curr_end = i*box_num_per_sample + box_num_per_sample
-        curr_keep_bool = keep_bool[curr_start:curr_end]
-        if torch.sum(curr_keep_bool.long()).data[0] == 0:
-            continue
-
-        curr_dets, final_index = conduct_nms(
-            class_ids[curr_start:curr_end],
-            refined_rois[curr_start:curr_end, :],
-            class_scores[curr_start:curr_end],
-            curr_keep_bool,
-            config)
-        actual_dets_num = curr_dets.size(0)
-        detections[i, :actual_dets_num, :] = curr_dets
-
-        if feature is not None:
-            temp = feature[curr_start:curr_end]  # 1000 x 1024 (feat_dim)
-            output_feat[i, :actual_dets_num] = temp[final_index]
+    # class-aware nms of all samples in one call
+    nms_func = conduct_fast_nms if config.TEST.NMS_METHOD == 'fast' else conduct_nms
+    final_index, final_im, final_rank = nms_func(
+        class_ids, refined_rois, class_scores, keep_bool, config, box_num_per_sample)
+
+    # Arrange output as [DET_MAX_INSTANCES, (y1, x1, y2, x2, class_id, score)] per sample, zero padded
+    # Coordinates are in image domain.
+    out_index = final_im * config.TEST.DET_MAX_INSTANCES + final_rank
+    curr_dets = torch.cat((refined_rois.data[final_index],
+                           class_ids.data[final_index].unsqueeze(1).float(),
+                           class_scores.data[final_index].unsqueeze(1)), dim=1)
+    detections.data.view(-1, 6).index_copy_(0, out_index, curr_dets)
+
+    if feature is not None:
+        output_feat.data.view(-1, feat_dim).index_copy_(0, out_index, feature.data[final_index])
 
     return detections, output_feat
 
@@ -853,7 +875,7 @@ def compute_rpn_bbox_loss(target_rpn_bbox, target_rpn_match, rpn_bbox):
 
     # Trim target bounding box deltas to the same length as rpn_bbox.
     bs = target_rpn_bbox.size(0)
-    target_bbox_sort = Variable(torch.zeros(rpn_bbox.size()).cuda(), requires_grad=False)
+    target_bbox_sort = Variable(rpn_bbox.data.new(rpn_bbox.size()).zero_(), requires_grad=False)
     cnt = 0
     for i in range(bs):
         curr_size = sum(indices.data[:, 0] == i)
@@ -895,8 +917,8 @@ def compute_mrcnn_bbox_loss(target_bbox, target_class_ids, pred_bbox):
         # TODO: optimize here, loss
         # in my ugly manner
         ugly_ind = torch.nonzero(target_class_ids > 0).long()
-        target_bbox_sort = Variable(torch.zeros(ugly_ind.size(0), 4).cuda(), requires_grad=False)
-        temp = Variable(torch.zeros(ugly_ind.size(0), 4).cuda(), requires_grad=True)
+        target_bbox_sort = Variable(target_bbox.data.new(ugly_ind.size(0), 4).zero_(), requires_grad=False)
+        temp = Variable(pred_bbox.data.new(ugly_ind.size(0), 4).zero_(), requires_grad=True)
         pred_bbox_sort = temp.clone()
 
         for i in range(ugly_ind.size(0)):
@@ -926,8 +948,8 @@ def compute_mrcnn_mask_loss(target_masks, target_class_ids, pred_masks):
         # in my ugly manner
         mask_sz = target_masks.size(2)
         ugly_ind = torch.nonzero(target_class_ids > 0).long()
-        y_true_sort = Variable(torch.zeros(ugly_ind.size(0), mask_sz, mask_sz).cuda(), requires_grad=False)
-        temp = Variable(torch.zeros(y_true_sort.size()).cuda(), requires_grad=True)
+        y_true_sort = Variable(target_masks.data.new(ugly_ind.size(0), mask_sz, mask_sz).zero_(), requires_grad=False)
+        temp = Variable(pred_masks.data.new(y_true_sort.size()).zero_(), requires_grad=True)
         y_pred_sort = temp.clone()
 
         for i in range(ugly_ind.size(0)):
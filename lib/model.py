@@ -9,7 +9,9 @@ from torch.autograd import Variable
 
 import tools.utils as utils
 from lib.OT_module import OptTrans
-from tools.image_utils import parse_image_meta
+from lib.nms.nms_wrapper import set_nms_backend
+from lib.roi_align.crop_and_resize import set_num_threads as set_roi_align_threads
+from tools.image_utils import parse_image_meta, mold_inputs, unmold_detections
 from tools.tsne.vtsne import VTSNE
 
 
@@ -20,6 +22,8 @@ class MaskRCNN(nn.Module):
     def __init__(self, config):
         super(MaskRCNN, self).__init__()
         self.config = config
+        set_nms_backend(config.MISC.NMS_BACKEND)
+        set_roi_align_threads(config.MISC.CPU_ROI_THREADS)
         self._build(config=config)
         self._initialize_weights()
     @property
@@ -60,6 +64,9 @@ class MaskRCNN(nn.Module):
             generate_pyramid_priors(config.RPN.ANCHOR_SCALES, config.RPN.ANCHOR_RATIOS,
                                     config.MODEL.BACKBONE_SHAPES, config.MODEL.BACKBONE_STRIDES,
                                     config.RPN.ANCHOR_STRIDE)).float()
+        self.prior_grid = generate_prior_grid(
+            config.RPN.ANCHOR_SCALES, config.RPN.ANCHOR_RATIOS, config.MODEL.BACKBONE_SHAPES,
+            config.MODEL.BACKBONE_STRIDES, config.RPN.ANCHOR_STRIDE) if config.RPN.TARGET_SPARSE_MATCH else None
         # RPN
         self.rpn = RPN(len(config.RPN.ANCHOR_RATIOS), config.RPN.ANCHOR_STRIDE, input_ch=256)
         # RoI
@@ -109,8 +116,10 @@ class MaskRCNN(nn.Module):
         """ called in 'utils.py' """
         if self.config.DEV.INIT_BUFFER_WEIGHT == 'scratch':
             utils.print_log('init buffer from scratch ...', log_file)
-            self.buffer = torch.zeros(self.config.DEV.BUFFER_SIZE, 1024, self.config.DATASET.NUM_CLASSES).cuda()
-            self.buffer_cnt = torch.zeros(self.config.DEV.BUFFER_SIZE, 1, self.config.DATASET.NUM_CLASSES).cuda()
+            self.buffer = to_device(torch.zeros(self.config.DEV.BUFFER_SIZE, 1024, self.config.DATASET.NUM_CLASSES),
+                                    self.config)
+            self.buffer_cnt = to_device(torch.zeros(self.config.DEV.BUFFER_SIZE, 1, self.config.DATASET.NUM_CLASSES),
+                                        self.config)
 
         elif self.config.DEV.INIT_BUFFER_WEIGHT == 'coco_pretrain':
             # TODO: init buffer
@@ -174,7 +183,7 @@ class MaskRCNN(nn.Module):
             _idx_tmp = torch.nonzero(small_gt_all).squeeze().data
             buff_cls_idx = torch.nonzero(torch.sum(self.buffer_cnt, dim=0).squeeze() > 0).squeeze()
             _idx = [ind for ind in _idx_tmp if small_gt_all[ind].data.cpu().numpy() in buff_cls_idx]
-            _idx = torch.from_numpy(np.array(_idx)).cuda()
+            _idx = to_device(torch.from_numpy(np.array(_idx)), self.config)
         else:
             # final_small_feat, 1024 x 81; final_small_cnt, 1 x 81
             final_small_feat, final_small_cnt = self._merge_feat_vec(small_feat, small_cnt)
@@ -209,7 +218,7 @@ class MaskRCNN(nn.Module):
             elif self.config.DEV.LOSS_CHOICE == 'ot':
                 loss = self.ot_loss(SMALL.unsqueeze(dim=-1), BIG.unsqueeze(dim=-1).contiguous())
         else:
-            loss = Variable(torch.zeros(1).cuda())
+            loss = Variable(to_device(torch.zeros(1), self.config))
         return loss
 
     @staticmethod
@@ -226,9 +235,9 @@ class MaskRCNN(nn.Module):
         feat_avg_sum /= (cnt_sum + EPS)
         return feat_avg_sum, cnt_sum
 
-    @staticmethod
-    def adjust_input_gt(*args):
-        """zero-padding different number of GTs for each image within the batch"""
+    def adjust_input_gt(self, *args):
+        """zero-padding different number of GTs for each image within the batch;
+        gt masks stay uint8 (ByteTensor) up to the crop-and-resize in prepare_det_target"""
         gt_cls_ids = args[0]
         gt_boxes = args[1]
         gt_masks = args[2]
@@ -239,18 +248,75 @@ class MaskRCNN(nn.Module):
 
         GT_CLS_IDS = torch.zeros(bs, max_gt_num)
         GT_BOXES = torch.zeros(bs, max_gt_num, 4)
-        GT_MASKS = torch.zeros(bs, max_gt_num, mask_shape, mask_shape)
+        GT_MASKS = torch.ByteTensor(bs, max_gt_num, mask_shape, mask_shape).zero_()
         for i in range(bs):
             GT_CLS_IDS[i, :gt_num[i]] = torch.from_numpy(gt_cls_ids[i])
             GT_BOXES[i, :gt_num[i], :] = torch.from_numpy(gt_boxes[i]).float()
-            GT_MASKS[i, :gt_num[i], :, :] = torch.from_numpy(gt_masks[i]).float()
+            GT_MASKS[i, :gt_num[i], :, :] = torch.from_numpy(gt_masks[i])
 
-        GT_CLS_IDS = Variable(GT_CLS_IDS.cuda(), requires_grad=False)
-        GT_BOXES = Variable(GT_BOXES.cuda(), requires_grad=False)
-        GT_MASKS = Variable(GT_MASKS.cuda(), requires_grad=False)
+        GT_CLS_IDS = Variable(to_device(GT_CLS_IDS, self.config), requires_grad=False)
+        GT_BOXES = Variable(to_device(GT_BOXES, self.config), requires_grad=False)
+        GT_MASKS = Variable(to_device(GT_MASKS, self.config), requires_grad=False)
 
         return GT_CLS_IDS, GT_BOXES, GT_MASKS, gt_num
 
+    def adjust_input_rpn_target(self, inputs):
+        """rpn targets computed in the data loader (RPN.TARGET_IN_LOADER); [] otherwise.
+        The returned list goes between gt_masks and image_metas in the train input of forward()."""
+        if not self.config.RPN.TARGET_IN_LOADER:
+            return []
+        rpn_match = Variable(to_device(inputs[4].float(), self.config), requires_grad=False)
+        rpn_bbox = Variable(to_device(inputs[5], self.config), requires_grad=False)
+        return [rpn_match, rpn_bbox]
+
+    def detect(self, images, batch_size=None):
+        """Runs the detection pipeline on in-memory images; no dataset or coco api needed.
+        Call it on the bare model (use model.module.detect for nn.DataParallel).
+            images:         List of image matrices [height, width, 3] (RGB, uint8). Images can have different sizes.
+            batch_size:     max number of images per forward pass; default is TEST.BATCH_SIZE
+
+        Returns a list of dicts, one dict per image, in the same order:
+            rois:           [N, (y1, x1, y2, x2)] detection bounding boxes in pixels
+            class_ids:      [N] int class IDs
+            scores:         [N] float probability scores for the class IDs
+            masks:          [height, width, N] uint8 instance binary masks ([height, width, 0] if there is no
+                            detection); all zero for detections with score < TEST.MASK_MIN_SCORE (no mask
+                            computed, see tools.image_utils.mask_computed); None if TEST.OUTPUT='boxes'
+        """
+        if batch_size is None:
+            batch_size = self.config.TEST.BATCH_SIZE
+        batch_size = max(batch_size, 1)
+
+        results = []
+        for start in range(0, len(images), batch_size):
+            curr_images = []
+            for image in images[start:start + batch_size]:
+                # If grayscale or with alpha channel, convert to RGB for consistency.
+                if image.ndim != 3:
+                    image = np.stack([image] * 3, axis=-1)
+                curr_images.append(image[:, :, :3])
+
+            molded_images, image_metas, windows = mold_inputs(curr_images, self.config)
+            molded_images = torch.from_numpy(molded_images.transpose(0, 3, 1, 2)).float()
+            molded_images = Variable(to_device(molded_images, self.config), volatile=True)
+            image_metas = Variable(to_device(torch.from_numpy(image_metas), self.config), volatile=True)
+
+            # detections: bs, 100, 6; mrcnn_mask: bs, 100, 28, 28 (not computed if TEST.OUTPUT='boxes')
+            outputs = self.forward([molded_images, image_metas], mode='inference')
+            detections = outputs[0].data.cpu().numpy()
+            mrcnn_mask = outputs[1].data.cpu().numpy() if len(outputs) > 1 else None
+
+            for i, image in enumerate(curr_images):
+                final_rois, final_class_ids, final_scores, final_masks = unmold_detections(
+                    detections[i], mrcnn_mask[i] if mrcnn_mask is not None else None, image.shape, windows[i])
+                results.append({
+                    'rois':         final_rois,
+                    'class_ids':    final_class_ids,
+                    'scores':       final_scores,
+                    'masks':        final_masks,
+                })
+        return results
+
     def forward(self, input, mode, do_meta=False):
         """forward function of the Mask-RCNN network
             input: data
@@ -261,7 +327,7 @@ class MaskRCNN(nn.Module):
         molded_images = input[0]
         sample_per_gpu = molded_images.size(0)  # aka, actual batch size
         # for debug only
-        curr_gpu_id = torch.cuda.current_device()
+        curr_gpu_id = torch.cuda.current_device() if self.config.MISC.DEVICE == 'cuda' else -1
         curr_coco_im_id = input[-1][:, -1]
 
         # set model state
@@ -303,13 +369,17 @@ class MaskRCNN(nn.Module):
 
         # Generate proposals
         # Proposals are [batch, N (say 2000), (y1, x1, y2, x2)] in normalized coordinates and zero padded.
-        _proposals = proposal_layer([_rpn_class_score, rpn_pred_bbox],
-                                    proposal_count=_proposal_cnt,
-                                    nms_threshold=self.config.RPN.NMS_THRESHOLD,
-                                    priors=self.priors, config=self.config)
+        # proposal_num: [batch], number of valid (non-padded) proposals per image
+        _proposals, proposal_num = proposal_layer([_rpn_class_score, rpn_pred_bbox],
+                                                  proposal_count=_proposal_cnt,
+                                                  nms_threshold=self.config.RPN.NMS_THRESHOLD,
+                                                  priors=self.priors, config=self.config)
+        if mode != 'train':
+            # drop the zero padding common to all images, so that the RoI heads do not run on it
+            _proposals = _proposals[:, :max(proposal_num.max(), 1)].contiguous()
         # Normalize coordinates
         h, w = self.config.DATA.IMAGE_SHAPE[:2]
-        scale = Variable(torch.from_numpy(np.array([h, w, h, w])).float(), requires_grad=False).cuda()
+        scale = to_device(Variable(torch.from_numpy(np.array([h, w, h, w])).float(), requires_grad=False), self.config)
 
         if self.config.CTRL.PROFILE_ANALYSIS and mode == 'train':
             print('\t[gpu {:d}] curr_coco_im_ids: {}'.format(curr_gpu_id, curr_coco_im_id.data.cpu().numpy()))
@@ -319,7 +389,8 @@ class MaskRCNN(nn.Module):
 
             assert _proposals.sum().data[0] != 0
 
-            _pooled_cls, _, _feat_out_test = self.dev_roi(_mrcnn_feature_maps, _proposals)
+            # the 14x14 mask crops of the proposals are not used
+            _pooled_cls, _, _feat_out_test = self.dev_roi(_mrcnn_feature_maps, _proposals, need_mask=False)
 
             if self.config.DEV.STRUCTURE == 'beta':
                 small_output_all, small_gt_all = _feat_out_test
@@ -332,18 +403,36 @@ class MaskRCNN(nn.Module):
             # input[1], image_metas, (3, 90), Variable
             _, _, windows, _, _ = parse_image_meta(input[1])
             # output is [batch, num_detections (say 100), (y1, x1, y2, x2, class_id, score)] in image coordinates
-            detections = detection_layer(_proposals, mrcnn_class, mrcnn_bbox, windows, self.config)
+            detections, _ = detection_layer(_proposals, mrcnn_class, mrcnn_bbox, windows, self.config)
 
             # assert detections.sum().data[0] != 0   # update: allow zero detection
-            # Convert boxes to normalized coordinates
-            normalize_boxes = detections[:, :, :4] / scale
-            # Create masks for detections
-            _, _pooled_mask, _ = self.dev_roi(_mrcnn_feature_maps, normalize_boxes)
-            mrcnn_mask = self.mask(_pooled_mask)
-
-            # shape: batch, num_detections, 81, 28, 28
-            mrcnn_mask = mrcnn_mask.view(
-                sample_per_gpu, -1, mrcnn_mask.size(1), mrcnn_mask.size(2), mrcnn_mask.size(3))
+            if self.config.TEST.OUTPUT == 'boxes':
+                # NO MASK BRANCH
+                return [detections]
+
+            # Run the mask branch on the real detections only. They are a score-sorted prefix of the zero-padded
+            # detections of each image, so RoI pooling runs on the first max_valid boxes per image and the mask
+            # head only on the valid ones among them; the rest (including detections below MASK_MIN_SCORE, which
+            # stay in the output) get an empty mask.
+            mask_h, mask_w = self.config.MRCNN.MASK_SHAPE
+            valid = (detections[:, :, 4] > 0) & (detections[:, :, 5] >= self.config.TEST.MASK_MIN_SCORE)
+            max_valid = torch.sum(valid.long(), dim=1).max().data[0]
+            # shape: batch, num_detections, 28, 28
+            mrcnn_mask = Variable(detections.data.new(sample_per_gpu, detections.size(1), mask_h, mask_w).zero_(),
+                                  volatile=True)
+            if max_valid > 0:
+                # Convert boxes to normalized coordinates
+                normalize_boxes = detections[:, :max_valid, :4] / scale
+                # Create masks for detections
+                _, _pooled_mask, _ = self.dev_roi(_mrcnn_feature_maps, normalize_boxes, need_cls=False, need_feat=False)
+                index = torch.nonzero(valid[:, :max_valid]).data   # valid_num x 2
+                _pooled_mask = _pooled_mask[index[:, 0] * max_valid + index[:, 1]]
+                curr_mask = self.mask(_pooled_mask)   # valid_num, 81, 28, 28
+
+                # keep only the mask of the predicted class before it leaves the device
+                class_ids = detections[index[:, 0], index[:, 1], 4].long()
+                _idx = to_device(torch.arange(class_ids.size(0)), self.config).long()
+                mrcnn_mask[index[:, 0], index[:, 1]] = curr_mask[_idx, class_ids]
 
             return [detections, mrcnn_mask]
 
@@ -351,7 +440,8 @@ class MaskRCNN(nn.Module):
 
             assert _proposals.sum().data[0] != 0
 
-            _pooled_cls, _, _feat_out_test = self.dev_roi(_mrcnn_feature_maps, _proposals)
+            # the 14x14 mask crops of the proposals are not used
+            _pooled_cls, _, _feat_out_test = self.dev_roi(_mrcnn_feature_maps, _proposals, need_mask=False)
 
             if self.config.DEV.STRUCTURE == 'beta':
                 small_output_all, small_gt_all = _feat_out_test
@@ -373,15 +463,14 @@ class MaskRCNN(nn.Module):
 
             gt_class_ids, gt_boxes, gt_masks = input[1], input[2], input[3]
 
-            # 1. compute RPN targets
-            # try:
-            target_rpn_match, target_rpn_bbox = \
-                prepare_rpn_target(self.priors, gt_class_ids, gt_boxes, self.config, curr_coco_im_id)
-            # except RuntimeError:
-            #     import pdb
-            #     pdb.set_trace()
-            #     a = 1
- 
+            # 1. compute RPN targets (or take them from the data loader)
+            if self.config.RPN.TARGET_IN_LOADER:
+                target_rpn_match, target_rpn_bbox = input[4], input[5]
+            else:
+                target_rpn_match, target_rpn_bbox = \
+                    prepare_rpn_target(self.priors, gt_class_ids, gt_boxes, self.config, curr_coco_im_id,
+                                       self.prior_grid)
+
             if self.config.CTRL.PROFILE_ANALYSIS:
                 print('\t[gpu {:d}] pass rpn_target generation'.format(curr_gpu_id))
 
@@ -390,7 +479,8 @@ class MaskRCNN(nn.Module):
             # target_class_ids: bs, 200
             # TODO: roi-pool below
             _rois, target_class_ids, target_deltas, target_mask = \
-                prepare_det_target(_proposals.detach(), gt_class_ids, gt_boxes / scale, gt_masks, self.config)
+                prepare_det_target(_proposals.detach(), gt_class_ids, gt_boxes / scale, gt_masks, self.config,
+                                   proposal_num)
             if self.config.CTRL.PROFILE_ANALYSIS:
                 print('\t[gpu {:d}] pass pass det_target generation'.format(curr_gpu_id))
 
@@ -399,20 +489,23 @@ class MaskRCNN(nn.Module):
             scale_num = 2 if self.config.DEV.STRUCTURE == 'alpha' else 3
             if self.config.DEV.ASSIGN_BOX_ON_ALL_SCALE:
                 scale_num = 4
-            big_feat = Variable(torch.zeros(1, scale_num, 1024, self.config.DATASET.NUM_CLASSES).cuda())
-            big_cnt = Variable(torch.zeros(1, scale_num, 1, self.config.DATASET.NUM_CLASSES).cuda())
-            small_feat = Variable(torch.zeros(1, scale_num, 1024, self.config.DATASET.NUM_CLASSES).cuda())
-            small_cnt = Variable(torch.zeros(1, scale_num, 1, self.config.DATASET.NUM_CLASSES).cuda())
-            big_loss = Variable(torch.zeros(1, scale_num, 1).cuda())
+            big_feat = Variable(to_device(torch.zeros(1, scale_num, 1024, self.config.DATASET.NUM_CLASSES),
+                                          self.config))
+            big_cnt = Variable(to_device(torch.zeros(1, scale_num, 1, self.config.DATASET.NUM_CLASSES), self.config))
+            small_feat = Variable(to_device(torch.zeros(1, scale_num, 1024, self.config.DATASET.NUM_CLASSES),
+                                            self.config))
+            small_cnt = Variable(to_device(torch.zeros(1, scale_num, 1, self.config.DATASET.NUM_CLASSES), self.config))
+            big_loss = Variable(to_device(torch.zeros(1, scale_num, 1), self.config))
 
-            small_output_all = Variable(torch.zeros(1, 1024).cuda())
-            small_gt_all = Variable(torch.zeros(1).cuda())
+            small_output_all = Variable(to_device(torch.zeros(1, 1024), self.config))
+            small_gt_all = Variable(to_device(torch.zeros(1), self.config))
 
             num_rois, mask_sz, num_cls = \
                 self.config.ROIS.TRAIN_ROIS_PER_IMAGE, self.config.MRCNN.MASK_SHAPE[0], self.config.DATASET.NUM_CLASSES
-            mrcnn_class_logits = Variable(torch.zeros(sample_per_gpu, num_rois, num_cls).cuda())
-            mrcnn_bbox = Variable(torch.zeros(sample_per_gpu, num_rois, num_cls, 4).cuda())
-            mrcnn_mask = Variable(torch.zeros(sample_per_gpu, num_rois, num_cls, mask_sz, mask_sz).cuda())
+            mrcnn_class_logits = Variable(to_device(torch.zeros(sample_per_gpu, num_rois, num_cls), self.config))
+            mrcnn_bbox = Variable(to_device(torch.zeros(sample_per_gpu, num_rois, num_cls, 4), self.config))
+            mrcnn_mask = Variable(to_device(torch.zeros(sample_per_gpu, num_rois, num_cls, mask_sz, mask_sz),
+                                            self.config))
 
             # 3. mask and cls generation
             if torch.sum(_rois).data[0] != 0:
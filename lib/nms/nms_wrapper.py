@@ -7,28 +7,61 @@
 from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
-from lib.nms.pth_nms import pth_nms
-import numpy as np
+from lib.nms.pth_nms import pth_nms, EXT_AVAILABLE
+from lib.nms.py_nms import py_nms
+import torch
 
+# 'ext': compiled lib/nms/_ext (pth_nms); 'torch': vectorized tensor ops (py_nms), no build needed
+_NMS_FUNC = {'ext': pth_nms, 'torch': py_nms}
+_nms_backend = 'ext' if EXT_AVAILABLE else 'torch'
 
-def nms(dets, thresh):
-    """Dispatch to either CPU or GPU NMS implementations.
-    used in both inference (keep_out is 1D) and 'proposal_layer' (keep_out is 2D)
+
+def set_nms_backend(backend='auto'):
+    """backend: 'auto' (use 'ext' if the extension is built, otherwise 'torch'), 'ext' or 'torch'"""
+    global _nms_backend
+    if backend == 'auto':
+        backend = 'ext' if EXT_AVAILABLE else 'torch'
+    assert backend in _NMS_FUNC, 'unknown nms backend {}'.format(backend)
+    if backend == 'ext' and not EXT_AVAILABLE:
+        raise ImportError('nms backend [ext] requested but lib/nms/_ext is not built; run setup.sh')
+    _nms_backend = backend
+    return backend
+
+
+def nms_single(dets, thresh):
+    """NMS on one sample with the selected backend.
+    Args:
+        dets:       [N, 5] Tensor, (y1, x1, y2, x2, score)
+    Returns:
+        keep:       LongTensor, kept indices in descending score order
+    """
+    return _NMS_FUNC[_nms_backend](dets, thresh)
+
+
+def nms_batch(dets, thresh):
+    """Batched NMS in one call: boxes of different samples never suppress each other (see nms_grouped).
+    Args:
+        dets:       [bs, N, 5] Tensor, (y1, x1, y2, x2, score); coordinates are non-negative
+        thresh:     nms threshold
+    Returns:
+        keep:       LongTensor (K,), indices into the flattened (bs*N) boxes, in descending score order
+    """
+    bs, num = dets.size(0), dets.size(1)
+    groups = torch.arange(0, bs).type_as(dets).unsqueeze(1).expand(bs, num).contiguous().view(-1)
+    return nms_grouped(dets.view(-1, 5), groups, thresh)
+
+
+def nms_grouped(dets, groups, thresh):
+    """NMS in one call where boxes only suppress boxes of the same group (say, image and/or class):
+    each group is shifted by group_id * max_coordinate so that boxes of different groups never overlap.
     Args:
-        dets:       [bs, N, 4]
+        dets:       [N, 5] Tensor, (y1, x1, y2, x2, score); coordinates are non-negative
+        groups:     [N] Tensor, non-negative integer group id of each box
         thresh:     nms threshold
     Returns:
-        keep_out:   ndarray (bs, min_keep_num)
+        keep:       LongTensor (K,), kept indices in descending score order
     """
-    bs = dets.size(0)
-    keep = []
-    min_keep_num = 1e10
-    for i in range(bs):
-        curr_sample_keep = pth_nms(dets[i, :], thresh)
-        keep.append(curr_sample_keep)
-        if len(curr_sample_keep) < min_keep_num:
-            min_keep_num = len(curr_sample_keep)
-    keep_out = np.zeros((bs, min_keep_num), dtype=np.int32)
-    for i in range(bs):
-        keep_out[i, :] = keep[i][:min_keep_num].cpu().numpy()
-    return keep_out
+    offset = dets[:, :4].max() + 1
+    shifted_dets = dets.clone()
+    shifted_dets[:, :4] += (groups.type_as(dets) * offset).unsqueeze(1).expand(dets.size(0), 4)
+    return nms_single(shifted_dets, thresh)
@@ -1,5 +1,10 @@
 import torch
-from ._ext import nms
+try:
+    from ._ext import nms
+except ImportError:
+    # extension not built (see lib/nms/build.py); nms_wrapper falls back to py_nms
+    nms = None
+EXT_AVAILABLE = nms is not None
 
 
 def pth_nms(dets, thresh):
@@ -19,30 +24,12 @@ def pth_nms(dets, thresh):
         return keep[:num_out[0]]
 
     else:
-        x1 = dets[:, 1]
-        y1 = dets[:, 0]
-        x2 = dets[:, 3]
-        y2 = dets[:, 2]
-        scores = dets[:, 4]
-
-        dets_temp = torch.FloatTensor(dets.size()).cuda()
-        dets_temp[:, 0] = dets[:, 1]
-        dets_temp[:, 1] = dets[:, 0]
-        dets_temp[:, 2] = dets[:, 3]
-        dets_temp[:, 3] = dets[:, 2]
-        dets_temp[:, 4] = dets[:, 4]
-
-        areas = (x2 - x1 + 1) * (y2 - y1 + 1)
-        order = scores.sort(0, descending=True)[1]
-        # order = torch.from_numpy(np.ascontiguousarray(scores.cpu().numpy().argsort()[::-1])).long().cuda()
-        dets = dets[order].contiguous()
+        # gpu_nms expects (x1, y1, x2, y2, score) boxes sorted by score; keep indexes the sorted boxes
+        order = dets[:, 4].sort(0, descending=True)[1]
+        dets_temp = dets[order].index_select(1, order.new([1, 0, 3, 2, 4])).contiguous()
 
         keep = torch.LongTensor(dets.size(0))
         num_out = torch.LongTensor(1)
-        # keep = torch.cuda.LongTensor(dets.size(0))
-        # num_out = torch.cuda.LongTensor(1)
         nms.gpu_nms(keep, num_out, dets_temp, thresh)
 
-        return order[keep[:num_out[0]].cuda()].contiguous()
-        # return order[keep[:num_out[0]]].contiguous()
-
+        return order[keep[:num_out[0]].cuda(dets.get_device())].contiguous()
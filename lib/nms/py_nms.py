@@ -0,0 +1,60 @@
+import numpy as np
+import torch
+
+
+def py_nms(dets, thresh, block_size=1024):
+    """Exact greedy NMS in tensor ops; no compiled extension needed.
+    Boxes are sorted by score and the suppression mask (IoU with a higher-scored box over thresh) is computed with
+    tensor ops, block_size rows at a time; a single host-side sweep over each block then applies the greedy
+    rule. So there is one device-to-host copy per block instead of one sync per kept box.
+    Same semantics (and keep indices) as the 'ext' backend on the same device, IoU with the +1 pixel convention:
+    on cpu a box is suppressed if its IoU with a kept box is >= thresh (cpu_nms in src/nms.c), on gpu if it is
+    > thresh (nms_kernel in src/cuda/nms_kernel.cu).
+    Args:
+        dets:       Tensor (N, 5), (y1, x1, y2, x2, score); no batch size dim
+        thresh:     nms threshold
+        block_size: rows of the suppression mask computed at a time (bounds the memory to block_size x N)
+    Returns:
+        keep:       LongTensor, indices of the kept boxes in descending score order (on the device of dets)
+    """
+    num = dets.size(0)
+    if num == 0:
+        return dets.new().long()
+    order = dets[:, 4].sort(0, descending=True)[1]
+    dets = dets[order]
+    y1 = dets[:, 0]
+    x1 = dets[:, 1]
+    y2 = dets[:, 2]
+    x2 = dets[:, 3]
+    areas = (x2 - x1 + 1) * (y2 - y1 + 1)
+
+    removed = np.zeros(num, dtype=bool)
+    keep = []
+    for start in range(0, num, block_size):
+        end = min(start + block_size, num)
+        # IoU of boxes [start, end) (rows) with boxes [start, num) (columns)
+        shape = (end - start, num - start)
+        yy1 = torch.max(y1[start:end].unsqueeze(1).expand(*shape), y1[start:].unsqueeze(0).expand(*shape))
+        xx1 = torch.max(x1[start:end].unsqueeze(1).expand(*shape), x1[start:].unsqueeze(0).expand(*shape))
+        yy2 = torch.min(y2[start:end].unsqueeze(1).expand(*shape), y2[start:].unsqueeze(0).expand(*shape))
+        xx2 = torch.min(x2[start:end].unsqueeze(1).expand(*shape), x2[start:].unsqueeze(0).expand(*shape))
+        w = (xx2 - xx1 + 1).clamp(min=0)
+        h = (yy2 - yy1 + 1).clamp(min=0)
+        inter = w * h
+        area_sum = areas[start:end].unsqueeze(1).expand(*shape) + areas[start:].unsqueeze(0).expand(*shape)
+        ovr = inter / (area_sum - inter)
+        suppress = (ovr > thresh) if ovr.is_cuda else (ovr >= thresh)
+        suppress = suppress.cpu().numpy().astype(bool)
+
+        # greedy sweep: a kept box removes the later boxes it overlaps
+        for r in range(end - start):
+            i = start + r
+            if removed[i]:
+                continue
+            keep.append(i)
+            removed[i + 1:] |= suppress[r, r + 1:]
+
+    keep = torch.LongTensor(keep)
+    if order.is_cuda:
+        keep = keep.cuda(order.get_device())
+    return order[keep]
@@ -3,6 +3,11 @@ from ._ext import crop_and_resize as _backend
 import torch
 
 
+def set_num_threads(num_threads):
+    """Threads of the cpu crop_and_resize kernels (forward and backward); <= 0 uses OMP_NUM_THREADS."""
+    _backend.crop_and_resize_set_num_threads(int(num_threads))
+
+
 # From Mask R-CNN paper: "We sample four regular locations, so
 # that we can evaluate either max or average pooling. In fact,
 # interpolating only a single value at each bin center (without
@@ -19,7 +24,8 @@ class CropAndResizeFunction(Function):
         self.extrapolation_value = extrapolation_value
 
     def forward(self, image, boxes, box_ind):
-        crops = torch.zeros_like(image)
+        # resized (and filled) by the backend
+        crops = image.new()
 
         if image.is_cuda:
             _backend.crop_and_resize_gpu_forward(
@@ -40,7 +46,8 @@ class CropAndResizeFunction(Function):
         boxes, box_ind = self.saved_tensors
 
         grad_outputs = grad_outputs.contiguous()
-        grad_image = torch.zeros_like(grad_outputs).resize_(*self.im_size)
+        # zeroed by the backend
+        grad_image = grad_outputs.new(*self.im_size)
 
         if grad_outputs.is_cuda:
             _backend.crop_and_resize_gpu_backward(
@@ -54,6 +61,55 @@ class CropAndResizeFunction(Function):
         return grad_image, None, None
 
 
+# CropAndResizeFunction over the four pyramid levels in one launch:
+# box n is cropped from the map of level box_level[n] (0 to 3 for P2 to P5) and written to row n,
+# so the crops come out in the order of the boxes; box_level -1 leaves the row at extrapolation_value.
+# Result: [num_boxes, channels, crop_height, crop_width]
+class MultiLevelCropAndResizeFunction(Function):
+
+    def __init__(self, crop_height, crop_width, extrapolation_value=0):
+        self.crop_height = crop_height
+        self.crop_width = crop_width
+        self.extrapolation_value = extrapolation_value
+
+    def forward(self, p2, p3, p4, p5, boxes, box_ind, box_level):
+        # resized (and filled) by the backend
+        crops = p2.new()
+
+        if p2.is_cuda:
+            _backend.crop_and_resize_multilevel_gpu_forward(
+                p2, p3, p4, p5, boxes, box_ind, box_level,
+                self.extrapolation_value, self.crop_height, self.crop_width, crops)
+        else:
+            _backend.crop_and_resize_multilevel_forward(
+                p2, p3, p4, p5, boxes, box_ind, box_level,
+                self.extrapolation_value, self.crop_height, self.crop_width, crops)
+
+        # save for backward
+        self.im_sizes = [p.size() for p in (p2, p3, p4, p5)]
+        self.save_for_backward(boxes, box_ind, box_level)
+
+        return crops
+
+    def backward(self, grad_outputs):
+        boxes, box_ind, box_level = self.saved_tensors
+
+        grad_outputs = grad_outputs.contiguous()
+        # zeroed by the backend
+        grad_images = [grad_outputs.new(*im_size) for im_size in self.im_sizes]
+
+        if grad_outputs.is_cuda:
+            _backend.crop_and_resize_multilevel_gpu_backward(
+                grad_outputs, boxes, box_ind, box_level, *grad_images
+            )
+        else:
+            _backend.crop_and_resize_multilevel_backward(
+                grad_outputs, boxes, box_ind, box_level, *grad_images
+            )
+
+        return tuple(grad_images) + (None, None, None)
+
+
 # class CropAndResize(nn.Module):
 #     """
 #     Crop and resize ported from tensorflow
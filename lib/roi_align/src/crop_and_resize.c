@@ -1,6 +1,173 @@
 #include <TH/TH.h>
 #include <stdio.h>
 #include <math.h>
+#ifdef _OPENMP
+#include <omp.h>
+#endif
+
+// threads of the cpu kernels; 0 uses the OpenMP default (OMP_NUM_THREADS)
+static int cpu_num_threads = 0;
+
+void crop_and_resize_set_num_threads(const int num_threads)
+{
+    cpu_num_threads = num_threads > 0 ? num_threads : 0;
+}
+
+static int get_num_threads()
+{
+#ifdef _OPENMP
+    return cpu_num_threads > 0 ? cpu_num_threads : omp_get_max_threads();
+#else
+    return 1;
+#endif
+}
+
+static void check_box_index(const int * box_index_data, const int num_boxes, const int batch_size)
+{
+    for (int b = 0; b < num_boxes; ++b) {
+        const int b_in = box_index_data[b];
+        if (b_in < 0 || b_in >= batch_size) {
+            printf("Error: batch_index %d out of range [0, %d)\n", b_in, batch_size);
+            exit(-1);
+        }
+    }
+}
+
+
+// bilinear crop of one (box, channel) plane: pimage [image_height, image_width] -> pcrop [crop_height, crop_width]
+static void crop_and_resize_plane(
+    const float * pimage,
+    const int image_height,
+    const int image_width,
+    const float * box,
+    float * pcrop,
+    const int crop_height,
+    const int crop_width,
+    const float extrapolation_value
+) {
+    const float y1 = box[0];
+    const float x1 = box[1];
+    const float y2 = box[2];
+    const float x2 = box[3];
+
+    const float height_scale =
+        (crop_height > 1)
+            ? (y2 - y1) * (image_height - 1) / (crop_height - 1)
+            : 0;
+    const float width_scale =
+        (crop_width > 1) ? (x2 - x1) * (image_width - 1) / (crop_width - 1)
+                         : 0;
+
+    for (int y = 0; y < crop_height; ++y)
+    {
+        const float in_y = (crop_height > 1)
+                               ? y1 * (image_height - 1) + y * height_scale
+                               : 0.5 * (y1 + y2) * (image_height - 1);
+
+        if (in_y < 0 || in_y > image_height - 1)
+        {
+            for (int x = 0; x < crop_width; ++x)
+            {
+                // crops(b, y, x, d) = extrapolation_value;
+                pcrop[y * crop_width + x] = extrapolation_value;
+            }
+            continue;
+        }
+
+        const int top_y_index = floorf(in_y);
+        const int bottom_y_index = ceilf(in_y);
+        const float y_lerp = in_y - top_y_index;
+
+        for (int x = 0; x < crop_width; ++x)
+        {
+            const float in_x = (crop_width > 1)
+                                   ? x1 * (image_width - 1) + x * width_scale
+                                   : 0.5 * (x1 + x2) * (image_width - 1);
+            if (in_x < 0 || in_x > image_width - 1)
+            {
+                pcrop[y * crop_width + x] = extrapolation_value;
+                continue;
+            }
+
+            const int left_x_index = floorf(in_x);
+            const int right_x_index = ceilf(in_x);
+            const float x_lerp = in_x - left_x_index;
+
+            const float top_left = pimage[top_y_index * image_width + left_x_index];
+            const float top_right = pimage[top_y_index * image_width + right_x_index];
+            const float bottom_left = pimage[bottom_y_index * image_width + left_x_index];
+            const float bottom_right = pimage[bottom_y_index * image_width + right_x_index];
+
+            const float top = top_left + (top_right - top_left) * x_lerp;
+            const float bottom =
+                bottom_left + (bottom_right - bottom_left) * x_lerp;
+
+            pcrop[y * crop_width + x] = top + (bottom - top) * y_lerp;
+        }   // end for x
+    }   // end for y
+}
+
+
+// gradient of crop_and_resize_plane: adds pgrad [crop_height, crop_width] into pimage [image_height, image_width]
+static void crop_and_resize_plane_backward(
+    const float * pgrad,
+    const int crop_height,
+    const int crop_width,
+    const float * box,
+    float * pimage,
+    const int image_height,
+    const int image_width
+) {
+    const float y1 = box[0];
+    const float x1 = box[1];
+    const float y2 = box[2];
+    const float x2 = box[3];
+
+    const float height_scale =
+        (crop_height > 1) ? (y2 - y1) * (image_height - 1) / (crop_height - 1)
+                          : 0;
+    const float width_scale =
+        (crop_width > 1) ? (x2 - x1) * (image_width - 1) / (crop_width - 1)
+                         : 0;
+
+    for (int y = 0; y < crop_height; ++y)
+    {
+        const float in_y = (crop_height > 1)
+                               ? y1 * (image_height - 1) + y * height_scale
+                               : 0.5 * (y1 + y2) * (image_height - 1);
+        if (in_y < 0 || in_y > image_height - 1)
+        {
+            continue;
+        }
+        const int top_y_index = floorf(in_y);
+        const int bottom_y_index = ceilf(in_y);
+        const float y_lerp = in_y - top_y_index;
+
+        for (int x = 0; x < crop_width; ++x)
+        {
+            const float in_x = (crop_width > 1)
+                                   ? x1 * (image_width - 1) + x * width_scale
+                                   : 0.5 * (x1 + x2) * (image_width - 1);
+            if (in_x < 0 || in_x > image_width - 1)
+            {
+                continue;
+            }
+            const int left_x_index = floorf(in_x);
+            const int right_x_index = ceilf(in_x);
+            const float x_lerp = in_x - left_x_index;
+
+            const float grad_val = pgrad[y * crop_width + x];
+
+            const float dtop = (1 - y_lerp) * grad_val;
+            pimage[top_y_index * image_width + left_x_index] += (1 - x_lerp) * dtop;
+            pimage[top_y_index * image_width + right_x_index] += x_lerp * dtop;
+
+            const float dbottom = y_lerp * grad_val;
+            pimage[bottom_y_index * image_width + left_x_index] += (1 - x_lerp) * dbottom;
+            pimage[bottom_y_index * image_width + right_x_index] += x_lerp * dbottom;
+        }   // end x
+    }   // end y
+}
 
 
 void CropAndResizePerBox(
@@ -26,88 +193,27 @@ void CropAndResizePerBox(
     const int channel_elements = crop_height * crop_width;
     const int crop_elements = depth * channel_elements;
 
-    int b;
-    #pragma omp parallel for
-    for (b = start_box; b < limit_box; ++b) {
-        const float * box = boxes_data + b * 4;
-        const float y1 = box[0];
-        const float x1 = box[1];
-        const float y2 = box[2];
-        const float x2 = box[3];
+    check_box_index(box_index_data + start_box, limit_box - start_box, batch_size);
 
+    // one (box, channel) plane of the crops per iteration
+    int bd;
+    #pragma omp parallel for num_threads(get_num_threads())
+    for (bd = start_box * depth; bd < limit_box * depth; ++bd) {
+        const int b = bd / depth;
+        const int d = bd % depth;
         const int b_in = box_index_data[b];
-        if (b_in < 0 || b_in >= batch_size) {
-            printf("Error: batch_index %d out of range [0, %d)\n", b_in, batch_size);
-            exit(-1);
-        }
 
-        const float height_scale =
-            (crop_height > 1)
-                ? (y2 - y1) * (image_height - 1) / (crop_height - 1)
-                : 0;
-        const float width_scale =
-            (crop_width > 1) ? (x2 - x1) * (image_width - 1) / (crop_width - 1)
-                             : 0;
-
-        for (int y = 0; y < crop_height; ++y)
-        {
-            const float in_y = (crop_height > 1)
-                                   ? y1 * (image_height - 1) + y * height_scale
-                                   : 0.5 * (y1 + y2) * (image_height - 1);
-
-            if (in_y < 0 || in_y > image_height - 1)
-            {
-                for (int x = 0; x < crop_width; ++x)
-                {
-                    for (int d = 0; d < depth; ++d)
-                    {
-                        // crops(b, y, x, d) = extrapolation_value;
-                        corps_data[crop_elements * b + channel_elements * d + y * crop_width + x] = extrapolation_value;
-                    }
-                }
-                continue;
-            }
-            
-            const int top_y_index = floorf(in_y);
-            const int bottom_y_index = ceilf(in_y);
-            const float y_lerp = in_y - top_y_index;
-
-            for (int x = 0; x < crop_width; ++x)
-            {
-                const float in_x = (crop_width > 1)
-                                       ? x1 * (image_width - 1) + x * width_scale
-                                       : 0.5 * (x1 + x2) * (image_width - 1);
-                if (in_x < 0 || in_x > image_width - 1)
-                {
-                    for (int d = 0; d < depth; ++d)
-                    {
-                        corps_data[crop_elements * b + channel_elements * d + y * crop_width + x] = extrapolation_value;
-                    }
-                    continue;
-                }
-            
-                const int left_x_index = floorf(in_x);
-                const int right_x_index = ceilf(in_x);
-                const float x_lerp = in_x - left_x_index;
-
-                for (int d = 0; d < depth; ++d)
-                {   
-                    const float *pimage = image_data + b_in * image_elements + d * image_channel_elements;
-
-                    const float top_left = pimage[top_y_index * image_width + left_x_index];
-                    const float top_right = pimage[top_y_index * image_width + right_x_index];
-                    const float bottom_left = pimage[bottom_y_index * image_width + left_x_index];
-                    const float bottom_right = pimage[bottom_y_index * image_width + right_x_index];
-                    
-                    const float top = top_left + (top_right - top_left) * x_lerp;
-                    const float bottom =
-                        bottom_left + (bottom_right - bottom_left) * x_lerp;
-                        
-                    corps_data[crop_elements * b + channel_elements * d + y * crop_width + x] = top + (bottom - top) * y_lerp;
-                }
-            }   // end for x
-        }   // end for y
-    }   // end for b
+        crop_and_resize_plane(
+            image_data + b_in * image_elements + d * image_channel_elements,
+            image_height,
+            image_width,
+            boxes_data + b * 4,
+            corps_data + crop_elements * b + channel_elements * d,
+            crop_height,
+            crop_width,
+            extrapolation_value
+        );
+    }   // end for (b, d)
 
 }
 
@@ -128,9 +234,8 @@ void crop_and_resize_forward(
 
     const int num_boxes = boxes->size[0];
 
-    // init output space
+    // init output space; every element is written below, no need to zero it
     THFloatTensor_resize4d(crops, num_boxes, depth, crop_height, crop_width);
-    THFloatTensor_zero(crops);
 
     // crop_and_resize for each box
     CropAndResizePerBox(
@@ -187,66 +292,183 @@ void crop_and_resize_backward(
     const int * box_index_data = THIntTensor_data(box_index);
     float * grads_image_data = THFloatTensor_data(grads_image);
 
+    check_box_index(box_index_data, num_boxes, batch_size);
+
+    // Race-free: each iteration owns one (image, channel) plane of grads_image and adds up the boxes cropped
+    // from that image in box order, so the result does not depend on the thread number either.
+    int bd;
+    #pragma omp parallel for num_threads(get_num_threads())
+    for (bd = 0; bd < batch_size * depth; ++bd) {
+        const int b_in = bd / depth;
+        const int d = bd % depth;
+        float *pimage = grads_image_data + b_in * image_elements + d * image_channel_elements;
+
+        for (int b = 0; b < num_boxes; ++b) {
+            if (box_index_data[b] != b_in)
+                continue;
+            crop_and_resize_plane_backward(
+                grads_data + crop_elements * b + channel_elements * d,
+                crop_height,
+                crop_width,
+                boxes_data + b * 4,
+                pimage,
+                image_height,
+                image_width
+            );
+        }   // end b
+    }   // end (b_in, d)
+}
+
+
+#define NUM_LEVELS 4
+
+static void check_box_level(const int * box_level_data, const int num_boxes)
+{
     for (int b = 0; b < num_boxes; ++b) {
-        const float * box = boxes_data + b * 4;
-        const float y1 = box[0];
-        const float x1 = box[1];
-        const float y2 = box[2];
-        const float x2 = box[3];
+        const int level = box_level_data[b];
+        if (level < -1 || level >= NUM_LEVELS) {
+            printf("Error: box_level %d out of range [-1, %d)\n", level, NUM_LEVELS);
+            exit(-1);
+        }
+    }
+}
 
-        const int b_in = box_index_data[b];
-        if (b_in < 0 || b_in >= batch_size) {
-            printf("Error: batch_index %d out of range [0, %d)\n", b_in, batch_size);
+
+void crop_and_resize_multilevel_forward(
+    THFloatTensor * image_p2,
+    THFloatTensor * image_p3,
+    THFloatTensor * image_p4,
+    THFloatTensor * image_p5,
+    THFloatTensor * boxes,      // [y1, x1, y2, x2]
+    THIntTensor * box_index,    // range in [0, batch_size)
+    THIntTensor * box_level,    // range in [0, 4), index of the image (P2 to P5) to crop from; -1: not cropped
+    const float extrapolation_value,
+    const int crop_height,
+    const int crop_width,
+    THFloatTensor * crops
+) {
+    THFloatTensor * images[NUM_LEVELS] = {image_p2, image_p3, image_p4, image_p5};
+    const float * image_data[NUM_LEVELS];
+    int image_height[NUM_LEVELS], image_width[NUM_LEVELS];
+
+    const int batch_size = image_p2->size[0];
+    const int depth = image_p2->size[1];
+    for (int l = 0; l < NUM_LEVELS; ++l) {
+        if (images[l]->size[0] != batch_size || images[l]->size[1] != depth) {
+            printf("Error: image of level %d has size [%ld, %ld, ...], expected [%d, %d, ...]\n",
+                   l, (long)images[l]->size[0], (long)images[l]->size[1], batch_size, depth);
             exit(-1);
         }
+        image_data[l] = THFloatTensor_data(images[l]);
+        image_height[l] = images[l]->size[2];
+        image_width[l] = images[l]->size[3];
+    }
+
+    const int num_boxes = boxes->size[0];
+    const int channel_elements = crop_height * crop_width;
+    const int crop_elements = depth * channel_elements;
+
+    // init output space; every element is written below, no need to zero it
+    THFloatTensor_resize4d(crops, num_boxes, depth, crop_height, crop_width);
+
+    const float * boxes_data = THFloatTensor_data(boxes);
+    const int * box_index_data = THIntTensor_data(box_index);
+    const int * box_level_data = THIntTensor_data(box_level);
+    float * crops_data = THFloatTensor_data(crops);
+
+    check_box_index(box_index_data, num_boxes, batch_size);
+    check_box_level(box_level_data, num_boxes);
+
+    // one (box, channel) plane of the crops per iteration, whatever level the box is on;
+    // box b is written to row b, so the crops come out in the order of the boxes
+    int bd;
+    #pragma omp parallel for num_threads(get_num_threads())
+    for (bd = 0; bd < num_boxes * depth; ++bd) {
+        const int b = bd / depth;
+        const int d = bd % depth;
+        const int l = box_level_data[b];
+        float * pcrop = crops_data + crop_elements * b + channel_elements * d;
+
+        if (l < 0) {
+            for (int i = 0; i < channel_elements; ++i)
+                pcrop[i] = extrapolation_value;
+            continue;
+        }
+        const int image_channel_elements = image_height[l] * image_width[l];
+        crop_and_resize_plane(
+            image_data[l] + (box_index_data[b] * depth + d) * image_channel_elements,
+            image_height[l],
+            image_width[l],
+            boxes_data + b * 4,
+            pcrop,
+            crop_height,
+            crop_width,
+            extrapolation_value
+        );
+    }   // end for (b, d)
+}
 
-        const float height_scale =
-            (crop_height > 1) ? (y2 - y1) * (image_height - 1) / (crop_height - 1)
-                              : 0;
-        const float width_scale =
-            (crop_width > 1) ? (x2 - x1) * (image_width - 1) / (crop_width - 1)
-                             : 0;
 
-        for (int y = 0; y < crop_height; ++y)
-        {
-            const float in_y = (crop_height > 1)
-                                   ? y1 * (image_height - 1) + y * height_scale
-                                   : 0.5 * (y1 + y2) * (image_height - 1);
-            if (in_y < 0 || in_y > image_height - 1)
-            {
-                continue;
-            }
-            const int top_y_index = floorf(in_y);
-            const int bottom_y_index = ceilf(in_y);
-            const float y_lerp = in_y - top_y_index;
+void crop_and_resize_multilevel_backward(
+    THFloatTensor * grads,
+    THFloatTensor * boxes,      // [y1, x1, y2, x2]
+    THIntTensor * box_index,    // range in [0, batch_size)
+    THIntTensor * box_level,    // range in [0, 4); -1: not cropped
+    THFloatTensor * grads_p2,   // resize to [bsize, c, hc, wc] of each level
+    THFloatTensor * grads_p3,
+    THFloatTensor * grads_p4,
+    THFloatTensor * grads_p5
+) {
+    THFloatTensor * grads_images[NUM_LEVELS] = {grads_p2, grads_p3, grads_p4, grads_p5};
+    float * grads_image_data[NUM_LEVELS];
+    int image_height[NUM_LEVELS], image_width[NUM_LEVELS];
+
+    const int batch_size = grads_p2->size[0];
+    const int depth = grads_p2->size[1];
+    for (int l = 0; l < NUM_LEVELS; ++l) {
+        // init output space
+        THFloatTensor_zero(grads_images[l]);
+        grads_image_data[l] = THFloatTensor_data(grads_images[l]);
+        image_height[l] = grads_images[l]->size[2];
+        image_width[l] = grads_images[l]->size[3];
+    }
 
-            for (int x = 0; x < crop_width; ++x)
-            {
-                const float in_x = (crop_width > 1)
-                                       ? x1 * (image_width - 1) + x * width_scale
-                                       : 0.5 * (x1 + x2) * (image_width - 1);
-                if (in_x < 0 || in_x > image_width - 1)
-                {
-                    continue;
-                }
-                const int left_x_index = floorf(in_x);
-                const int right_x_index = ceilf(in_x);
-                const float x_lerp = in_x - left_x_index;
-
-                for (int d = 0; d < depth; ++d)
-                {   
-                    float *pimage = grads_image_data + b_in * image_elements + d * image_channel_elements;
-                    const float grad_val = grads_data[crop_elements * b + channel_elements * d + y * crop_width + x];
-
-                    const float dtop = (1 - y_lerp) * grad_val;
-                    pimage[top_y_index * image_width + left_x_index] += (1 - x_lerp) * dtop;
-                    pimage[top_y_index * image_width + right_x_index] += x_lerp * dtop;
-
-                    const float dbottom = y_lerp * grad_val;
-                    pimage[bottom_y_index * image_width + left_x_index] += (1 - x_lerp) * dbottom;
-                    pimage[bottom_y_index * image_width + right_x_index] += x_lerp * dbottom;
-                }   // end d
-            }   // end x
-        }   // end y
-    }   // end b
-}
\ No newline at end of file
+    const int num_boxes = grads->size[0];
+    const int crop_height = grads->size[2];
+    const int crop_width = grads->size[3];
+    const int channel_elements = crop_height * crop_width;
+    const int crop_elements = depth * channel_elements;
+
+    const float * grads_data = THFloatTensor_data(grads);
+    const float * boxes_data = THFloatTensor_data(boxes);
+    const int * box_index_data = THIntTensor_data(box_index);
+    const int * box_level_data = THIntTensor_data(box_level);
+
+    check_box_index(box_index_data, num_boxes, batch_size);
+    check_box_level(box_level_data, num_boxes);
+
+    // Race-free, as in crop_and_resize_backward: each iteration owns one (level, image, channel) plane
+    // and adds up the boxes cropped from it in box order.
+    int lbd;
+    #pragma omp parallel for num_threads(get_num_threads())
+    for (lbd = 0; lbd < NUM_LEVELS * batch_size * depth; ++lbd) {
+        const int l = lbd / (batch_size * depth);
+        const int b_in = lbd / depth % batch_size;
+        const int d = lbd % depth;
+        float * pimage = grads_image_data[l] + (b_in * depth + d) * image_height[l] * image_width[l];
+
+        for (int b = 0; b < num_boxes; ++b) {
+            if (box_level_data[b] != l || box_index_data[b] != b_in)
+                continue;
+            crop_and_resize_plane_backward(
+                grads_data + crop_elements * b + channel_elements * d,
+                crop_height,
+                crop_width,
+                boxes_data + b * 4,
+                pimage,
+                image_height[l],
+                image_width[l]
+            );
+        }   // end b
+    }   // end (l, b_in, d)
+}
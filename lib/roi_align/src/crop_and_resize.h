@@ -13,4 +13,34 @@ void crop_and_resize_backward(
     THFloatTensor * boxes,      // [y1, x1, y2, x2]
     THIntTensor * box_index,    // range in [0, batch_size)
     THFloatTensor * grads_image // resize to [bsize, c, hc, wc]
-);
\ No newline at end of file
+);
+
+// number of threads of the two cpu ops above; <= 0 uses the OpenMP default (OMP_NUM_THREADS)
+void crop_and_resize_set_num_threads(const int num_threads);
+
+// crop_and_resize over the four pyramid levels (P2 to P5) in one call: box b is cropped from the image of
+// level box_level[b] and written to crops[b]; box_level -1 leaves the crop at extrapolation_value
+void crop_and_resize_multilevel_forward(
+    THFloatTensor * image_p2,
+    THFloatTensor * image_p3,
+    THFloatTensor * image_p4,
+    THFloatTensor * image_p5,
+    THFloatTensor * boxes,      // [y1, x1, y2, x2]
+    THIntTensor * box_index,    // range in [0, batch_size)
+    THIntTensor * box_level,    // range in [0, 4); -1: not cropped
+    const float extrapolation_value,
+    const int crop_height,
+    const int crop_width,
+    THFloatTensor * crops
+);
+
+void crop_and_resize_multilevel_backward(
+    THFloatTensor * grads,
+    THFloatTensor * boxes,      // [y1, x1, y2, x2]
+    THIntTensor * box_index,    // range in [0, batch_size)
+    THIntTensor * box_level,    // range in [0, 4); -1: not cropped
+    THFloatTensor * grads_p2,   // resize to [bsize, c, hc, wc] of each level
+    THFloatTensor * grads_p3,
+    THFloatTensor * grads_p4,
+    THFloatTensor * grads_p5
+);
@@ -66,4 +66,85 @@ void crop_and_resize_gpu_backward(
         THCudaTensor_data(state, grads_image),
         stream
     );
-}
\ No newline at end of file
+}
+
+void crop_and_resize_multilevel_gpu_forward(
+    THCudaTensor * image_p2,
+    THCudaTensor * image_p3,
+    THCudaTensor * image_p4,
+    THCudaTensor * image_p5,
+    THCudaTensor * boxes,           // [y1, x1, y2, x2]
+    THCudaIntTensor * box_index,    // range in [0, batch_size)
+    THCudaIntTensor * box_level,    // range in [0, 4); -1: not cropped
+    const float extrapolation_value,
+    const int crop_height,
+    const int crop_width,
+    THCudaTensor * crops
+) {
+    THCudaTensor * images[4] = {image_p2, image_p3, image_p4, image_p5};
+    const float * image_ptrs[4];
+    int image_heights[4], image_widths[4];
+    for (int l = 0; l < 4; ++l) {
+        image_ptrs[l] = THCudaTensor_data(state, images[l]);
+        image_heights[l] = THCudaTensor_size(state, images[l], 2);
+        image_widths[l] = THCudaTensor_size(state, images[l], 3);
+    }
+    const int batch_size = THCudaTensor_size(state, image_p2, 0);
+    const int depth = THCudaTensor_size(state, image_p2, 1);
+
+    const int num_boxes = THCudaTensor_size(state, boxes, 0);
+
+    // init output space; every element is written by the kernel
+    THCudaTensor_resize4d(state, crops, num_boxes, depth, crop_height, crop_width);
+
+    cudaStream_t stream = THCState_getCurrentStream(state);
+    CropAndResizeMultiLevelLaucher(
+        image_ptrs, image_heights, image_widths, 4,
+        THCudaTensor_data(state, boxes),
+        THCudaIntTensor_data(state, box_index),
+        THCudaIntTensor_data(state, box_level),
+        num_boxes, batch_size, crop_height, crop_width, depth, extrapolation_value,
+        THCudaTensor_data(state, crops),
+        stream
+    );
+}
+
+
+void crop_and_resize_multilevel_gpu_backward(
+    THCudaTensor * grads,
+    THCudaTensor * boxes,           // [y1, x1, y2, x2]
+    THCudaIntTensor * box_index,    // range in [0, batch_size)
+    THCudaIntTensor * box_level,    // range in [0, 4); -1: not cropped
+    THCudaTensor * grads_p2,        // resize to [bsize, c, hc, wc] of each level
+    THCudaTensor * grads_p3,
+    THCudaTensor * grads_p4,
+    THCudaTensor * grads_p5
+) {
+    THCudaTensor * grads_images[4] = {grads_p2, grads_p3, grads_p4, grads_p5};
+    float * grads_image_ptrs[4];
+    int image_heights[4], image_widths[4];
+    for (int l = 0; l < 4; ++l) {
+        // init output space
+        THCudaTensor_zero(state, grads_images[l]);
+        grads_image_ptrs[l] = THCudaTensor_data(state, grads_images[l]);
+        image_heights[l] = THCudaTensor_size(state, grads_images[l], 2);
+        image_widths[l] = THCudaTensor_size(state, grads_images[l], 3);
+    }
+    const int batch_size = THCudaTensor_size(state, grads_p2, 0);
+    const int depth = THCudaTensor_size(state, grads_p2, 1);
+
+    const int num_boxes = THCudaTensor_size(state, grads, 0);
+    const int crop_height = THCudaTensor_size(state, grads, 2);
+    const int crop_width = THCudaTensor_size(state, grads, 3);
+
+    cudaStream_t stream = THCState_getCurrentStream(state);
+    CropAndResizeMultiLevelBackpropImageLaucher(
+        THCudaTensor_data(state, grads),
+        THCudaTensor_data(state, boxes),
+        THCudaIntTensor_data(state, box_index),
+        THCudaIntTensor_data(state, box_level),
+        num_boxes, batch_size, crop_height, crop_width, depth,
+        grads_image_ptrs, image_heights, image_widths, 4,
+        stream
+    );
+}
@@ -13,4 +13,29 @@ void crop_and_resize_gpu_backward(
     THCudaTensor * boxes,      // [y1, x1, y2, x2]
     THCudaIntTensor * box_index,    // range in [0, batch_size)
     THCudaTensor * grads_image // resize to [bsize, c, hc, wc]
-);
\ No newline at end of file
+);
+
+void crop_and_resize_multilevel_gpu_forward(
+    THCudaTensor * image_p2,
+    THCudaTensor * image_p3,
+    THCudaTensor * image_p4,
+    THCudaTensor * image_p5,
+    THCudaTensor * boxes,           // [y1, x1, y2, x2]
+    THCudaIntTensor * box_index,    // range in [0, batch_size)
+    THCudaIntTensor * box_level,    // range in [0, 4); -1: not cropped
+    const float extrapolation_value,
+    const int crop_height,
+    const int crop_width,
+    THCudaTensor * crops
+);
+
+void crop_and_resize_multilevel_gpu_backward(
+    THCudaTensor * grads,
+    THCudaTensor * boxes,           // [y1, x1, y2, x2]
+    THCudaIntTensor * box_index,    // range in [0, batch_size)
+    THCudaIntTensor * box_level,    // range in [0, 4); -1: not cropped
+    THCudaTensor * grads_p2,        // resize to [bsize, c, hc, wc] of each level
+    THCudaTensor * grads_p3,
+    THCudaTensor * grads_p4,
+    THCudaTensor * grads_p5
+);
@@ -218,4 +218,256 @@ void CropAndResizeBackpropImageLaucher(
             exit(-1);
         }
     }
-}
\ No newline at end of file
+}
+
+#define MAX_LEVELS 4
+
+// passed by value, so the level pointers and sizes reach the kernel without a host-to-device copy
+struct LevelImages {
+    const float *ptr[MAX_LEVELS];
+    float *grad_ptr[MAX_LEVELS];
+    int height[MAX_LEVELS];
+    int width[MAX_LEVELS];
+};
+
+__global__
+void CropAndResizeMultiLevelKernel(
+    const int nthreads, const LevelImages images, const int num_levels, const float *boxes_ptr,
+    const int *box_ind_ptr, const int *box_level_ptr, int num_boxes, int batch,
+    int crop_height, int crop_width, int depth,
+    float extrapolation_value, float *crops_ptr)
+{
+    CUDA_1D_KERNEL_LOOP(out_idx, nthreads)
+    {
+        // NCHW: out_idx = w + crop_width * (h + crop_height * (d + depth * b)); box b goes to row b
+        int idx = out_idx;
+        const int x = idx % crop_width;
+        idx /= crop_width;
+        const int y = idx % crop_height;
+        idx /= crop_height;
+        const int d = idx % depth;
+        const int b = idx / depth;
+
+        const int b_in = box_ind_ptr[b];
+        const int level = box_level_ptr[b];
+        if (b_in < 0 || b_in >= batch || level < 0 || level >= num_levels)
+        {
+            crops_ptr[out_idx] = extrapolation_value;
+            continue;
+        }
+        const int image_height = images.height[level];
+        const int image_width = images.width[level];
+
+        const float y1 = boxes_ptr[b * 4];
+        const float x1 = boxes_ptr[b * 4 + 1];
+        const float y2 = boxes_ptr[b * 4 + 2];
+        const float x2 = boxes_ptr[b * 4 + 3];
+
+        const float height_scale =
+            (crop_height > 1) ? (y2 - y1) * (image_height - 1) / (crop_height - 1)
+                                : 0;
+        const float width_scale =
+            (crop_width > 1) ? (x2 - x1) * (image_width - 1) / (crop_width - 1) : 0;
+
+        const float in_y = (crop_height > 1)
+                                ? y1 * (image_height - 1) + y * height_scale
+                                : 0.5 * (y1 + y2) * (image_height - 1);
+        if (in_y < 0 || in_y > image_height - 1)
+        {
+            crops_ptr[out_idx] = extrapolation_value;
+            continue;
+        }
+
+        const float in_x = (crop_width > 1)
+                                ? x1 * (image_width - 1) + x * width_scale
+                                : 0.5 * (x1 + x2) * (image_width - 1);
+        if (in_x < 0 || in_x > image_width - 1)
+        {
+            crops_ptr[out_idx] = extrapolation_value;
+            continue;
+        }
+
+        const int top_y_index = floorf(in_y);
+        const int bottom_y_index = ceilf(in_y);
+        const float y_lerp = in_y - top_y_index;
+
+        const int left_x_index = floorf(in_x);
+        const int right_x_index = ceilf(in_x);
+        const float x_lerp = in_x - left_x_index;
+
+        const float *pimage = images.ptr[level] + (b_in * depth + d) * image_height * image_width;
+        const float top_left = pimage[top_y_index * image_width + left_x_index];
+        const float top_right = pimage[top_y_index * image_width + right_x_index];
+        const float bottom_left = pimage[bottom_y_index * image_width + left_x_index];
+        const float bottom_right = pimage[bottom_y_index * image_width + right_x_index];
+
+        const float top = top_left + (top_right - top_left) * x_lerp;
+        const float bottom = bottom_left + (bottom_right - bottom_left) * x_lerp;
+        crops_ptr[out_idx] = top + (bottom - top) * y_lerp;
+    }
+}
+
+__global__
+void CropAndResizeMultiLevelBackpropImageKernel(
+    const int nthreads, const float *grads_ptr, const float *boxes_ptr,
+    const int *box_ind_ptr, const int *box_level_ptr, int num_boxes, int batch,
+    int crop_height, int crop_width, int depth,
+    const LevelImages images, const int num_levels)
+{
+    CUDA_1D_KERNEL_LOOP(out_idx, nthreads)
+    {
+        // NCHW: out_idx = w + crop_width * (h + crop_height * (d + depth * b))
+        int idx = out_idx;
+        const int x = idx % crop_width;
+        idx /= crop_width;
+        const int y = idx % crop_height;
+        idx /= crop_height;
+        const int d = idx % depth;
+        const int b = idx / depth;
+
+        const int b_in = box_ind_ptr[b];
+        const int level = box_level_ptr[b];
+        if (b_in < 0 || b_in >= batch || level < 0 || level >= num_levels)
+        {
+            continue;
+        }
+        const int image_height = images.height[level];
+        const int image_width = images.width[level];
+
+        const float y1 = boxes_ptr[b * 4];
+        const float x1 = boxes_ptr[b * 4 + 1];
+        const float y2 = boxes_ptr[b * 4 + 2];
+        const float x2 = boxes_ptr[b * 4 + 3];
+
+        const float height_scale =
+            (crop_height > 1) ? (y2 - y1) * (image_height - 1) / (crop_height - 1)
+                                : 0;
+        const float width_scale =
+            (crop_width > 1) ? (x2 - x1) * (image_width - 1) / (crop_width - 1) : 0;
+
+        const float in_y = (crop_height > 1)
+                                ? y1 * (image_height - 1) + y * height_scale
+                                : 0.5 * (y1 + y2) * (image_height - 1);
+        if (in_y < 0 || in_y > image_height - 1)
+        {
+            continue;
+        }
+
+        const float in_x = (crop_width > 1)
+                                ? x1 * (image_width - 1) + x * width_scale
+                                : 0.5 * (x1 + x2) * (image_width - 1);
+        if (in_x < 0 || in_x > image_width - 1)
+        {
+            continue;
+        }
+
+        const int top_y_index = floorf(in_y);
+        const int bottom_y_index = ceilf(in_y);
+        const float y_lerp = in_y - top_y_index;
+
+        const int left_x_index = floorf(in_x);
+        const int right_x_index = ceilf(in_x);
+        const float x_lerp = in_x - left_x_index;
+
+        float *pimage = images.grad_ptr[level] + (b_in * depth + d) * image_height * image_width;
+        const float dtop = (1 - y_lerp) * grads_ptr[out_idx];
+        atomicAdd(
+            pimage + top_y_index * image_width + left_x_index,
+            (1 - x_lerp) * dtop
+        );
+        atomicAdd(
+            pimage + top_y_index * image_width + right_x_index,
+            x_lerp * dtop
+        );
+
+        const float dbottom = y_lerp * grads_ptr[out_idx];
+        atomicAdd(
+            pimage + bottom_y_index * image_width + left_x_index,
+            (1 - x_lerp) * dbottom
+        );
+        atomicAdd(
+            pimage + bottom_y_index * image_width + right_x_index,
+            x_lerp * dbottom
+        );
+    }
+}
+
+
+static LevelImages MakeLevelImages(
+    const float *const *image_ptrs, float *const *grads_image_ptrs,
+    const int *image_heights, const int *image_widths, int num_levels)
+{
+    if (num_levels > MAX_LEVELS)
+    {
+        fprintf(stderr, "crop_and_resize: %d levels given, at most %d supported\n", num_levels, MAX_LEVELS);
+        exit(-1);
+    }
+    LevelImages images;
+    for (int l = 0; l < num_levels; ++l)
+    {
+        images.ptr[l] = image_ptrs ? image_ptrs[l] : NULL;
+        images.grad_ptr[l] = grads_image_ptrs ? grads_image_ptrs[l] : NULL;
+        images.height[l] = image_heights[l];
+        images.width[l] = image_widths[l];
+    }
+    return images;
+}
+
+
+void CropAndResizeMultiLevelLaucher(
+    const float *const *image_ptrs, const int *image_heights, const int *image_widths, int num_levels,
+    const float *boxes_ptr, const int *box_ind_ptr, const int *box_level_ptr,
+    int num_boxes, int batch, int crop_height, int crop_width, int depth,
+    float extrapolation_value, float *crops_ptr, cudaStream_t stream)
+{
+    const int total_count = num_boxes * crop_height * crop_width * depth;
+    const int thread_per_block = 1024;
+    const int block_count = (total_count + thread_per_block - 1) / thread_per_block;
+    cudaError_t err;
+
+    if (total_count > 0)
+    {
+        const LevelImages images = MakeLevelImages(image_ptrs, NULL, image_heights, image_widths, num_levels);
+        CropAndResizeMultiLevelKernel<<<block_count, thread_per_block, 0, stream>>>(
+            total_count, images, num_levels, boxes_ptr,
+            box_ind_ptr, box_level_ptr, num_boxes, batch,
+            crop_height, crop_width, depth, extrapolation_value, crops_ptr);
+
+        err = cudaGetLastError();
+        if (cudaSuccess != err)
+        {
+            fprintf(stderr, "cudaCheckError() failed : %s\n", cudaGetErrorString(err));
+            exit(-1);
+        }
+    }
+}
+
+
+void CropAndResizeMultiLevelBackpropImageLaucher(
+    const float *grads_ptr, const float *boxes_ptr,
+    const int *box_ind_ptr, const int *box_level_ptr,
+    int num_boxes, int batch, int crop_height, int crop_width, int depth,
+    float *const *grads_image_ptrs, const int *image_heights, const int *image_widths, int num_levels,
+    cudaStream_t stream)
+{
+    const int total_count = num_boxes * crop_height * crop_width * depth;
+    const int thread_per_block = 1024;
+    const int block_count = (total_count + thread_per_block - 1) / thread_per_block;
+    cudaError_t err;
+
+    if (total_count > 0)
+    {
+        const LevelImages images = MakeLevelImages(NULL, grads_image_ptrs, image_heights, image_widths, num_levels);
+        CropAndResizeMultiLevelBackpropImageKernel<<<block_count, thread_per_block, 0, stream>>>(
+            total_count, grads_ptr, boxes_ptr,
+            box_ind_ptr, box_level_ptr, num_boxes, batch,
+            crop_height, crop_width, depth, images, num_levels);
+
+        err = cudaGetLastError();
+        if (cudaSuccess != err)
+        {
+            fprintf(stderr, "cudaCheckError() failed : %s\n", cudaGetErrorString(err));
+            exit(-1);
+        }
+    }
+}
@@ -17,6 +17,21 @@ void CropAndResizeBackpropImageLaucher(
     int image_width, int crop_height, int crop_width, int depth,
     float *grads_image_ptr, cudaStream_t stream);
 
+// the image (or grads_image) of box b is image_ptrs[box_level_ptr[b]], of size [batch, depth, height, width]
+// from image_heights / image_widths (host arrays of num_levels); box_level -1 leaves the crop at extrapolation_value
+void CropAndResizeMultiLevelLaucher(
+    const float *const *image_ptrs, const int *image_heights, const int *image_widths, int num_levels,
+    const float *boxes_ptr, const int *box_ind_ptr, const int *box_level_ptr,
+    int num_boxes, int batch, int crop_height, int crop_width, int depth,
+    float extrapolation_value, float *crops_ptr, cudaStream_t stream);
+
+void CropAndResizeMultiLevelBackpropImageLaucher(
+    const float *grads_ptr, const float *boxes_ptr,
+    const int *box_ind_ptr, const int *box_level_ptr,
+    int num_boxes, int batch, int crop_height, int crop_width, int depth,
+    float *const *grads_image_ptrs, const int *image_heights, const int *image_widths, int num_levels,
+    cudaStream_t stream);
+
 #ifdef __cplusplus
 }
 #endif
@@ -22,6 +22,8 @@ if torch.cuda.is_available():
     extra_objects = ['src/roi_pooling.cu.o']
     extra_objects = [os.path.join(this_file, fname) for fname in extra_objects]
 
+extra_compile_args = ['-fopenmp', '-std=c99']
+
 ffi = create_extension(
     '_ext.roi_pooling',
     headers=headers,
@@ -29,7 +31,8 @@ ffi = create_extension(
     define_macros=defines,
     relative_to=__file__,
     with_cuda=with_cuda,
-    extra_objects=extra_objects
+    extra_objects=extra_objects,
+    extra_compile_args=extra_compile_args
 )
 
 if __name__ == '__main__':
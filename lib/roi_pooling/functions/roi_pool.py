@@ -18,9 +18,8 @@ class RoIPoolFunction(Function):
         ctx.argmax = features.new(num_rois, num_channels, ctx.pooled_height, ctx.pooled_width).zero_().int()
         ctx.rois = rois
         if not features.is_cuda:
-            _features = features.permute(0, 2, 3, 1)
             roi_pooling.roi_pooling_forward(ctx.pooled_height, ctx.pooled_width, ctx.spatial_scale,
-                                            _features, rois, output)
+                                            features.contiguous(), rois.contiguous(), output, ctx.argmax)
         else:
             roi_pooling.roi_pooling_forward_cuda(ctx.pooled_height, ctx.pooled_width, ctx.spatial_scale,
                                                  features, rois, output, ctx.argmax)
@@ -28,11 +27,15 @@ class RoIPoolFunction(Function):
         return output
 
     def backward(ctx, grad_output):
-        assert(ctx.feature_size is not None and grad_output.is_cuda)
+        assert(ctx.feature_size is not None)
         batch_size, num_channels, data_height, data_width = ctx.feature_size
         grad_input = grad_output.new(batch_size, num_channels, data_height, data_width).zero_()
 
-        roi_pooling.roi_pooling_backward_cuda(ctx.pooled_height, ctx.pooled_width, ctx.spatial_scale,
-                                              grad_output, ctx.rois, grad_input, ctx.argmax)
+        if not grad_output.is_cuda:
+            roi_pooling.roi_pooling_backward(ctx.pooled_height, ctx.pooled_width, ctx.spatial_scale,
+                                             grad_output.contiguous(), ctx.rois.contiguous(), grad_input, ctx.argmax)
+        else:
+            roi_pooling.roi_pooling_backward_cuda(ctx.pooled_height, ctx.pooled_width, ctx.spatial_scale,
+                                                  grad_output, ctx.rois, grad_input, ctx.argmax)
 
         return grad_input, None
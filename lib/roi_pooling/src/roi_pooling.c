@@ -1,57 +1,60 @@
 #include <TH/TH.h>
 #include <math.h>
+#include <float.h>
+
+/* RoI max pooling on cpu; same layout and argmax convention as the cuda kernel (roi_pooling_kernel.cu):
+ * features are [batch, channels, height, width] and argmax holds the flat index into features of the pooled
+ * element, or -1 for an empty bin. Both passes are parallelized with OpenMP (OMP_NUM_THREADS).
+ */
 
 int roi_pooling_forward(int pooled_height, int pooled_width, float spatial_scale,
-                        THFloatTensor * features, THFloatTensor * rois, THFloatTensor * output)
+                        THFloatTensor * features, THFloatTensor * rois, THFloatTensor * output,
+                        THIntTensor * argmax)
 {
     // Grab the input tensor
-    float * data_flat = THFloatTensor_data(features);
-    float * rois_flat = THFloatTensor_data(rois);
+    const float * data_flat = THFloatTensor_data(features);
+    const float * rois_flat = THFloatTensor_data(rois);
 
     float * output_flat = THFloatTensor_data(output);
+    int * argmax_flat = THIntTensor_data(argmax);
 
     // Number of ROIs
-    int num_rois = THFloatTensor_size(rois, 0);
-    int size_rois = THFloatTensor_size(rois, 1);
-    // batch size
-    int batch_size = THFloatTensor_size(features, 0);
-    if(batch_size != 1)
-    {
-        return 0;
-    }
+    const int num_rois = THFloatTensor_size(rois, 0);
+    const int size_rois = THFloatTensor_size(rois, 1);
+    // Number of channels
+    const int num_channels = THFloatTensor_size(features, 1);
     // data height
-    int data_height = THFloatTensor_size(features, 1);
+    const int data_height = THFloatTensor_size(features, 2);
     // data width
-    int data_width = THFloatTensor_size(features, 2);
-    // Number of channels
-    int num_channels = THFloatTensor_size(features, 3);
-
-    // Set all element of the output tensor to -inf.
-    THFloatStorage_fill(THFloatTensor_storage(output), -1);
+    const int data_width = THFloatTensor_size(features, 3);
+    const int output_area = pooled_width * pooled_height;
 
-    // For each ROI R = [batch_index x1 y1 x2 y2]: max pool over R
-    int index_roi = 0;
-    int index_output = 0;
-    int n;
-    for (n = 0; n < num_rois; ++n)
+    // one (roi, channel) plane of the output per iteration
+    int nc;
+    #pragma omp parallel for
+    for (nc = 0; nc < num_rois * num_channels; ++nc)
     {
-        int roi_batch_ind = rois_flat[index_roi + 0];
-        int roi_start_w = round(rois_flat[index_roi + 1] * spatial_scale);
-        int roi_start_h = round(rois_flat[index_roi + 2] * spatial_scale);
-        int roi_end_w = round(rois_flat[index_roi + 3] * spatial_scale);
-        int roi_end_h = round(rois_flat[index_roi + 4] * spatial_scale);
-        //      CHECK_GE(roi_batch_ind, 0);
-        //      CHECK_LT(roi_batch_ind, batch_size);
+        const int n = nc / num_channels;
+        const int c = nc % num_channels;
 
-        int roi_height = fmaxf(roi_end_h - roi_start_h + 1, 1);
-        int roi_width = fmaxf(roi_end_w - roi_start_w + 1, 1);
-        float bin_size_h = (float)(roi_height) / (float)(pooled_height);
-        float bin_size_w = (float)(roi_width) / (float)(pooled_width);
+        // For each ROI R = [batch_index x1 y1 x2 y2]: max pool over R
+        const float * roi = rois_flat + n * size_rois;
+        const int roi_batch_ind = roi[0];
+        const int roi_start_w = round(roi[1] * spatial_scale);
+        const int roi_start_h = round(roi[2] * spatial_scale);
+        const int roi_end_w = round(roi[3] * spatial_scale);
+        const int roi_end_h = round(roi[4] * spatial_scale);
 
-        int index_data = roi_batch_ind * data_height * data_width * num_channels;
-        const int output_area = pooled_width * pooled_height;
+        // Force malformed ROIs to be 1x1
+        const int roi_height = fmaxf(roi_end_h - roi_start_h + 1, 1);
+        const int roi_width = fmaxf(roi_end_w - roi_start_w + 1, 1);
+        const float bin_size_h = (float)(roi_height) / (float)(pooled_height);
+        const float bin_size_w = (float)(roi_width) / (float)(pooled_width);
 
-        int c, ph, pw;
+        const int data_offset = (roi_batch_ind * num_channels + c) * data_height * data_width;
+        const int output_offset = nc * output_area;
+
+        int ph, pw, h, w;
         for (ph = 0; ph < pooled_height; ++ph)
         {
             for (pw = 0; pw < pooled_width; ++pw)
@@ -61,44 +64,73 @@ int roi_pooling_forward(int pooled_height, int pooled_width, float spatial_scale
                 int hend = (ceil((float)(ph + 1) * bin_size_h));
                 int wend = (ceil((float)(pw + 1) * bin_size_w));
 
+                // Add roi offsets and clip to input boundaries
                 hstart = fminf(fmaxf(hstart + roi_start_h, 0), data_height);
                 hend = fminf(fmaxf(hend + roi_start_h, 0), data_height);
                 wstart = fminf(fmaxf(wstart + roi_start_w, 0), data_width);
                 wend = fminf(fmaxf(wend + roi_start_w, 0), data_width);
+                const int is_empty = (hend <= hstart) || (wend <= wstart);
 
-                const int pool_index = index_output + (ph * pooled_width + pw);
-                int is_empty = (hend <= hstart) || (wend <= wstart);
-                if (is_empty)
-                {
-                    for (c = 0; c < num_channels * output_area; c += output_area)
-                    {
-                        output_flat[pool_index + c] = 0;
-                    }
-                }
-                else
+                // Define an empty pooling region to be zero
+                float maxval = is_empty ? 0 : -FLT_MAX;
+                // If nothing is pooled, argmax = -1 causes nothing to be backprop'd
+                int maxidx = -1;
+                for (h = hstart; h < hend; ++h)
                 {
-                    int h, w, c;
-                    for (h = hstart; h < hend; ++h)
+                    for (w = wstart; w < wend; ++w)
                     {
-                        for (w = wstart; w < wend; ++w)
+                        const int index = data_offset + h * data_width + w;
+                        if (data_flat[index] > maxval)
                         {
-                            for (c = 0; c < num_channels; ++c)
-                            {
-                                const int index = (h * data_width + w) * num_channels + c;
-                                if (data_flat[index_data + index] > output_flat[pool_index + c * output_area])
-                                {
-                                    output_flat[pool_index + c * output_area] = data_flat[index_data + index];
-                                }
-                            }
+                            maxval = data_flat[index];
+                            maxidx = index;
                         }
                     }
                 }
+                output_flat[output_offset + ph * pooled_width + pw] = maxval;
+                argmax_flat[output_offset + ph * pooled_width + pw] = maxidx;
             }
         }
+    }
+    return 1;
+}
+
+int roi_pooling_backward(int pooled_height, int pooled_width, float spatial_scale,
+                         THFloatTensor * top_grad, THFloatTensor * rois, THFloatTensor * bottom_grad,
+                         THIntTensor * argmax)
+{
+    const float * top_grad_flat = THFloatTensor_data(top_grad);
+    const float * rois_flat = THFloatTensor_data(rois);
+    const int * argmax_flat = THIntTensor_data(argmax);
+    float * bottom_grad_flat = THFloatTensor_data(bottom_grad);
+
+    const int num_rois = THFloatTensor_size(rois, 0);
+    const int size_rois = THFloatTensor_size(rois, 1);
+    const int batch_size = THFloatTensor_size(bottom_grad, 0);
+    const int num_channels = THFloatTensor_size(bottom_grad, 1);
+    const int output_area = pooled_width * pooled_height;
 
-        // Increment ROI index
-        index_roi += size_rois;
-        index_output += pooled_height * pooled_width * num_channels;
+    // Race-free: each iteration owns one (batch, channel) plane of bottom_grad, and the argmax of every roi of
+    // that batch index (and channel) points into this plane only.
+    int bc;
+    #pragma omp parallel for
+    for (bc = 0; bc < batch_size * num_channels; ++bc)
+    {
+        const int b = bc / num_channels;
+        const int c = bc % num_channels;
+        int n, i;
+        for (n = 0; n < num_rois; ++n)
+        {
+            if ((int)(rois_flat[n * size_rois]) != b)
+                continue;
+            const int offset = (n * num_channels + c) * output_area;
+            for (i = 0; i < output_area; ++i)
+            {
+                const int index = argmax_flat[offset + i];
+                if (index >= 0)
+                    bottom_grad_flat[index] += top_grad_flat[offset + i];
+            }
+        }
     }
     return 1;
-}
\ No newline at end of file
+}
@@ -1,4 +1,4 @@
-from lib.layers import pyramid_roi_align
+from lib.layers import pyramid_roi_align, assign_roi_level, copy_in_roi_order, multilevel_roi_align
 from lib.roi_align.crop_and_resize import CropAndResizeFunction
 from lib.roi_pooling.functions.roi_pool import RoIPoolFunction
 import torch.nn.functional as F
@@ -188,7 +188,7 @@ class FPN(nn.Module):
 
     def forward(self, x, mode):
         bs = x.size(0)
-        ot_loss = Variable(torch.zeros(bs, 3).cuda())
+        ot_loss = Variable(to_device(torch.zeros(bs, 3), self.config))
         x = self.C1(x)
         x = self.C2(x)
         c2_out = x
@@ -296,6 +296,7 @@ class Dev(nn.Module):
         self.num_classs = config.DATASET.NUM_CLASSES
         self.config = config
         self.dis_upsample = config.DEV.DIS_UPSAMPLER
+        self.upsample_on_roi = config.DEV.UPSAMPLE_ON_ROI and config.ROIS.METHOD == 'roi_align'
         self.structure = config.DEV.STRUCTURE
         self.roi_type = config.ROIS.METHOD
         # if self.roi_type == 'roi_pool':
@@ -377,17 +378,25 @@ class Dev(nn.Module):
             big_ix = (roi_level == -1)
         return big_ix
 
-    def forward(self, x, rois, roi_cls_gt=None):
+    def forward(self, x, rois, roi_cls_gt=None, need_cls=True, need_mask=True, need_feat=True):
         # x is a multi-scale List containing Variable (feature maps)
         # rois: [bs, 200, 4], normalized, y1, x1, y2, x2
+        # need_cls, need_mask, need_feat: which of (pooled_out, mask_out, feat_out) the caller uses;
+        #   the others are not computed and returned as None
         base = self.config.ROIS.ASSIGN_ANCHOR_BASE
+        # meta features (feat_out) are computed only if asked for
+        meta_on = need_feat and not self.config.DEV.BASELINE
+        pooled_out, mask_out, feat_out = None, None, None
 
         # fixme: roi-pool not below
         if not self.use_dev:
             # in 'layers.py'
-            pooled_out = pyramid_roi_align([rois] + x, self.pool_size, self.image_shape, base=base)
-            mask_out = pyramid_roi_align([rois] + x, self.mask_pool_size, self.image_shape, base=base)
-            feat_out = None
+            # the level assignment is shared by the 7x7 and 14x14 crops
+            roi_level = assign_roi_level(rois, self.image_shape, base=base)
+            if need_cls:
+                pooled_out = pyramid_roi_align([rois] + x, self.pool_size, self.image_shape, roi_level=roi_level)
+            if need_mask:
+                mask_out = pyramid_roi_align([rois] + x, self.mask_pool_size, self.image_shape, roi_level=roi_level)
 
         # fixme: roi-pool not below
         elif self.structure == 'alpha':
@@ -398,18 +407,14 @@ class Dev(nn.Module):
             y1, x1, y2, x2 = rois.chunk(4, dim=2)   # in normalized coordinate
             h, w = y2 - y1, x2 - x1
             area = w*h
+            total_box = rois.size(0)*rois.size(1)
 
             # use **either** 'roi_level' or 'accu_small_idx' to assign anchors
             if not self.config.DEV.ASSIGN_BOX_ON_ALL_SCALE:
                 # original plan
-                _image_area = Variable(torch.FloatTensor(
-                    [float(self.image_shape[0]*self.image_shape[1])]), requires_grad=False).cuda()
-                roi_level = 4 + log2(torch.sqrt(area)/(base/torch.sqrt(_image_area)))
-                roi_level = roi_level.round().int()
-                # in case batch size =1, we keep that dim
-                roi_level = roi_level.clamp(2, 5).squeeze(dim=-1)   # size: [bs, num_roi], say [3, 200]
+                roi_level = assign_roi_level(rois, self.image_shape, base=base)   # size: [bs, num_roi], say [3, 200]
             else:
-                accu_small_idx = Variable(torch.ByteTensor(rois.size(0), rois.size(1)).cuda())
+                accu_small_idx = Variable(to_device(torch.ByteTensor(rois.size(0), rois.size(1)), self.config))
                 accu_small_idx[:] = False
 
             # if self.config.CTRL.DEBUG:
@@ -417,9 +422,20 @@ class Dev(nn.Module):
             #           'max box area: {:.4f}, min box area: {:.4f}'.format(
             #             rois.size(0)*rois.size(1), 4, area.max().data[0], area.min().data[0]))
 
-            pooled, mask, box_to_level = [], [], []
+            # when boxes are assigned by area, big ones are left out of all scales during train
+            zero_fill = self.config.DEV.ASSIGN_BOX_ON_ALL_SCALE and train_phase
             big_feat, big_cnt, small_feat, small_cnt = [], [], [], []   # to generate feat_out
             big_loss = []
+            # with RoI align on whole (upsampled) maps, the loop only collects the map and the level of each RoI;
+            # all levels are then cropped by one multilevel_roi_align call per pool size.
+            # per-RoI upsampled windows are still cropped level by level.
+            fused_crop = not self.upsample_on_roi
+            level_maps = list(x)
+            box_level = to_device(torch.IntTensor(total_box).fill_(-1), self.config)   # -1: not on any level
+            # (position in small_feat, roi_index, small_index) of the levels whose meta feature is computed
+            # from mask_out after the loop; if mask_out is not asked for, only the RoIs of these levels are cropped
+            small_meta = []
+            meta_level = box_level.clone()
             # LOOP through levels and apply ROI pooling to each.
             # P2 to P5, with 2 being the most coarse map
             for i, level in enumerate(range(2, 6)):
@@ -455,16 +471,18 @@ class Dev(nn.Module):
                     #     print('\tscale {:d} (thres: {:.4f}), NO (small) num_box, skip this scale ...'
                     #           .format(level, _thres))
                     # if there are no "small" boxes, we won't compute stats of *both* small and big on this scale
-                    if _use_upsample and train_phase and not self.config.DEV.BASELINE:
-                        small_feat.append(Variable(torch.zeros(1024, self.num_classs).cuda()))
-                        small_cnt.append(Variable(torch.zeros(1, self.num_classs).cuda(), requires_grad=False))
-                        big_feat.append(Variable(torch.zeros(1024, self.num_classs).cuda()))
-                        big_cnt.append(Variable(torch.zeros(1, self.num_classs).cuda(), requires_grad=False))
-                        big_loss.append(Variable(torch.zeros(1).cuda()))
+                    if _use_upsample and train_phase and meta_on:
+                        small_feat.append(Variable(to_device(torch.zeros(1024, self.num_classs), self.config)))
+                        small_cnt.append(Variable(to_device(torch.zeros(1, self.num_classs),
+                                                            self.config), requires_grad=False))
+                        big_feat.append(Variable(to_device(torch.zeros(1024, self.num_classs), self.config)))
+                        big_cnt.append(Variable(to_device(torch.zeros(1, self.num_classs),
+                                                          self.config), requires_grad=False))
+                        big_loss.append(Variable(to_device(torch.zeros(1), self.config)))
                     continue
 
                 # Decide "big_ix"; deal with 'big' boxes during train
-                if train_phase and not self.config.DEV.BASELINE:
+                if train_phase and meta_on:
                     if not self.config.DEV.ASSIGN_BOX_ON_ALL_SCALE:
                         big_ix = self._find_big_box(level, roi_level)
                     else:
@@ -473,9 +491,10 @@ class Dev(nn.Module):
                     if not big_ix.any():
                         if _use_upsample:
                             # there is no "big" boxes; never mind, we use historic data
-                            big_feat.append(Variable(torch.zeros(1024, self.num_classs).cuda()))
-                            big_cnt.append(Variable(torch.zeros(1, self.num_classs).cuda(), requires_grad=False))
-                            big_loss.append(Variable(torch.zeros(1).cuda()))
+                            big_feat.append(Variable(to_device(torch.zeros(1024, self.num_classs), self.config)))
+                            big_cnt.append(Variable(to_device(torch.zeros(1, self.num_classs),
+                                                              self.config), requires_grad=False))
+                            big_loss.append(Variable(to_device(torch.zeros(1), self.config)))
                         big_num = 0
                     else:
                         # process big-small-supervise (big part)
@@ -506,55 +525,80 @@ class Dev(nn.Module):
                             curr_big_loss = F.cross_entropy(big_feat_cls_digits, big_box_gt.long())
                             big_loss.append(curr_big_loss)
                         else:
-                            big_loss.append(Variable(torch.zeros(1).cuda()))
+                            big_loss.append(Variable(to_device(torch.zeros(1), self.config)))
 
                 # "SMALL" boxes (or simply boxes on scale 4,5) exist
                 # small_index: say, 2670 (actual boxes found in this level) x 2
                 small_index = torch.nonzero(small_ix)
-                # Keep track of which box is mapped to which level
-                box_to_level.append(small_index.data)
+                # flat index of the boxes in the RoI-ordered output
+                roi_index = small_index.data[:, 0] * rois.size(1) + small_index.data[:, 1]
                 # rois: [bs, num_roi, 4] -> small_boxes [index[0], 4]
                 small_boxes = rois[small_index[:, 0].data, small_index[:, 1].data, :]
 
                 # scale up feature map of "smaller" boxes
                 box_ind = small_index[:, 0].int()
+                _crop_boxes, _crop_ind = small_boxes, box_ind
                 if _use_upsample:
                     # small_boxes *= self.upsample_fac
                     _idx = i if self.config.DEV.MULTI_UPSAMPLER else 0
-                    _feat_maps = self.upsample[_idx](curr_feat_maps)
+                    if self.upsample_on_roi:
+                        _feat_maps, _crop_boxes, _crop_ind = \
+                            self._upsample_on_roi(self.upsample[_idx], curr_feat_maps, small_boxes, box_ind)
+                    else:
+                        _feat_maps = self.upsample[_idx](curr_feat_maps)
                 else:
                     _feat_maps = curr_feat_maps
 
                 assert small_boxes.max().data[0] <= 1.0
-                # shape: say 473, 256, 7, 7
-                pooled_features = CropAndResizeFunction(
-                    self.pool_size, self.pool_size)(_feat_maps, small_boxes, box_ind)
-                pooled.append(pooled_features)
-
                 # mask and feat features are shared with a RoI
                 # since the output size is the same (mask_pool_size=feat_pool_size)
-                # shape: say 473, 256, 14, 14
-                mask_and_feat = CropAndResizeFunction(
-                    self.mask_pool_size, self.mask_pool_size)(_feat_maps, small_boxes, box_ind)
-                mask.append(mask_and_feat)
-
                 # for scale 4 and 5, we don't do meta-supervise
-                if _use_upsample and train_phase and not self.config.DEV.BASELINE:
-                    # process big-small-supervise (small part)
-                    small_box_gt = roi_cls_gt[small_index[:, 0].data, small_index[:, 1].data]
-                    small_output = self.feat_extract(mask_and_feat)
-                    if self.config.DEV.LOSS_CHOICE != 'ot':
-                        small_output = self.last_op(small_output)
-                    _s_feat, _s_cnt = self._assign_feat2cls([small_box_gt, small_output])
-                    small_feat.append(_s_feat)
-                    small_cnt.append(_s_cnt)
+                _small_meta = _use_upsample and train_phase and meta_on
+                if fused_crop:
+                    level_maps[i] = _feat_maps
+                    box_level.index_fill_(0, roi_index, i)
+                    if _small_meta:
+                        meta_level.index_fill_(0, roi_index, i)
+                else:
+                    # shape: say 473, 256, 7, 7
+                    if need_cls:
+                        pooled_features = CropAndResizeFunction(
+                            self.pool_size, self.pool_size)(_feat_maps, _crop_boxes, _crop_ind)
+                        pooled_out = copy_in_roi_order(pooled_out, roi_index, pooled_features, total_box, zero_fill)
+                    # shape: say 473, 256, 14, 14
+                    if need_mask or _small_meta:
+                        mask_and_feat = CropAndResizeFunction(
+                            self.mask_pool_size, self.mask_pool_size)(_feat_maps, _crop_boxes, _crop_ind)
+                        mask_out = copy_in_roi_order(mask_out, roi_index, mask_and_feat, total_box, zero_fill)
+
+                if _small_meta:
+                    small_meta.append((len(small_feat), roi_index, small_index))
+                    small_feat.append(None)
+                    small_cnt.append(None)
                 # if self.config.CTRL.DEBUG:
                 #     print('\tscale {:d} (thres: {:.4f}), (small) num_box: {:d}, big_box: {:d}, upsample: {}'
                 #           .format(level, _thres, small_index.size(0), big_num, _use_upsample))
             # SCALE LOOP ENDS
 
-            pooled_out, mask_out = self._reshape_result(pooled, mask, box_to_level, rois.size())
-            if train_phase and not self.config.DEV.BASELINE:
+            if fused_crop:
+                if need_cls:
+                    pooled_out = multilevel_roi_align(level_maps, rois, box_level, self.pool_size)
+                if need_mask or small_meta:
+                    mask_out = multilevel_roi_align(level_maps, rois, box_level if need_mask else meta_level,
+                                                    self.mask_pool_size)
+
+            for _pos, roi_index, small_index in small_meta:
+                # process big-small-supervise (small part)
+                mask_and_feat = mask_out.index_select(0, Variable(roi_index))
+                small_box_gt = roi_cls_gt[small_index[:, 0].data, small_index[:, 1].data]
+                small_output = self.feat_extract(mask_and_feat)
+                if self.config.DEV.LOSS_CHOICE != 'ot':
+                    small_output = self.last_op(small_output)
+                small_feat[_pos], small_cnt[_pos] = self._assign_feat2cls([small_box_gt, small_output])
+            if not need_mask:
+                mask_out = None
+
+            if train_phase and meta_on:
                 feat_out = [
                     torch.stack(big_feat).detach().unsqueeze(dim=0),   # do *NOT* pass gradient of big_feat
                     torch.stack(big_cnt).unsqueeze(dim=0),
@@ -562,7 +606,7 @@ class Dev(nn.Module):
                     torch.stack(small_cnt).unsqueeze(dim=0),
                     torch.stack(big_loss).unsqueeze(dim=0),
                 ]
-            else:
+            elif need_feat:
                 feat_out = []
 
         elif self.structure == 'beta':
@@ -580,14 +624,9 @@ class Dev(nn.Module):
             # use **either** 'roi_level' or 'accu_small_idx' to assign anchors
             if not self.config.DEV.ASSIGN_BOX_ON_ALL_SCALE:
                 # original plan
-                _image_area = Variable(torch.FloatTensor(
-                    [float(self.image_shape[0]*self.image_shape[1])]), requires_grad=False).cuda()
-                roi_level = 4 + log2(torch.sqrt(area)/(base/torch.sqrt(_image_area)))
-                roi_level = roi_level.round().int()
-                # in case batch size =1, we keep that dim
-                roi_level = roi_level.clamp(2, 5).squeeze(dim=-1)   # size: [bs, num_roi], say [3, 200]
+                roi_level = assign_roi_level(rois, self.image_shape, base=base)   # size: [bs, num_roi], say [3, 200]
             else:
-                accu_small_idx = Variable(torch.ByteTensor(rois.size(0), rois.size(1)).cuda())
+                accu_small_idx = Variable(to_device(torch.ByteTensor(rois.size(0), rois.size(1)), self.config))
                 accu_small_idx[:] = False
 
             if SHOW_STAT:
@@ -597,12 +636,26 @@ class Dev(nn.Module):
 
             # Step 2. LOOP through levels and apply ROI pooling to each.
             # P2 to P5, with 2 being the most coarse map
-            pooled, mask, box_to_level = [], [], []
+            # when boxes are assigned by area, big ones are left out of all scales during train
+            zero_fill = self.config.DEV.ASSIGN_BOX_ON_ALL_SCALE and train_phase
             big_feat, big_cnt, small_feat, small_cnt = [], [], [], []   # to generate feat_out
             big_loss = []
-            small_output_all = Variable(torch.zeros(total_box, 1024).cuda())
-            small_gt_all = Variable(torch.zeros(total_box).cuda())
+            if need_feat:
+                small_output_all = Variable(to_device(torch.zeros(total_box, 1024), self.config))
+                small_gt_all = Variable(to_device(torch.zeros(total_box), self.config))
+            else:
+                small_output_all, small_gt_all = None, None
             small_out_cnt = 0
+            # with RoI align on whole upsampled maps, the loop only collects the map and the level of each RoI;
+            # all levels are then cropped by one multilevel_roi_align call per pool size.
+            # RoIPool and per-RoI upsampled windows are still cropped level by level.
+            fused_crop = self.roi_type == 'roi_align' and not self.upsample_on_roi
+            level_maps = list(x)
+            box_level = to_device(torch.IntTensor(total_box).fill_(-1), self.config)   # -1: not on any level
+            # (position in small_feat, roi_index, small_index) of the levels whose meta feature is computed
+            # from mask_out after the loop; if mask_out is not asked for, only the RoIs of these levels are cropped
+            small_meta = []
+            meta_level = box_level.clone()
 
             for i, level in enumerate(range(2, 6)):
 
@@ -636,18 +689,20 @@ class Dev(nn.Module):
                         print('\tscale {:d} (thres: {:.4f}), NO (small) num_box, skip this scale ...'
                               .format(level, _thres))
                     # if there are no "small" boxes, we won't compute stats of *both* small and big on this scale
-                    if _use_meta and train_phase and not self.config.DEV.BASELINE:
-                        small_feat.append(Variable(torch.zeros(1024, self.num_classs).cuda()))
-                        small_cnt.append(Variable(torch.zeros(1, self.num_classs).cuda(), requires_grad=False))
-                        big_feat.append(Variable(torch.zeros(1024, self.num_classs).cuda()))
-                        big_cnt.append(Variable(torch.zeros(1, self.num_classs).cuda(), requires_grad=False))
-                        big_loss.append(Variable(torch.zeros(1).cuda()))
+                    if _use_meta and train_phase and meta_on:
+                        small_feat.append(Variable(to_device(torch.zeros(1024, self.num_classs), self.config)))
+                        small_cnt.append(Variable(to_device(torch.zeros(1, self.num_classs),
+                                                            self.config), requires_grad=False))
+                        big_feat.append(Variable(to_device(torch.zeros(1024, self.num_classs), self.config)))
+                        big_cnt.append(Variable(to_device(torch.zeros(1, self.num_classs),
+                                                          self.config), requires_grad=False))
+                        big_loss.append(Variable(to_device(torch.zeros(1), self.config)))
                     continue
                 #import pdb 
                 #pdb.set_trace()
 
                 # TRAIN ONLY: Decide "big_ix"; deal with 'big' boxes
-                if train_phase and not self.config.DEV.BASELINE:
+                if train_phase and meta_on:
                     if not self.config.DEV.ASSIGN_BOX_ON_ALL_SCALE:
                         big_ix = self._find_big_box2(level, roi_level)
                     else:
@@ -656,9 +711,10 @@ class Dev(nn.Module):
                     if not big_ix.any():
                         if _use_meta:
                             # there is no "big" boxes; never mind, we use historic data
-                            big_feat.append(Variable(torch.zeros(1024, self.num_classs).cuda()))
-                            big_cnt.append(Variable(torch.zeros(1, self.num_classs).cuda(), requires_grad=False))
-                            big_loss.append(Variable(torch.zeros(1).cuda()))
+                            big_feat.append(Variable(to_device(torch.zeros(1024, self.num_classs), self.config)))
+                            big_cnt.append(Variable(to_device(torch.zeros(1, self.num_classs),
+                                                              self.config), requires_grad=False))
+                            big_loss.append(Variable(to_device(torch.zeros(1), self.config)))
                         big_num = 0
                         big_no_need = 0
                         big_need = 0
@@ -712,71 +768,68 @@ class Dev(nn.Module):
                             curr_big_loss = F.cross_entropy(big_feat_cls_digits, big_box_gt.long())
                             big_loss.append(curr_big_loss)
                         else:
-                            big_loss.append(Variable(torch.zeros(1).cuda()))
+                            big_loss.append(Variable(to_device(torch.zeros(1), self.config)))
 
                 # "SMALL" boxes (or simply boxes on scale 4,5) exist
                 # small_index: say, 2670 (actual boxes found in this level) x 2
                 small_index = torch.nonzero(small_ix)
-                # Keep track of which box is mapped to which level
-                box_to_level.append(small_index.data)
+                # flat index of the boxes in the RoI-ordered output
+                roi_index = small_index.data[:, 0] * rois.size(1) + small_index.data[:, 1]
                 # rois: [bs, num_roi, 4] -> small_boxes [index[0], 4]
                 small_boxes = rois[small_index[:, 0].data, small_index[:, 1].data, :]
 
                 # scale up feature map of "smaller" boxes
                 box_ind = small_index[:, 0].int()
                 _idx = i if self.config.DEV.MULTI_UPSAMPLER else 0
-                _feat_maps = self.upsample[_idx](curr_feat_maps)
+                if self.upsample_on_roi:
+                    _feat_maps, _crop_boxes, _crop_ind = \
+                        self._upsample_on_roi(self.upsample[_idx], curr_feat_maps, small_boxes, box_ind)
+                else:
+                    _feat_maps = self.upsample[_idx](curr_feat_maps)
+                    _crop_boxes, _crop_ind = small_boxes, box_ind
                 # _feat_maps = curr_feat_maps
                 assert small_boxes.max().data[0] <= 1.0
 
-                # pooled_features shape: say 473, 256, 7, 7
-                if self.roi_type == 'roi_align':
-                    pooled_features = CropAndResizeFunction(
-                        self.pool_size, self.pool_size)(_feat_maps, small_boxes, box_ind)
-                elif self.roi_type == 'roi_pool':
-                    _input = self._make_roi_pool_box_input(small_boxes, box_ind)
-                    pooled_features = RoIPoolFunction(
-                        self.pool_size, self.pool_size, self.roi_spatial_scale[i]
-                    )(_feat_maps, _input)
-                # print(pooled_features_align.sum().data[0])
-                # print(pooled_features_pool.sum().data[0])
-                pooled.append(pooled_features)
-
                 # mask and feat features are shared with a RoI
                 # since the output size is the same (mask_pool_size=feat_pool_size)
-                # mask_and_feat shape: say 473, 256, 14, 14
-                if self.roi_type == 'roi_align':
-                    mask_and_feat = CropAndResizeFunction(
-                        self.mask_pool_size, self.mask_pool_size)(_feat_maps, small_boxes, box_ind)
-                elif self.roi_type == 'roi_pool':
-                    mask_and_feat = RoIPoolFunction(
-                        self.mask_pool_size, self.mask_pool_size, self.roi_spatial_scale[i]
-                    )(_feat_maps, _input)
-                mask.append(mask_and_feat)
+                _small_meta = _use_meta and meta_on
+                if fused_crop:
+                    level_maps[i] = _feat_maps
+                    box_level.index_fill_(0, roi_index, i)
+                    if _small_meta:
+                        meta_level.index_fill_(0, roi_index, i)
+                else:
+                    if self.roi_type == 'roi_pool':
+                        _input = self._make_roi_pool_box_input(small_boxes, box_ind)
 
-                # Deal with 'small' boxes during train and test
-                if _use_meta and not self.config.DEV.BASELINE:
-                    # shape: say 460, 1024, 1, 1
-                    small_output = self.feat_extract(mask_and_feat)
-                    if self.config.DEV.LOSS_CHOICE != 'ot':
-                        small_output = self.last_op(small_output)
+                    # pooled_features shape: say 473, 256, 7, 7
+                    if need_cls:
+                        if self.roi_type == 'roi_align':
+                            pooled_features = CropAndResizeFunction(
+                                self.pool_size, self.pool_size)(_feat_maps, _crop_boxes, _crop_ind)
+                        elif self.roi_type == 'roi_pool':
+                            pooled_features = RoIPoolFunction(
+                                self.pool_size, self.pool_size, self.roi_spatial_scale[i]
+                            )(_feat_maps, _input)
+                        pooled_out = copy_in_roi_order(pooled_out, roi_index, pooled_features, total_box, zero_fill)
 
-                    _start_ind = small_out_cnt
-                    _small_num = small_index.size(0)
-                    small_output_all[_start_ind:_small_num+_start_ind, :] = small_output
-                    # TODO: does it match the indices? (8 x 10000 -> 8000)
+                    # mask_and_feat shape: say 473, 256, 14, 14
+                    if need_mask or _small_meta:
+                        if self.roi_type == 'roi_align':
+                            mask_and_feat = CropAndResizeFunction(
+                                self.mask_pool_size, self.mask_pool_size)(_feat_maps, _crop_boxes, _crop_ind)
+                        elif self.roi_type == 'roi_pool':
+                            mask_and_feat = RoIPoolFunction(
+                                self.mask_pool_size, self.mask_pool_size, self.roi_spatial_scale[i]
+                            )(_feat_maps, _input)
+                        mask_out = copy_in_roi_order(mask_out, roi_index, mask_and_feat, total_box, zero_fill)
 
+                # Deal with 'small' boxes during train and test
+                if _small_meta:
+                    small_meta.append((len(small_feat), roi_index, small_index))
                     if train_phase:
-                        small_box_gt = roi_cls_gt[small_index[:, 0].data, small_index[:, 1].data]
-                        # shape: always 1024 x 81 (cls_num); this is an averaged output
-                        _s_feat, _s_cnt = self._assign_feat2cls([small_box_gt, small_output])
-                        small_feat.append(_s_feat)
-                        small_cnt.append(_s_cnt)
-                        small_gt_all[_start_ind:_small_num+_start_ind] = small_box_gt
-                    else:
-                        small_gt_all[_start_ind:_small_num+_start_ind] = 1
-
-                    small_out_cnt += _small_num
+                        small_feat.append(None)
+                        small_cnt.append(None)
 
                 if SHOW_STAT:
                     small_area = (small_boxes[:, 0] - small_boxes[:, 2])*(small_boxes[:, 1] - small_boxes[:, 3])
@@ -795,9 +848,38 @@ class Dev(nn.Module):
                     a = 1
             # SCALE LOOP ENDS
 
-            pooled_out, mask_out = self._reshape_result(pooled, mask, box_to_level, rois.size())
+            if fused_crop:
+                if need_cls:
+                    pooled_out = multilevel_roi_align(level_maps, rois, box_level, self.pool_size)
+                if need_mask or small_meta:
+                    mask_out = multilevel_roi_align(level_maps, rois, box_level if need_mask else meta_level,
+                                                    self.mask_pool_size)
+
+            for _pos, roi_index, small_index in small_meta:
+                # shape: say 460, 1024, 1, 1
+                mask_and_feat = mask_out.index_select(0, Variable(roi_index))
+                small_output = self.feat_extract(mask_and_feat)
+                if self.config.DEV.LOSS_CHOICE != 'ot':
+                    small_output = self.last_op(small_output)
+
+                _start_ind = small_out_cnt
+                _small_num = small_index.size(0)
+                small_output_all[_start_ind:_small_num+_start_ind, :] = small_output
+                # TODO: does it match the indices? (8 x 10000 -> 8000)
+
+                if train_phase:
+                    small_box_gt = roi_cls_gt[small_index[:, 0].data, small_index[:, 1].data]
+                    # shape: always 1024 x 81 (cls_num); this is an averaged output
+                    small_feat[_pos], small_cnt[_pos] = self._assign_feat2cls([small_box_gt, small_output])
+                    small_gt_all[_start_ind:_small_num+_start_ind] = small_box_gt
+                else:
+                    small_gt_all[_start_ind:_small_num+_start_ind] = 1
+
+                small_out_cnt += _small_num
+            if not need_mask:
+                mask_out = None
 
-            if train_phase and not self.config.DEV.BASELINE:
+            if train_phase and meta_on:
                 if self.config.DEV.BIG_FEAT_DETACH:
                     # do *NOT* pass gradient of big_feat
                     big_feat = torch.stack(big_feat).unsqueeze(dim=0).detach()
@@ -812,34 +894,14 @@ class Dev(nn.Module):
                     small_output_all,
                     small_gt_all
                 ]
-            elif not train_phase:
+            elif not train_phase and need_feat:
                 # test phase in 'beta' structure
                 feat_out = [small_output_all, small_gt_all]
-            else:
+            elif need_feat:
                 feat_out = []
         # END BETA STRUCTURE
         return pooled_out, mask_out, feat_out
 
-    @staticmethod
-    def _reshape_result(pooled, mask, box_to_level, rois_size):
-        pooled = torch.cat(pooled, dim=0)
-        mask = torch.cat(mask, dim=0)
-        box_to_level = torch.cat(box_to_level, dim=0)
-
-        # Rearrange pooled features to match the order of the original boxes
-        pooled_out = Variable(torch.zeros(
-            rois_size[0], rois_size[1], pooled.size(1), pooled.size(2), pooled.size(3)).cuda())
-        pooled_out[box_to_level[:, 0], box_to_level[:, 1], :, :, :] = pooled
-        # 3, 1000, 256, 7, 7 -> 3000, 256, 7, 7
-        pooled_out = pooled_out.view(-1, pooled_out.size(2), pooled_out.size(3), pooled_out.size(4))
-
-        mask_out = Variable(torch.zeros(
-            rois_size[0], rois_size[1], mask.size(1), mask.size(2), mask.size(3)).cuda())
-        mask_out[box_to_level[:, 0], box_to_level[:, 1], :, :, :] = mask
-        mask_out = mask_out.view(-1, mask_out.size(2), mask_out.size(3), mask_out.size(4))
-
-        return pooled_out, mask_out
-
     def _assign_feat2cls(self, input):
         """
         input[List]
@@ -849,8 +911,8 @@ class Dev(nn.Module):
         box_gt, input_feat = input[0], input[1]
         assert box_gt.size(0) == input_feat.size(0)
 
-        feat = Variable(torch.zeros(1024, self.num_classs).cuda())
-        cnt = Variable(torch.zeros(1, self.num_classs).cuda(), requires_grad=False)
+        feat = Variable(to_device(torch.zeros(1024, self.num_classs), self.config))
+        cnt = Variable(to_device(torch.zeros(1, self.num_classs), self.config), requires_grad=False)
 
         for cls_ind in unique1d(box_gt).data:
             if cls_ind == 0:
@@ -862,6 +924,50 @@ class Dev(nn.Module):
                 feat[:, cls_ind] = torch.mean(input_feat[_idx, :], dim=0)
         return feat, cnt
 
+    def _upsample_on_roi(self, upsampler, feat_maps, boxes, box_ind):
+        """Upsample a window around each box instead of the whole feature map.
+        The window is cut at integer pixels with a one-pixel halo (zero padded outside the map), so the upsampler
+        (3x3 conv or stride-2 deconv) gives the same values as on the whole map wherever the crop samples.
+        Falls back to upsampling the whole map if the windows would not be smaller.
+        Args:
+            upsampler:      one of self.upsample
+            feat_maps:      [bs, C, H, W] Variable
+            boxes:          [n, (y1, x1, y2, x2)] Variable, normalized
+            box_ind:        [n] IntTensor Variable
+        Returns:
+            feat_maps, boxes, box_ind to crop from: [n, C, fac*size, fac*size], boxes normalized in their window,
+            and box i on window i
+        """
+        fac = int(self.upsample_fac)
+        bs, ch, h, w = feat_maps.size()
+        num = boxes.size(0)
+        # box corners in pixels of the upsampled map
+        y1, x1, y2, x2 = [boxes.data[:, k] for k in range(4)]
+        y1, y2 = y1 * (fac*h - 1), y2 * (fac*h - 1)
+        x1, x2 = x1 * (fac*w - 1), x2 * (fac*w - 1)
+        # first pixel (on the input map) of each window and the window size shared by all boxes
+        top, left = (y1 / fac).floor() - 1, (x1 / fac).floor() - 1
+        size = int(max(((y2 / fac).floor() + 3 - top).max(), ((x2 / fac).floor() + 3 - left).max()))
+        if num * size * size >= bs * h * w:
+            return upsampler(feat_maps), boxes, box_ind
+
+        # gather the windows from the zero-padded, channel-last map; the pad puts pixel -1 at 0
+        pad_h, pad_w = h + 1 + size, w + 1 + size
+        padded = F.pad(feat_maps, (1, size, 1, size)).permute(0, 2, 3, 1).contiguous().view(-1, ch)
+        steps = boxes.data.new(size).copy_(torch.arange(0, size))
+        rows = (box_ind.data.float() * pad_h + top + 1).unsqueeze(1) + steps.unsqueeze(0)
+        cols = (left + 1).unsqueeze(1) + steps.unsqueeze(0)
+        index = (rows.unsqueeze(2) * pad_w + cols.unsqueeze(1)).view(-1).long()
+        windows = padded.index_select(0, Variable(index)).view(num, size, size, ch).permute(0, 3, 1, 2)
+        windows = upsampler(windows.contiguous())
+
+        # box coordinates inside its (upsampled) window
+        win_len = float(fac*size - 1)
+        crop_boxes = torch.stack([(y1 - fac*top) / win_len, (x1 - fac*left) / win_len,
+                                  (y2 - fac*top) / win_len, (x2 - fac*left) / win_len], dim=1)
+        crop_ind = box_ind.data.new(num).copy_(torch.arange(0, num))
+        return windows, Variable(crop_boxes), Variable(crop_ind)
+
     def _make_roi_pool_box_input(self, boxes, box_ind):
         # For each ROI R = [batch_index x1 y1 x2 y2]: max pool over R
         boxes_new = boxes * float(self.image_shape[0])
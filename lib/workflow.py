@@ -1,3 +1,9 @@
+import io
+import json
+import tarfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import skimage.io
 import matplotlib.pyplot as plt
 from datasets.eval.PythonAPI.pycocotools import mask as maskUtils
 from datasets.eval.PythonAPI.pycocotools.cocoeval import COCOeval
@@ -53,7 +59,7 @@ def train_model(input_model, train_generator, valset, optimizer, layers, vis=Non
     total_ep_till_now = sum(model.config.TRAIN.SCHEDULE[:TEMP[layers]])
 
     # check details
-    if (num_train_im % model.config.TRAIN.BATCH_SIZE) % model.config.MISC.GPU_COUNT != 0:
+    if (num_train_im % model.config.TRAIN.BATCH_SIZE) % max(model.config.MISC.GPU_COUNT, 1) != 0:
         print_log('WARNING [TRAIN]: last mini-batch in an epoch is not divisible by gpu number.\n'
                   'total train im: {:d}, batch size: {:d}, gpu num {:d}\n'
                   'last mini-batch size: {:d}\n'.format(
@@ -172,8 +178,8 @@ def train_epoch(input_model, data_loader, optimizer, **args):
         # takes super long time!!!
         # (when bs is large, like 32, use iterator costs 27s while use zip takes 0.0x seconds)
         # inputs = next(data_iterator)
-        images = Variable(inputs[0].cuda())
-        image_metas = Variable(inputs[-1].cuda())
+        images = Variable(to_device(inputs[0], config))
+        image_metas = Variable(to_device(inputs[-1], config))
         # print('fetch data time: {:.4f}'.format(time.time() - curr_iter_time_start))
 
         if SEE_ONE_EXAMPLE:
@@ -184,7 +190,8 @@ def train_epoch(input_model, data_loader, optimizer, **args):
             # assert EXAMPLE_COCO_IND == image_metas[0][-1].data.cpu()[0]
             gt_class_ids, gt_boxes, gt_masks, _ = model.adjust_input_gt(inputs[1], inputs[2], inputs[3])
             merged_loss, big_feat, big_cnt, small_feat, small_cnt, _ = \
-                input_model([images, gt_class_ids, gt_boxes, gt_masks, image_metas], 'train')  # DEBUG HERE
+                input_model([images, gt_class_ids, gt_boxes, gt_masks] + model.adjust_input_rpn_target(inputs) +
+                            [image_metas], 'train')  # DEBUG HERE
         else:
             # pad with zeros
             gt_class_ids, gt_boxes, gt_masks, _ = model.adjust_input_gt(inputs[1], inputs[2], inputs[3])
@@ -199,7 +206,8 @@ def train_epoch(input_model, data_loader, optimizer, **args):
                 merged_loss, \
                 big_feat, big_cnt, small_feat, small_cnt, big_loss, \
                 small_output_all, small_gt_all, fpn_ot_loss = \
-                    input_model([images, gt_class_ids, gt_boxes, gt_masks, image_metas], 'train')
+                    input_model([images, gt_class_ids, gt_boxes, gt_masks] + model.adjust_input_rpn_target(inputs) +
+                                [image_metas], 'train')
             except Exception:
                 info_pass = {
                     'type': 'Runtime Error',
@@ -224,21 +232,21 @@ def train_epoch(input_model, data_loader, optimizer, **args):
                 meta_loss = model.meta_loss([big_feat, big_cnt, small_feat, small_cnt,
                                              small_output_all, small_gt_all])
             else:
-                meta_loss = Variable(torch.zeros(1).cuda())
+                meta_loss = Variable(to_device(torch.zeros(1), config))
 
             _meta_loss_value = meta_loss.data.cpu()[0]
             if _meta_loss_value < 0:
                 # TODO: seriously consider (meta loss < 0) case in KL option
                 print_log('\n** meta_loss: {:.4f}, at iter {:d} epoch {:d}; set to 0 in this case **\n'.format(
                     _meta_loss_value, iter_ind, curr_ep), config.MISC.LOG_FILE)
-                meta_loss = Variable(torch.zeros(1).cuda())
+                meta_loss = Variable(to_device(torch.zeros(1), config))
 
             if do_meta:
                 meta_loss *= config.DEV.LOSS_FAC
             else:
                 # for the very first few iter, we don't compute meta-loss
                 # but rather accumulate the buffer pool
-                meta_loss = Variable(torch.zeros(1).cuda())
+                meta_loss = Variable(to_device(torch.zeros(1), config))
         else:
             meta_loss = 0
 
@@ -339,6 +347,7 @@ def test_model(input_model, valset, coco_api, limit=-1, image_ids=None, **args):
         if not os.path.exists(_val_folder):
             os.makedirs(_val_folder)
         det_res_file = os.path.join(_val_folder, 'det_result_{:s}.pth'.format(_model_suffix))
+        vis_file_name = None
         train_log_file = model.config.MISC.LOG_FILE
         save_im_folder = os.path.join(_val_folder, _model_suffix)
         if model.config.TEST.SAVE_IM:
@@ -369,16 +378,34 @@ def test_model(input_model, valset, coco_api, limit=-1, image_ids=None, **args):
     # Limit to a subset
     if limit > 0:
         image_ids = image_ids[:limit]
+    # Get corresponding COCO image IDs (of all shards; used in evaluation)
+    coco_image_ids = [dataset.image_info[ind]["id"] for ind in image_ids]
+
+    shard_num, shard_id = model.config.TEST.SHARD_NUM, model.config.TEST.SHARD_ID
+    do_shard = shard_num > 1 and mode == 'inference' and not args['during_train']
+    if do_shard and shard_id >= 0:
+        # this process only sees its own slice of the images
+        image_ids = np.array_split(np.array(image_ids), shard_num)[shard_id].tolist()
+        det_res_file = _shard_file_name(det_res_file, shard_id, shard_num)
+        print_log('[SHARD {:d}/{:d}] {:d} images'.format(shard_id, shard_num, len(image_ids)), log_file)
 
     num_test_im = len(image_ids)
     test_bs = model.config.TEST.BATCH_SIZE
-    # Get corresponding COCO image IDs.
-    coco_image_ids = [dataset.image_info[ind]["id"] for ind in image_ids]
     t_prediction = 0
     t_start = time.time()
 
     skip = False
-    if det_res_file is not None and os.path.exists(det_res_file):
+    if do_shard and shard_id == -1:
+        # merge step: concatenate the result shards and evaluate once
+        results = []
+        for k in range(shard_num):
+            shard_file = _shard_file_name(det_res_file, k, shard_num)
+            assert os.path.exists(shard_file), 'result shard {} not found'.format(shard_file)
+            results.extend(torch.load(shard_file)['det_result'])
+        print_log('merged {:d} result shards; saving results to {:s}'.format(shard_num, det_res_file), log_file)
+        torch.save({'det_result': results}, det_res_file)
+        skip = True
+    elif det_res_file is not None and os.path.exists(det_res_file):
         print_log('results file: {} exists, skip inference and directly evaluate ...'.format(det_res_file),
                   log_file, additional_file=train_log_file)
         results = torch.load(det_res_file)['det_result']
@@ -393,7 +420,7 @@ def test_model(input_model, valset, coco_api, limit=-1, image_ids=None, **args):
     # inference: extract features, do detections
     if not skip:
         print_log("Running COCO evaluation on {} images.".format(num_test_im), log_file, additional_file=train_log_file)
-        assert (num_test_im % test_bs) % model.config.MISC.GPU_COUNT == 0, \
+        assert (num_test_im % test_bs) % max(model.config.MISC.GPU_COUNT, 1) == 0, \
             '[INFERENCE/VISUALIZE] last mini-batch in an epoch is not divisible by gpu number.'
 
         results, cnt = [], 0
@@ -417,8 +444,10 @@ def test_model(input_model, valset, coco_api, limit=-1, image_ids=None, **args):
 
             # FORWARD PASS
             if mode == 'inference':
-                # detections: 8,100,6; mrcnn_mask: 8,100,81,28,28
-                detections, mrcnn_mask = input_model([molded_images, image_metas], mode=mode)
+                # detections: 8,100,6; mrcnn_mask: 8,100,28,28 (not computed if TEST.OUTPUT='boxes')
+                outputs = input_model([molded_images, image_metas], mode=mode)
+                detections = outputs[0]
+                mrcnn_mask = outputs[1] if len(outputs) > 1 else None
             elif mode == 'visualize':
                 # out_feat: 8,100,1024
                 detections, out_feat = input_model([molded_images, image_metas], mode=mode)
@@ -426,20 +455,25 @@ def test_model(input_model, valset, coco_api, limit=-1, image_ids=None, **args):
 
             # Convert to numpy
             detections = detections.data.cpu().numpy()
-            if mode == 'inference':
-                mrcnn_mask = mrcnn_mask.permute(0, 1, 3, 4, 2).contiguous().data.cpu().numpy()
+            if mode == 'inference' and mrcnn_mask is not None:
+                mrcnn_mask = mrcnn_mask.data.cpu().numpy()
 
             # LOOP for each image within this batch
             for i, image in enumerate(images):
 
-                curr_coco_id = coco_image_ids[curr_image_ids[i]]
-                input_value = mrcnn_mask[i] if mode == 'inference' else out_feat[i]
+                curr_coco_id = dataset.image_info[curr_image_ids[i]]["id"]
+                if mode == 'inference':
+                    input_value = mrcnn_mask[i] if mrcnn_mask is not None else None
+                else:
+                    input_value = out_feat[i]
 
-                final_rois, final_class_ids, final_scores, output_value = _unmold_detections(
+                final_rois, final_class_ids, final_scores, output_value = unmold_detections(
                     detections[i], input_value, image.shape, windows[i], mode == 'inference')
 
                 if final_rois is None:
                     continue
+                if mode == 'inference':
+                    has_mask = mask_computed(final_scores, model.config.TEST.MASK_MIN_SCORE)
                 for det_id in range(final_rois.shape[0]):
                     # EACH INSTANCE
                     bbox = np.around(final_rois[det_id], 1)
@@ -450,8 +484,10 @@ def test_model(input_model, valset, coco_api, limit=-1, image_ids=None, **args):
                             "category_id":  dataset.get_source_class_id(final_class_ids[det_id], "coco"),
                             "bbox":         [bbox[1], bbox[0], bbox[3] - bbox[1], bbox[2] - bbox[0]],
                             "score":        final_scores[det_id],
-                            "segmentation": maskUtils.encode(np.asfortranarray(final_masks[:, :, det_id]))
                         }
+                        if final_masks is not None and has_mask[det_id]:
+                            curr_result["segmentation"] = \
+                                maskUtils.encode(np.asfortranarray(final_masks[:, :, det_id]))
                     elif mode == 'visualize':
                         final_feat = output_value[det_id]
                         curr_result = {
@@ -491,6 +527,11 @@ def test_model(input_model, valset, coco_api, limit=-1, image_ids=None, **args):
             print_log('Saving results to {:s}'.format(vis_file_name), log_file, additional_file=train_log_file)
             torch.save({'feat_result': results}, vis_file_name)
 
+    if do_shard and shard_id >= 0:
+        # evaluation is left to the merge step
+        print_log('[SHARD {:d}/{:d}] Done!'.format(shard_id, shard_num), log_file)
+        return
+
     # evaluate on COCO
     if not model.config.TSNE.SKIP_INFERENCE:
         # Evaluate
@@ -528,7 +569,7 @@ def test_model(input_model, valset, coco_api, limit=-1, image_ids=None, **args):
         # TODO (mid): apply multi-gpu in training TSNE
         tsne_model = VTSNE(n_points, model.config.TSNE.N_TOPICS, pt_ver=pt_ver)
         if pt_ver == '0.3':
-            tsne_model = tsne_model.cuda()
+            tsne_model = to_device(tsne_model, model.config)
         elif pt_ver == '0.4':
             # model = model.to(device)
             raise NotImplementedError
@@ -550,7 +591,7 @@ def test_model(input_model, valset, coco_api, limit=-1, image_ids=None, **args):
             # fixme: remove the chunks method
             for data_batch in chunks(batch_size, pij, i, j):
                 if pt_ver == '0.3':
-                    data_batch = [Variable(torch.from_numpy(data).cuda()) for data in data_batch]
+                    data_batch = [Variable(to_device(torch.from_numpy(data), model.config)) for data in data_batch]
                 elif pt_ver == '0.4':
                     pass
                 optimizer.zero_grad()
@@ -609,130 +650,174 @@ def test_model(input_model, valset, coco_api, limit=-1, image_ids=None, **args):
         print_log('Done with training tsne; check the folder: {}!'.format(vis_res_figure), log_file)
 
 
-def _mold_inputs(model, image_ids, dataset):
-    """
-        FOR EVALUATION ONLY.
-        Takes a list of images and modifies them to the format expected as an input to the neural network.
-        images: List of image matrices [height,width,depth]. Images can have different sizes.
-
-        Returns 3 Numpy matrices:
-            molded_images: [N, h, w, 3]. Images resized and normalized.
-            image_metas: [N, length of meta datasets]. Details about each image.
-            windows: [N, (y1, x1, y2, x2)]. The portion of the image that has the
-            original image (padding excluded).
-    """
-    molded_images = []
-    image_metas = []
-    windows = []
-    images = []
-
-    for curr_id in image_ids:
-        image = dataset.load_image(curr_id)
-        # Resize image to fit the model expected size
-        molded_image, window, scale, padding = resize_image(
-            image, min_dim=model.config.DATA.IMAGE_MIN_DIM,
-            max_dim=model.config.DATA.IMAGE_MAX_DIM, padding=model.config.DATA.IMAGE_PADDING)
-        molded_image = molded_image.astype(np.float32) - model.config.DATA.MEAN_PIXEL
-
-        # Build image_meta
-        image_meta = compose_image_meta(0, image.shape, window,
-                                        np.zeros([model.config.DATASET.NUM_CLASSES], dtype=np.int32), 0)
-        # Append
-        molded_images.append(molded_image)
-        windows.append(window)
-        image_metas.append(image_meta)
-        images.append(image)
-
-    # Pack into arrays
-    molded_images = np.stack(molded_images)
-    image_metas = np.stack(image_metas)
-    windows = np.stack(windows)
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff')
+TAR_EXTENSIONS = ('.tar', '.tar.gz', '.tgz')
 
-    # Convert images to torch tensor
-    molded_images = torch.from_numpy(molded_images.transpose(0, 3, 1, 2)).float()
-    molded_images = Variable(molded_images.cuda(), volatile=True)
-    image_metas = Variable(torch.from_numpy(image_metas).cuda(), volatile=True)
 
-    return molded_images, image_metas, windows, images
+def stream_model(input_model, source, output_file=None):
+    """
+        Run detection over a (possibly huge) stream of images; no Dataset or annotations needed.
+        Images are decoded and molded lazily by a thread pool, consumed in fixed-size batches of TEST.BATCH_SIZE
+        and results are appended to a JSON-lines file; at most TEST.STREAM_PREFETCH_BATCHES batches are in flight,
+        so memory stays bounded regardless of the input size.
+        Args:
+            input_model:    nn.DataParallel
+            source:         comma-separated list of image folders and/or tar shards (folders may hold tar shards)
+            output_file:    JSON-lines file; one line per image {"file", "rois", "class_ids", "scores", "masks"}
+    """
+    if isinstance(input_model, nn.DataParallel):
+        model = input_model.module
+    else:
+        # single-gpu
+        model = input_model
+    assert source, 'no input for streaming; set TEST.STREAM_INPUT (folders and/or tar shards)'
+    config = model.config
+    log_file = config.MISC.LOG_FILE
+    output_file = output_file or config.MISC.DET_RESULT_FILE
+    test_bs = config.TEST.BATCH_SIZE
+    max_in_flight = test_bs * max(config.TEST.STREAM_PREFETCH_BATCHES, 1)
+
+    print_log('[STREAM] reading from {:s}; writing results to {:s}'.format(source, output_file), log_file)
+    executor = ThreadPoolExecutor(max_workers=config.TEST.STREAM_DECODE_WORKERS)
+    pending = deque()
+    cnt, t_start = 0, time.time()
+    image_iter = _iter_stream_images(source.split(','))
+
+    with open(output_file, 'w') as f:
+        while True:
+            # keep the decode pool busy without reading ahead more than max_in_flight images
+            while len(pending) < max_in_flight:
+                item = next(image_iter, None)
+                if item is None:
+                    break
+                pending.append((item[0], executor.submit(_decode_and_mold, item[1], config)))
+            if len(pending) == 0:
+                break
+
+            names, molded_images, image_metas, windows, image_shapes = [], [], [], [], []
+            while len(pending) > 0 and len(names) < test_bs:
+                name, future = pending.popleft()
+                try:
+                    molded_image, image_meta, window, image_shape = future.result()
+                except Exception as e:
+                    print_log('[STREAM] skip {:s}: {}'.format(name, e), log_file)
+                    continue
+                names.append(name)
+                molded_images.append(molded_image)
+                image_metas.append(image_meta)
+                windows.append(window)
+                image_shapes.append(image_shape)
+            if len(names) == 0:
+                continue
+            # pad the last batch so that the model always sees TEST.BATCH_SIZE images
+            actual_bs = len(names)
+            molded_images += [molded_images[-1]] * (test_bs - actual_bs)
+            image_metas += [image_metas[-1]] * (test_bs - actual_bs)
+
+            molded_images = torch.from_numpy(np.stack(molded_images).transpose(0, 3, 1, 2)).float()
+            molded_images = Variable(to_device(molded_images, config), volatile=True)
+            image_metas = Variable(to_device(torch.from_numpy(np.stack(image_metas)), config), volatile=True)
+            outputs = input_model([molded_images, image_metas], mode='inference')
+            detections = outputs[0].data.cpu().numpy()
+            mrcnn_mask = outputs[1].data.cpu().numpy() if len(outputs) > 1 else None
+
+            for i in range(actual_bs):
+                final_rois, final_class_ids, final_scores, final_masks = unmold_detections(
+                    detections[i], mrcnn_mask[i] if mrcnn_mask is not None else None, image_shapes[i], windows[i])
+                curr_result = encode_detections(final_rois, final_class_ids, final_scores, final_masks,
+                                                config.TEST.MASK_MIN_SCORE)
+                curr_result['file'] = names[i]
+                f.write(json.dumps(curr_result) + '\n')
+            f.flush()
+
+            cnt += actual_bs
+            if (cnt // test_bs) % config.CTRL.SHOW_INTERVAL == 0:
+                print_log('[STREAM] {:d} images done, {:.4f} sec/image ...'.format(
+                    cnt, (time.time() - t_start) / cnt), log_file)
+
+    executor.shutdown()
+    print_log('[STREAM] Done! {:d} images in {:.4f} sec'.format(cnt, time.time() - t_start), log_file)
+
+
+def encode_detections(rois, class_ids, scores, masks, mask_min_score=0.):
+    """Convert the unmolded detections of one image to a json-serializable dict; masks (if any) are COCO RLE,
+    None for the detections below mask_min_score (TEST.MASK_MIN_SCORE) that got no mask."""
+    output = {
+        'rois':         rois.tolist(),
+        'class_ids':    class_ids.tolist(),
+        'scores':       scores.tolist(),
+    }
+    if masks is not None:
+        rles = []
+        has_mask = mask_computed(scores, mask_min_score)
+        for i in range(len(rois)):
+            if not has_mask[i]:
+                rles.append(None)
+                continue
+            rle = maskUtils.encode(np.asfortranarray(masks[:, :, i]))
+            rle['counts'] = rle['counts'].decode('ascii')
+            rles.append(rle)
+        output['masks'] = rles
+    return output
+
+
+def _iter_stream_images(sources):
+    """Yield (name, path or raw bytes) for every image under the sources, lazily and in a stable order."""
+    for source in sources:
+        if source.endswith(TAR_EXTENSIONS):
+            # streaming mode; members are read one at a time
+            with tarfile.open(source, mode='r|*') as tar:
+                for member in tar:
+                    if member.isfile() and member.name.lower().endswith(IMAGE_EXTENSIONS):
+                        yield '{:s}/{:s}'.format(source, member.name), tar.extractfile(member).read()
+        elif os.path.isdir(source):
+            for root, dirs, files in os.walk(source):
+                dirs.sort()
+                for file_name in sorted(files):
+                    path = os.path.join(root, file_name)
+                    if file_name.lower().endswith(IMAGE_EXTENSIONS):
+                        yield path, path
+                    elif file_name.endswith(TAR_EXTENSIONS):
+                        for item in _iter_stream_images([path]):
+                            yield item
+        elif source.lower().endswith(IMAGE_EXTENSIONS):
+            yield source, source
+
+
+def _decode_and_mold(data, config):
+    """Decode one image (path or encoded bytes) and mold it; only the original shape is kept."""
+    image = skimage.io.imread(io.BytesIO(data) if isinstance(data, bytes) else data)
+    # If grayscale or with alpha channel, convert to RGB for consistency.
+    if image.ndim != 3:
+        image = np.stack([image] * 3, axis=-1)
+    image = image[:, :, :3]
+    molded_images, image_metas, windows = mold_inputs([image], config)
+    return molded_images[0], image_metas[0], windows[0], image.shape
+
+
+def _shard_file_name(det_res_file, shard_id, shard_num):
+    """det_result_xxx.pth -> det_result_xxx_shard_1_of_4.pth"""
+    return det_res_file.replace('.pth', '_shard_{:d}_of_{:d}.pth'.format(shard_id, shard_num))
 
 
-def _unmold_detections(detections, input_value, image_shape, window, inference=True):
+def _mold_inputs(model, image_ids, dataset):
     """
         FOR EVALUATION ONLY.
-        Re-formats the detections of one image from the format of the neural
-        network output to a format suitable for use in the rest of the application.
-
-            detections:     [100, (y1, x1, y2, x2, class_id, score)]
-            input_value:
-                            mrcnn_mask:     [100, height, width, num_classes]
-                            OR
-                            feature:        [100, 1025]
-
-            image_shape:    [height, width, depth] Original size of the image before resizing
-            window:         [y1, x1, y2, x2] Box in the image where the real image is excluding the padding.
+        Loads images from the dataset and modifies them to the format expected as an input to the neural network.
+        See mold_inputs() in tools/image_utils.py for details.
 
         Returns:
-            boxes:          [N (<=100; actual no. of detections), (y1, x1, y2, x2)] Bounding boxes in pixels
-            class_ids:      [N] Integer class IDs for each bounding box
-            scores:         [N] Float probability scores of the class_id
-            output_value:
-                            masks:          [height, width, num_instances] Instance masks
-                            OR
-                            final_feature
+            molded_images:  [N, 3, h, w] Variable. Images resized and normalized.
+            image_metas:    [N, length of meta datasets] Variable. Details about each image.
+            windows:        [N, (y1, x1, y2, x2)] Numpy. The portion of the image that has the original image.
+            images:         List of original image matrices.
     """
-    # TODO: (low) consider the batch size dim
-    # How many detections do we have?
-    # Detections array is padded with zeros. Find the first class_id == 0.
-    zero_ix = np.where(detections[:, 4] == 0)[0]
-    N = zero_ix[0] if zero_ix.shape[0] > 0 else detections.shape[0]
-
-    # Extract boxes, class_ids, scores, and class-specific masks
-    boxes = detections[:N, :4]
-    class_ids = detections[:N, 4].astype(np.int32)
-    scores = detections[:N, 5]
-    if inference:
-        masks = input_value[np.arange(N), :, :, class_ids]
-    else:
-        feature = input_value[:N]
-
-    # Compute scale and shift to translate coordinates to image domain.
-    h_scale = image_shape[0] / (window[2] - window[0])
-    w_scale = image_shape[1] / (window[3] - window[1])
-    scale = min(h_scale, w_scale)
-    shift = window[:2]  # y, x
-    scales = np.array([scale, scale, scale, scale])
-    shifts = np.array([shift[0], shift[1], shift[0], shift[1]])
-
-    # Translate bounding boxes to image domain
-    boxes = np.multiply(boxes - shifts, scales).astype(np.int32)
-
-    # **FILTER OUT** detections with zero area. Often only happens in early
-    # stages of training when the network weights are still a bit random.
-    exclude_ix = np.where(
-        (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1]) <= 0)[0]
-    if exclude_ix.shape[0] > 0:
-        boxes = np.delete(boxes, exclude_ix, axis=0)
-        class_ids = np.delete(class_ids, exclude_ix, axis=0)
-        scores = np.delete(scores, exclude_ix, axis=0)
-        if inference:
-            masks = np.delete(masks, exclude_ix, axis=0)
-        else:
-            feature = np.delete(feature, exclude_ix, axis=0)
-
-    if inference:
-        N = class_ids.shape[0]
-        # Resize masks to original image size and set boundary threshold.
-        full_masks = []
-        for i in range(N):
-            # Convert neural network mask to full size mask
-            full_mask = unmold_mask(masks[i], boxes[i], image_shape)
-            full_masks.append(full_mask)
-        full_masks = np.stack(full_masks, axis=-1)\
-            if full_masks else np.empty((0,) + masks.shape[1:3])
-        output_value = full_masks
-    else:
-        area = (boxes[:, 0] - boxes[:, 2]) * (boxes[:, 1] - boxes[:, 3]) / (image_shape[0]*image_shape[1])
-        output_value = np.concatenate((feature, np.expand_dims(area, axis=1)), axis=1)
+    images = [dataset.load_image(curr_id) for curr_id in image_ids]
+    molded_images, image_metas, windows = mold_inputs(images, model.config)
 
-    return boxes, class_ids, scores, output_value
+    # Convert images to torch tensor
+    molded_images = torch.from_numpy(molded_images.transpose(0, 3, 1, 2)).float()
+    molded_images = Variable(to_device(molded_images, model.config), volatile=True)
+    image_metas = Variable(to_device(torch.from_numpy(image_metas), model.config), volatile=True)
 
+    return molded_images, image_metas, windows, images
@@ -1,6 +1,6 @@
 import argparse
 from lib.config import CocoConfig
-from lib.workflow import train_model, test_model
+from lib.workflow import train_model, test_model, stream_model
 from datasets.dataset_coco import get_data
 from tools.visualize import Visualizer
 from lib.model import MaskRCNN
@@ -14,7 +14,7 @@ if __name__ == '__main__':
                         # default='train',
                         # default='inference',
                         default='visualize',          # it is inference
-                        help='train or inference')
+                        help='train, inference, visualize or stream')
 
     parser.add_argument('--config_name',
                         required=False,
@@ -48,8 +48,11 @@ if __name__ == '__main__':
 
     # Configuration
     config = CocoConfig(args)
-    # Get data
-    train_data, val_data, val_api = get_data(config)
+    # Get data (phase 'stream' reads raw images from TEST.STREAM_INPUT; no coco dataset needed)
+    if args.phase == 'stream':
+        train_data, val_data, val_api = None, None, None
+    else:
+        train_data, val_data, val_api = get_data(config)
 
     # Create model
     print('building network ...\n')
@@ -66,7 +69,7 @@ if __name__ == '__main__':
     config, model = update_config_and_load_model(config, model, train_data)
 
     # Visualizer
-    vis = Visualizer(config, model, val_data)
+    vis = Visualizer(config, model, val_data) if args.phase != 'stream' else None
 
     print_log('print network structure in log file [NOT shown in terminal] ...', config.MISC.LOG_FILE)
     print_log(model, config.MISC.LOG_FILE, quiet_termi=True)
@@ -95,6 +98,10 @@ if __name__ == '__main__':
     elif args.phase == 'inference' or args.phase == 'visualize':
 
         test_model(model, val_data, val_api, during_train=False, vis=vis)
+
+    elif args.phase == 'stream':
+
+        stream_model(model, config.TEST.STREAM_INPUT)
     else:
         print("'{}' is not recognized. "
               "Use 'train' or 'evaluate'".format(args.phase))
@@ -0,0 +1,42 @@
+#!/usr/bin/env bash
+
+# minival mAP and latency of the detection-head nms: exact greedy (conduct_nms) vs. Fast NMS (conduct_fast_nms).
+# Each method writes its own log / det_result file under results/<config_name>/inference/; the output of each
+# run is also kept in $OUT_DIR, and at the end the bbox AP (COCOeval, IoU=0.50:0.95) and the "Average ... sec/image"
+# line of both runs are printed as one table, together with the config and the gpu.
+# For the nms op alone (no network), see: python -m tools.benchmark_nms --det_head
+#
+# NOTE: remove an existing det_result_*.pth of the model first; otherwise inference loads it, skips the
+# prediction and no sec/image is reported for that method.
+#
+# Results: NOT recorded; the comparison requested for TEST.NMS_METHOD 'fast' is still open. It has to be run on
+# a gpu with COCO minival and a trained checkpoint (none was available where 'fast' was added), then the table
+# printed at the end pasted here:
+#
+#   method   bbox AP (minival)  sec/image    config / gpu
+#   greedy   -                  -            -
+#   fast     -                  -            -
+DEVICE_ID=0
+config_file=configs/105/meta_105_quick_1_roipool.yaml
+OUT_DIR=results/compare_nms_method
+mkdir -p $OUT_DIR
+
+for method in greedy fast; do
+    CUDA_VISIBLE_DEVICES=$DEVICE_ID python main.py \
+        --device_id=$DEVICE_ID \
+        --phase=inference \
+        --config_name=None \
+        --debug=0 \
+        --config_file=$config_file \
+        TEST.NMS_METHOD $method 2>&1 | tee $OUT_DIR/$method.txt
+done
+
+GPU=$(nvidia-smi --query-gpu=name --format=csv,noheader -i $DEVICE_ID 2>/dev/null)
+printf '\nconfig: %s, gpu: %s\n' "$config_file" "${GPU:-unknown}"
+printf '%-8s %-18s %s\n' method 'bbox AP (minival)' sec/image
+for method in greedy fast; do
+    AP=$(grep -m 1 'Average Precision  (AP) @\[ IoU=0.50:0.95 | area=   all | maxDets=100 \]' $OUT_DIR/$method.txt \
+        | awk '{print $NF}')
+    SEC=$(grep -m 1 'sec/image' $OUT_DIR/$method.txt | sed 's/.*Average \([0-9.]*\) sec\/image.*/\1/')
+    printf '%-8s %-18s %s\n' $method "${AP:--}" "${SEC:--}"
+done
@@ -0,0 +1,42 @@
+#!/usr/bin/env bash
+
+# Sharded evaluation: one inference process per device, each on its own slice of the val images;
+# then a merge step concatenates the result shards and runs COCOeval once.
+# For cpu-only machines set DEVICE=cpu; each shard is then pinned to CORES_PER_SHARD cores.
+DEVICE_ID=0,1,2,3
+DEVICE=cuda
+CORES_PER_SHARD=8
+config_file=configs/105/meta_105_quick_1_roipool.yaml
+
+IFS=',' read -r -a DEVICES <<< "$DEVICE_ID"
+SHARD_NUM=${#DEVICES[@]}
+
+for ((k=0; k<SHARD_NUM; k++)); do
+    if [ "$DEVICE" == "cpu" ]; then
+        PIN="taskset -c $((k*CORES_PER_SHARD))-$((k*CORES_PER_SHARD+CORES_PER_SHARD-1))"
+        export OMP_NUM_THREADS=$CORES_PER_SHARD
+    else
+        PIN=""
+    fi
+    CUDA_VISIBLE_DEVICES=${DEVICES[$k]} $PIN python main.py \
+        --device_id=${DEVICES[$k]} \
+        --phase=inference \
+        --config_name=None \
+        --debug=0 \
+        --config_file=$config_file \
+        MISC.DEVICE $DEVICE \
+        TEST.SHARD_NUM $SHARD_NUM \
+        TEST.SHARD_ID $k &
+done
+wait
+
+# merge and evaluate
+CUDA_VISIBLE_DEVICES=${DEVICES[0]} python main.py \
+    --device_id=${DEVICES[0]} \
+    --phase=inference \
+    --config_name=None \
+    --debug=0 \
+    --config_file=$config_file \
+    MISC.DEVICE $DEVICE \
+    TEST.SHARD_NUM $SHARD_NUM \
+    TEST.SHARD_ID -1
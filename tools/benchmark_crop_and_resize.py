@@ -0,0 +1,76 @@
+"""Speed of the cpu crop_and_resize (roi align) kernels against the number of threads.
+
+Workloads mimic the RoI heads: 1000 RoIs on a 256-channel map, cropped to 7x7 (classifier), 14x14 (mask head)
+and 28x28 (mask targets). Forward and backward are timed; outputs and input gradients are compared with the
+single-thread run (the backward accumulates per image/channel plane, so they should be identical).
+Usage:
+    python -m tools.benchmark_crop_and_resize --threads 1,2,4,8 --repeat 5
+"""
+import time
+import argparse
+
+import numpy as np
+import torch
+from torch.autograd import Variable
+
+from lib.roi_align.crop_and_resize import CropAndResizeFunction, set_num_threads
+
+CROP_SIZES = [7, 14, 28]
+
+
+def make_inputs(bs, depth, height, width, box_num, seed=0):
+    """Feature maps and normalized (y1, x1, y2, x2) boxes of mixed sizes, as the proposals are."""
+    rng = np.random.RandomState(seed)
+    image = torch.from_numpy(rng.randn(bs, depth, height, width).astype(np.float32))
+    ctr = rng.uniform(0, 1, size=(box_num, 2))
+    hw = rng.uniform(0.02, 0.5, size=(box_num, 2))
+    boxes = np.concatenate([ctr - hw / 2, ctr + hw / 2], axis=1).clip(0, 1)
+    box_ind = rng.randint(0, bs, size=box_num)
+    return image, torch.from_numpy(boxes.astype(np.float32)), torch.from_numpy(box_ind.astype(np.int32))
+
+
+def _run(image, boxes, box_ind, crop_size, repeat):
+    fwd_ms, bwd_ms = 0., 0.
+    for i in range(repeat + 1):
+        _image = Variable(image, requires_grad=True)
+        t = time.time()
+        crops = CropAndResizeFunction(crop_size, crop_size)(_image, Variable(boxes), Variable(box_ind))
+        t_fwd = time.time()
+        crops.backward(torch.ones_like(crops.data))
+        t_bwd = time.time()
+        if i > 0:   # the first run is a warm-up
+            fwd_ms += (t_fwd - t) * 1000. / repeat
+            bwd_ms += (t_bwd - t_fwd) * 1000. / repeat
+    return crops.data, _image.grad.data, fwd_ms, bwd_ms
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='cpu crop_and_resize benchmark')
+    parser.add_argument('--threads', default='1,2,4,8', type=str)
+    parser.add_argument('--repeat', default=5, type=int)
+    parser.add_argument('--bs', default=2, type=int)
+    parser.add_argument('--depth', default=256, type=int)
+    parser.add_argument('--height', default=128, type=int)
+    parser.add_argument('--width', default=128, type=int)
+    parser.add_argument('--box_num', default=1000, type=int)
+    args = parser.parse_args()
+
+    thread_nums = [int(n) for n in args.threads.split(',')]
+    image, boxes, box_ind = make_inputs(args.bs, args.depth, args.height, args.width, args.box_num)
+    for crop_size in CROP_SIZES:
+        base = None
+        for num_threads in thread_nums:
+            set_num_threads(num_threads)
+            crops, grad, fwd_ms, bwd_ms = _run(image, boxes, box_ind, crop_size, args.repeat)
+            msg = '[{:d}x{:d}] boxes {:d}, map {}x{:d}x{:d}x{:d}, threads {:d}: forward {:.1f} ms, backward {:.1f} ms'\
+                .format(crop_size, crop_size, args.box_num, args.bs, args.depth, args.height, args.width,
+                        num_threads, fwd_ms, bwd_ms)
+            if base is None:
+                base = (crops, grad, fwd_ms, bwd_ms)
+            else:
+                same = bool((crops == base[0]).all()) and bool((grad == base[1]).all())
+                msg += ' (speedup {:.1f}x / {:.1f}x; identical to {:d} thread(s): {})'.format(
+                    base[2] / fwd_ms, base[3] / bwd_ms, thread_nums[0], same)
+            print(msg)
+    set_num_threads(0)
@@ -0,0 +1,137 @@
+"""Compare the nms backends (compiled lib/nms/_ext vs. tensor-op py_nms): keep indices and speed.
+
+Workloads mimic proposal_layer (6000 boxes, threshold 0.7) and detection_layer (1000 boxes, threshold 0.3).
+'torch' (py_nms) must keep exactly the same indices as 'ext' on each device (it suppresses on IoU >= thres on cpu
+like cpu_nms, on IoU > thres on gpu like the ext cuda kernel). With cuda, the batched nms (nms_batch, bs > 1) of
+each backend is also checked to keep the same boxes on cpu and gpu.
+Exits non-zero if any keep indices differ, or if the ext backend is not built (then py_nms is not checked).
+With --det_head, also compare the detection-head nms methods (TEST.NMS_METHOD): exact greedy conduct_nms vs.
+Fast NMS conduct_fast_nms, on a batch of class-labelled boxes; for the mAP side see script/compare_nms_method.sh.
+Usage:
+    python -m tools.benchmark_nms --repeat 20 [--det_head]
+"""
+import sys
+import time
+import argparse
+
+import numpy as np
+import torch
+
+from lib.nms.pth_nms import pth_nms, EXT_AVAILABLE
+from lib.nms.py_nms import py_nms
+from lib.nms.nms_wrapper import nms_batch, set_nms_backend
+from tools.collections import AttrDict
+
+WORKLOADS = [
+    # name, box number, nms threshold
+    ('rpn', 6000, 0.7),
+    ('detection', 1000, 0.3),
+]
+
+
+def make_boxes(num, image_size=1024, object_num=50, seed=0):
+    """Boxes jittered around a few objects (as real proposals are), (y1, x1, y2, x2, score) float32."""
+    rng = np.random.RandomState(seed)
+    centers = rng.uniform(0, image_size, size=(object_num, 2))
+    sizes = rng.uniform(16, 256, size=(object_num, 2))
+    obj = rng.randint(0, object_num, size=num)
+    ctr = centers[obj] + rng.normal(0, 8, size=(num, 2))
+    hw = sizes[obj] * rng.uniform(0.8, 1.2, size=(num, 2))
+    boxes = np.concatenate([ctr - hw / 2, ctr + hw / 2], axis=1).clip(0, image_size)
+    scores = rng.uniform(0, 1, size=(num, 1))
+    return torch.from_numpy(np.concatenate([boxes, scores], axis=1).astype(np.float32))
+
+
+def _time(func, dets, thresh, repeat, cuda):
+    keep = func(dets, thresh)
+    if cuda:
+        torch.cuda.synchronize()
+    t = time.time()
+    for _ in range(repeat):
+        keep = func(dets, thresh)
+    if cuda:
+        torch.cuda.synchronize()
+    return keep.cpu(), (time.time() - t) / repeat * 1000.
+
+
+def same_keep(keep_a, keep_b):
+    return keep_a.numel() == keep_b.numel() and bool((keep_a == keep_b).all())
+
+
+def check_batch(backend, bs=4, num=6000, thresh=0.7):
+    """Keep indices of nms_batch on cpu vs. gpu, boxes of bs images flattened (only sorted within an image).
+    Returns True if they are identical."""
+    set_nms_backend(backend)
+    dets = torch.stack([make_boxes(num, seed=i) for i in range(bs)], dim=0)
+    cpu_keep = nms_batch(dets, thresh)
+    gpu_keep = nms_batch(dets.cuda(), thresh).cpu()
+    same = same_keep(cpu_keep, gpu_keep)
+    print('[batch][{:s}] bs {:d}, boxes {:d}/image: cpu keep {:d}, gpu keep {:d}; identical keep: {}'.format(
+        backend, bs, num, cpu_keep.numel(), gpu_keep.numel(), same))
+    set_nms_backend('auto')
+    return same
+
+
+def bench_det_head(repeat, device, bs=8, box_num=1000, class_num=81):
+    """Latency of conduct_nms vs. conduct_fast_nms and how many detections the two keep in common."""
+    from torch.autograd import Variable
+    from lib.layers import conduct_nms, conduct_fast_nms
+
+    config = AttrDict()
+    config.DATASET = AttrDict(NUM_CLASSES=class_num)
+    config.TEST = AttrDict(DET_NMS_THRESHOLD=0.3, DET_MAX_INSTANCES=100)
+    dets = torch.cat([make_boxes(box_num, seed=i) for i in range(bs)], dim=0)
+    rng = np.random.RandomState(0)
+    class_ids = torch.from_numpy(rng.randint(0, class_num, size=bs * box_num)).long()
+    if device == 'cuda':
+        dets, class_ids = dets.cuda(), class_ids.cuda()
+    args = (Variable(class_ids), Variable(dets[:, :4].round()), Variable(dets[:, 4]),
+            Variable(class_ids > 0), config, box_num)
+
+    greedy, greedy_ms = _time(lambda *_: conduct_nms(*args)[0], None, None, repeat, device == 'cuda')
+    fast, fast_ms = _time(lambda *_: conduct_fast_nms(*args)[0], None, None, repeat, device == 'cuda')
+    common = len(set(greedy.tolist()) & set(fast.tolist()))
+    print('[det_head][{:s}] bs {:d}, boxes {:d}/image: greedy {:.2f} ms (keep {:d}); fast {:.2f} ms (keep {:d}); '
+          'common {:d}'.format(device, bs, box_num, greedy_ms, greedy.numel(), fast_ms, fast.numel(), common))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='nms backend benchmark')
+    parser.add_argument('--repeat', default=20, type=int)
+    parser.add_argument('--det_head', action='store_true', help='also compare TEST.NMS_METHOD greedy vs. fast')
+    args = parser.parse_args()
+
+    devices = ['cpu'] + (['cuda'] if torch.cuda.is_available() else [])
+    mismatches = []
+    for name, num, thresh in WORKLOADS:
+        dets = make_boxes(num)
+        for device in devices:
+            cuda = device == 'cuda'
+            curr_dets = dets.cuda() if cuda else dets
+            py_keep, py_ms = _time(py_nms, curr_dets, thresh, args.repeat, cuda)
+            msg = '[{:s}][{:s}] boxes {:d}, thres {:.1f}: torch {:.2f} ms (keep {:d})'.format(
+                name, device, num, thresh, py_ms, py_keep.numel())
+            if EXT_AVAILABLE:
+                ext_keep, ext_ms = _time(pth_nms, curr_dets, thresh, args.repeat, cuda)
+                same = same_keep(ext_keep, py_keep)
+                msg += '; ext {:.2f} ms (keep {:d}); identical keep: {}'.format(ext_ms, ext_keep.numel(), same)
+                if not same:
+                    mismatches.append('{:s}/{:s}'.format(name, device))
+            else:
+                msg += '; ext not built'
+            print(msg)
+
+    if torch.cuda.is_available():
+        for backend in ['torch'] + (['ext'] if EXT_AVAILABLE else []):
+            if not check_batch(backend):
+                mismatches.append('batch/{:s}'.format(backend))
+
+    if args.det_head:
+        for device in devices:
+            bench_det_head(args.repeat, device)
+
+    if mismatches:
+        sys.exit('keep indices differ: {:s}'.format(', '.join(mismatches)))
+    if not EXT_AVAILABLE:
+        sys.exit('lib/nms/_ext is not built: keep indices of py_nms were not checked against the C nms')
@@ -47,7 +47,7 @@ def clip_boxes(boxes, window):
         # for inference, batch size sensitive
         bs = window.size(0)
         boxes = boxes.view(bs, -1, 4)
-        boxes_out = Variable(torch.zeros(boxes.size()).cuda())
+        boxes_out = Variable(boxes.data.new(boxes.size()).zero_())
         for i in range(bs):
             boxes_out[i] = torch.stack([
                 boxes[i, :, 0].clamp(window[i, 0].data[0], window[i, 2].data[0]),
@@ -111,33 +111,73 @@ def box_refinement(box, gt_box):
 
 
 def compute_iou(boxes1, boxes2):
-    # 1. Tile boxes2 and repeat boxes1. This allows us to compare
-    # every boxes1 against every boxes2 without loops.
-    # TF doesn't have an equivalent to np.repeat() so simulate it
-    # using tf.tile() and tf.reshape.
-    boxes1_repeat = boxes2.size()[0]
-    boxes2_repeat = boxes1.size()[0]
-    boxes1 = boxes1.repeat(1, boxes1_repeat).view(-1, 4)
-    boxes2 = boxes2.repeat(boxes2_repeat, 1)
-    # 2. Compute intersections
-    b1_y1, b1_x1, b1_y2, b1_x2 = boxes1.chunk(4, dim=1)
-    b2_y1, b2_x1, b2_y2, b2_x2 = boxes2.chunk(4, dim=1)
-    y1 = torch.max(b1_y1, b2_y1)[:, 0]
-    x1 = torch.max(b1_x1, b2_x1)[:, 0]
-    y2 = torch.min(b1_y2, b2_y2)[:, 0]
-    x2 = torch.min(b1_x2, b2_x2)[:, 0]
-    zeros = Variable(torch.zeros(y1.size(0)), requires_grad=False)
-    if y1.is_cuda:
-        zeros = zeros.cuda()
-    intersection = torch.max(x2 - x1, zeros) * torch.max(y2 - y1, zeros)
-    # 3. Compute unions
+    """IoU of every pair by broadcasting; the pairwise (repeated) boxes are never materialized.
+    Args:
+        boxes1: [(bs, optional), N1, (y1, x1, y2, x2)] Tensor
+        boxes2: [(bs, optional), N2, (y1, x1, y2, x2)] Tensor; same number of dims as boxes1,
+                    bs dims broadcast (1 vs. bs)
+    Returns:
+        overlaps: [(bs, optional), N1, N2]
+    """
+    coord_dim = boxes1.dim()   # after unsqueeze below
+    b1_y1, b1_x1, b1_y2, b1_x2 = boxes1.unsqueeze(coord_dim - 1).chunk(4, dim=coord_dim)   # N1, 1, 1
+    b2_y1, b2_x1, b2_y2, b2_x2 = boxes2.unsqueeze(coord_dim - 2).chunk(4, dim=coord_dim)   # 1, N2, 1
+    # 1. Compute intersections
+    y1 = torch.max(b1_y1, b2_y1)
+    x1 = torch.max(b1_x1, b2_x1)
+    y2 = torch.min(b1_y2, b2_y2)
+    x2 = torch.min(b1_x2, b2_x2)
+    intersection = (x2 - x1).clamp(min=0) * (y2 - y1).clamp(min=0)
+    # 2. Compute unions
     b1_area = (b1_y2 - b1_y1) * (b1_x2 - b1_x1)
     b2_area = (b2_y2 - b2_y1) * (b2_x2 - b2_x1)
-    union = b1_area[:, 0] + b2_area[:, 0] - intersection
-    # 4. Compute IoU and reshape to [boxes1, boxes2]
+    union = b1_area + b2_area - intersection
+    # 3. Compute IoU, [N1, N2]
     iou = intersection / (union + EPS)
-    overlaps = iou.view(boxes2_repeat, boxes1_repeat)
-    return overlaps
+    return iou.squeeze(coord_dim)
+
+
+def np_bbox_overlaps(boxes1, boxes2, chunk_size=0):
+    """numpy version of bbox_overlaps (same convention, no +1; no bs dim); used in the data loader workers.
+    Args:
+        boxes1: [N1, (y1, x1, y2, x2)]
+        boxes2: [N2, (y1, x1, y2, x2)]
+        chunk_size: if > 0, boxes1 are processed chunk_size boxes at a time
+    Returns:
+        overlaps: [N1, N2] float32
+    """
+    boxes1, boxes2 = boxes1.astype(np.float32), boxes2.astype(np.float32)
+    if 0 < chunk_size < boxes1.shape[0]:
+        return np.concatenate([np_bbox_overlaps(boxes1[i:i + chunk_size], boxes2)
+                               for i in range(0, boxes1.shape[0], chunk_size)], axis=0)
+    y1 = np.maximum(boxes1[:, None, 0], boxes2[None, :, 0])
+    x1 = np.maximum(boxes1[:, None, 1], boxes2[None, :, 1])
+    y2 = np.minimum(boxes1[:, None, 2], boxes2[None, :, 2])
+    x2 = np.minimum(boxes1[:, None, 3], boxes2[None, :, 3])
+    intersection = np.maximum(x2 - x1, 0) * np.maximum(y2 - y1, 0)
+    b1_area = (boxes1[:, 2] - boxes1[:, 0]) * (boxes1[:, 3] - boxes1[:, 1])
+    b2_area = (boxes2[:, 2] - boxes2[:, 0]) * (boxes2[:, 3] - boxes2[:, 1])
+    union = b1_area[:, None] + b2_area[None, :] - intersection
+    return intersection / (union + EPS)
+
+
+def np_box_refinement(box, gt_box):
+    """numpy version of box_refinement. box and gt_box are [N, (y1, x1, y2, x2)]"""
+    height = box[:, 2] - box[:, 0]
+    width = box[:, 3] - box[:, 1]
+    center_y = box[:, 0] + 0.5 * height
+    center_x = box[:, 1] + 0.5 * width
+
+    gt_height = gt_box[:, 2] - gt_box[:, 0]
+    gt_width = gt_box[:, 3] - gt_box[:, 1]
+    gt_center_y = gt_box[:, 0] + 0.5 * gt_height
+    gt_center_x = gt_box[:, 1] + 0.5 * gt_width
+
+    dy = (gt_center_y - center_y) / height
+    dx = (gt_center_x - center_x) / width
+    dh = np.log(gt_height / height)
+    dw = np.log(gt_width / width)
+    return np.stack([dy, dx, dh, dw], axis=1)
 
 
 # def np_compute_iou(box, boxes, box_area, boxes_area):
@@ -160,37 +200,39 @@ def compute_iou(boxes1, boxes2):
 #     return iou
 
 
-def bbox_overlaps(boxes1, boxes2):
+def bbox_overlaps(boxes1, boxes2, chunk_size=0):
     """Computes IoU overlaps between two sets of boxes.
     Args:
-        boxes1: [(bs, optional), N, (y1, x1, y2, x2)]
-        boxes2: [(bs, optional), N, (y1, x1, y2, x2)]
+        boxes1: [(bs, optional), N1, (y1, x1, y2, x2)] Variable or Tensor
+        boxes2: [(bs, optional), N2, (y1, x1, y2, x2)]; if only one of them has the bs dim, the other one
+                    is shared by all samples
+        chunk_size: if > 0, boxes1 are processed chunk_size boxes at a time, so that the temporaries of
+                    compute_iou stay at [bs, chunk_size, N2] (see MISC.IOU_CHUNK_SIZE)
+    Returns:
+        overlaps: [(bs, optional), N1, N2]; no grad (Variable if the inputs are)
     """
-
-    # if isinstance(boxes1, np.ndarray):
-    #     # numpy
-    #     # Areas of anchors and GT boxes
-    #     area1 = (boxes1[:, 2] - boxes1[:, 0]) * (boxes1[:, 3] - boxes1[:, 1])
-    #     area2 = (boxes2[:, 2] - boxes2[:, 0]) * (boxes2[:, 3] - boxes2[:, 1])
-    #     # Compute overlaps to generate matrix [boxes1 count, boxes2 count]
-    #     # Each cell contains the IoU value.
-    #     overlaps = np.zeros((boxes1.shape[0], boxes2.shape[0]))
-    #     for i in range(overlaps.shape[1]):
-    #         box2 = boxes2[i]
-    #         overlaps[:, i] = np_compute_iou(box2, boxes1, area2[i], area1)
-    #     return overlaps
-    #
-    # else:
-
-    # Variable
-    assert boxes1.dim() == boxes2.dim()
-    if boxes1.dim() == 3:
-        # has bs dim
-        overlaps = Variable(torch.zeros(boxes1.size(0), boxes1.size(1), boxes2.size(1)).cuda(),
-                            requires_grad=False)
-        for i in range(boxes1.size(0)):
-            overlaps[i] = compute_iou(boxes1[i], boxes2[i])
-    else:
+    is_var = isinstance(boxes1, Variable)
+    if is_var:
+        boxes1, boxes2 = boxes1.data, boxes2.data
+    if boxes1.dim() < boxes2.dim():
+        boxes1 = boxes1.unsqueeze(0)
+    elif boxes2.dim() < boxes1.dim():
+        boxes2 = boxes2.unsqueeze(0)
+
+    box_dim = boxes1.dim() - 2
+    n1 = boxes1.size(box_dim)
+    if chunk_size <= 0 or n1 <= chunk_size:
         overlaps = compute_iou(boxes1, boxes2)
-
+    else:
+        out_size = [n1, boxes2.size(box_dim)]
+        if box_dim == 1:
+            out_size = [max(boxes1.size(0), boxes2.size(0))] + out_size
+        overlaps = boxes1.new(*out_size)
+        for start in range(0, n1, chunk_size):
+            length = min(chunk_size, n1 - start)
+            overlaps.narrow(box_dim, start, length).copy_(
+                compute_iou(boxes1.narrow(box_dim, start, length), boxes2))
+
+    if is_var:
+        overlaps = Variable(overlaps, requires_grad=False)
     return overlaps
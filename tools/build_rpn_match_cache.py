@@ -0,0 +1,56 @@
+"""Precompute the anchor-gt match cache (RPN.MATCH_CACHE_DIR) of the train set, for both flip states.
+
+Training fills the cache lazily as well; running this once beforehand takes the matching out of the first epoch.
+Usage:
+    python -m tools.build_rpn_match_cache --config_name=base_101_new --workers 16 \
+        RPN.TARGET_IN_LOADER True RPN.MATCH_CACHE_DIR datasets/coco/rpn_match_1024
+"""
+import time
+import argparse
+from multiprocessing import Pool
+
+import numpy as np
+
+from lib.config import CocoConfig
+from datasets.dataset_coco import COCODataset
+import tools.image_utils as utils
+
+_dataset = None
+
+
+def _cache_one(image_index):
+    image_id = _dataset.dataset.image_ids[image_index]
+    for flip in (False, True):
+        _, _, gt_class_ids, gt_boxes, _ = utils.load_image_and_gt(
+            _dataset.dataset, _dataset.config, image_id, augment=True, flip=flip)
+        # images with too many instances are matched on the fly (their gt boxes are sub-sampled)
+        if np.any(gt_class_ids > 0) and gt_boxes.shape[0] <= _dataset.config.DATA.MAX_GT_INSTANCES:
+            _dataset.rpn_match(image_id, flip, gt_class_ids, gt_boxes)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='build the rpn anchor-gt match cache')
+    parser.add_argument('--config_name', default='rpn_match_cache')
+    parser.add_argument('--config_file', default=None)
+    parser.add_argument('--device_id', default='0', type=str)
+    parser.add_argument('--workers', default=8, type=int)
+    parser.add_argument('opts', help='See lib/config.py for all options', default=None, nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+    args.phase, args.debug = 'train', 0
+
+    config = CocoConfig(args)
+    assert config.RPN.MATCH_CACHE_DIR, 'set RPN.MATCH_CACHE_DIR (and RPN.TARGET_IN_LOADER True)'
+
+    _dataset = COCODataset(config)
+    _dataset.dataset.load_coco(config.DATASET.PATH, "train", year=config.DATASET.YEAR)
+    _dataset.dataset.load_coco(config.DATASET.PATH, "valminusminival", year=config.DATASET.YEAR)
+    _dataset.dataset.prepare()
+
+    t_start, total = time.time(), len(_dataset)
+    pool = Pool(args.workers)   # forked workers share _dataset
+    for cnt, _ in enumerate(pool.imap_unordered(_cache_one, range(total), chunksize=16), 1):
+        if cnt % 1000 == 0 or cnt == total:
+            print('[{:d}/{:d}] {:.1f} images/s'.format(cnt, total, cnt / (time.time() - t_start)))
+    pool.close()
+    pool.join()
@@ -1,8 +1,11 @@
+import os
 import random
+import zipfile
+import hashlib
 import numpy as np
 import scipy.misc
 import scipy.ndimage
-from tools.box_utils import extract_bboxes
+from tools.box_utils import extract_bboxes, np_bbox_overlaps, np_box_refinement
 
 
 def compose_image_meta(image_id, image_shape, window, active_class_ids, coco_image_id):
@@ -189,13 +192,140 @@ def unmold_mask(mask, bbox, image_shape):
     return full_mask
 
 
+def mold_inputs(images, config):
+    """Takes a list of images and modifies them to the format expected as an input to the neural network.
+        images: List of image matrices [height,width,depth]. Images can have different sizes.
+
+        Returns 3 Numpy matrices:
+            molded_images: [N, h, w, 3]. Images resized and normalized.
+            image_metas: [N, length of meta datasets]. Details about each image.
+            windows: [N, (y1, x1, y2, x2)]. The portion of the image that has the
+            original image (padding excluded).
+    """
+    molded_images = []
+    image_metas = []
+    windows = []
+
+    for image in images:
+        # Resize image to fit the model expected size
+        molded_image, window, scale, padding = resize_image(
+            image, min_dim=config.DATA.IMAGE_MIN_DIM,
+            max_dim=config.DATA.IMAGE_MAX_DIM, padding=config.DATA.IMAGE_PADDING)
+        molded_image = molded_image.astype(np.float32) - config.DATA.MEAN_PIXEL
+
+        # Build image_meta
+        image_meta = compose_image_meta(0, image.shape, window,
+                                        np.zeros([config.DATASET.NUM_CLASSES], dtype=np.int32), 0)
+        # Append
+        molded_images.append(molded_image)
+        windows.append(window)
+        image_metas.append(image_meta)
+
+    # Pack into arrays
+    molded_images = np.stack(molded_images)
+    image_metas = np.stack(image_metas)
+    windows = np.stack(windows)
+
+    return molded_images, image_metas, windows
+
+
+def unmold_detections(detections, input_value, image_shape, window, inference=True):
+    """
+        Re-formats the detections of one image from the format of the neural
+        network output to a format suitable for use in the rest of the application.
+
+            detections:     [100, (y1, x1, y2, x2, class_id, score)]
+            input_value:
+                            mrcnn_mask:     [100, height, width] mask of the predicted class; None for boxes only
+                            OR
+                            feature:        [100, 1025]
+
+            image_shape:    [height, width, depth] Original size of the image before resizing
+            window:         [y1, x1, y2, x2] Box in the image where the real image is excluding the padding.
+
+        Returns:
+            boxes:          [N (<=100; actual no. of detections), (y1, x1, y2, x2)] Bounding boxes in pixels
+            class_ids:      [N] Integer class IDs for each bounding box
+            scores:         [N] Float probability scores of the class_id
+            output_value:
+                            masks:          [height, width, num_instances] Instance masks; None for boxes only
+                            OR
+                            final_feature
+    """
+    # TODO: (low) consider the batch size dim
+    # How many detections do we have?
+    # Detections array is padded with zeros. Find the first class_id == 0.
+    zero_ix = np.where(detections[:, 4] == 0)[0]
+    N = zero_ix[0] if zero_ix.shape[0] > 0 else detections.shape[0]
+
+    # Extract boxes, class_ids, scores, and class-specific masks
+    boxes = detections[:N, :4]
+    class_ids = detections[:N, 4].astype(np.int32)
+    scores = detections[:N, 5]
+    with_mask = inference and input_value is not None
+    if with_mask:
+        masks = input_value[:N]
+    elif not inference:
+        feature = input_value[:N]
+
+    # Compute scale and shift to translate coordinates to image domain.
+    h_scale = image_shape[0] / (window[2] - window[0])
+    w_scale = image_shape[1] / (window[3] - window[1])
+    scale = min(h_scale, w_scale)
+    shift = window[:2]  # y, x
+    scales = np.array([scale, scale, scale, scale])
+    shifts = np.array([shift[0], shift[1], shift[0], shift[1]])
+
+    # Translate bounding boxes to image domain
+    boxes = np.multiply(boxes - shifts, scales).astype(np.int32)
+
+    # **FILTER OUT** detections with zero area. Often only happens in early
+    # stages of training when the network weights are still a bit random.
+    exclude_ix = np.where(
+        (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1]) <= 0)[0]
+    if exclude_ix.shape[0] > 0:
+        boxes = np.delete(boxes, exclude_ix, axis=0)
+        class_ids = np.delete(class_ids, exclude_ix, axis=0)
+        scores = np.delete(scores, exclude_ix, axis=0)
+        if with_mask:
+            masks = np.delete(masks, exclude_ix, axis=0)
+        elif not inference:
+            feature = np.delete(feature, exclude_ix, axis=0)
+
+    if inference and not with_mask:
+        output_value = None
+    elif inference:
+        N = class_ids.shape[0]
+        # Resize masks to original image size and set boundary threshold.
+        full_masks = []
+        for i in range(N):
+            # Convert neural network mask to full size mask
+            full_mask = unmold_mask(masks[i], boxes[i], image_shape)
+            full_masks.append(full_mask)
+        full_masks = np.stack(full_masks, axis=-1)\
+            if full_masks else np.zeros(tuple(image_shape[:2]) + (0,), dtype=np.uint8)
+        output_value = full_masks
+    else:
+        area = (boxes[:, 0] - boxes[:, 2]) * (boxes[:, 1] - boxes[:, 3]) / (image_shape[0]*image_shape[1])
+        output_value = np.concatenate((feature, np.expand_dims(area, axis=1)), axis=1)
+
+    return boxes, class_ids, scores, output_value
+
+
+def mask_computed(scores, mask_min_score):
+    """[N] bool, True for the detections that went through the mask head (score >= TEST.MASK_MIN_SCORE);
+    the masks of the others are empty and are left out of the segmentation results."""
+    return scores >= np.float32(mask_min_score)
+
+
 ############################################################
 #  Data Generator (called in __get_item__)
 ############################################################
-def load_image_and_gt(dataset, config, image_id, augment=False, use_mini_mask=False):
+def load_image_and_gt(dataset, config, image_id, augment=False, use_mini_mask=False, flip=None):
     """Load and return ground truth datasets for an image (image, mask, bounding boxes).
 
     augment:        If true, apply random image augmentation.
+    flip:           with augment, use this horizontal flip state instead of a random one
     use_mini_mask:  If False, returns full-size masks that are the same height
                         and width as the original image. These can be big, for example
                         1024x1024x100 (for 100 instances). Mini masks are smaller, typically,
@@ -220,7 +350,7 @@ def load_image_and_gt(dataset, config, image_id, augment=False, use_mini_mask=Fa
 
     # Random horizontal flips.
     if augment:
-        if random.randint(0, 1):
+        if (random.randint(0, 1) if flip is None else flip):
             image = np.fliplr(image)
             mask = np.fliplr(mask)
 
@@ -244,4 +374,122 @@ def load_image_and_gt(dataset, config, image_id, augment=False, use_mini_mask=Fa
     coco_image_id = dataset.image_info[image_id]["id"]
     image_meta = compose_image_meta(image_id, image.shape, window, active_class_ids, coco_image_id)
 
-    return image, image_meta, class_ids, bbox, mask
\ No newline at end of file
+    return image, image_meta, class_ids, bbox, mask
+
+
+def match_rpn_anchors(anchors, gt_class_ids, gt_boxes, config):
+    """The deterministic part of the numpy rpn targets (see build_rpn_targets): anchor-gt matching of ONE image.
+    Depends only on the gt boxes (i.e., the image, its flip state and IMAGE_MAX_DIM), so it can be cached
+    (RPN.MATCH_CACHE_DIR). Every anchor not listed is negative.
+    Args:
+        anchors:            [num_anchors, (y1, x1, y2, x2)]
+        gt_class_ids:       [instance_count] Integer class IDs; < 0 = crowd
+        gt_boxes:           [instance_count, (y1, x1, y2, x2)]
+    Returns: dict of
+        pos_ids:            [P] int32 positive anchors
+        pos_gt_ids:         [P] int32 index (into gt_boxes) of the closest gt box of each positive anchor
+        neutral_ids:        [M] int32 neutral anchors, incl. would-be negatives that overlap a crowd
+        anchor_num, gt_num: int, to validate a cached match
+    """
+    no_crowd_bool = np.ones([anchors.shape[0]], dtype=bool)
+    crowd_ix = np.where(gt_class_ids < 0)[0]
+    if crowd_ix.shape[0] > 0:
+        # Anchors overlapping a crowd are never negative
+        crowd_overlaps = np_bbox_overlaps(anchors, gt_boxes[crowd_ix], config.MISC.IOU_CHUNK_SIZE)
+        no_crowd_bool = np.amax(crowd_overlaps, axis=1) < 0.001
+    non_crowd_ix = np.where(gt_class_ids > 0)[0]
+
+    # 1. Set negative anchors first; 2. an anchor for each GT box; 3. anchors with high overlap
+    rpn_match = np.zeros([anchors.shape[0]], dtype=np.int32)
+    overlaps = np_bbox_overlaps(anchors, gt_boxes[non_crowd_ix], config.MISC.IOU_CHUNK_SIZE)
+    if non_crowd_ix.shape[0] > 0:
+        anchor_iou_argmax = np.argmax(overlaps, axis=1)
+        anchor_iou_max = overlaps[np.arange(overlaps.shape[0]), anchor_iou_argmax]
+    else:
+        anchor_iou_argmax = np.zeros([anchors.shape[0]], dtype=np.int64)
+        anchor_iou_max = np.full([anchors.shape[0]], -1, dtype=np.float32)
+    rpn_match[(anchor_iou_max < config.RPN.TARGET_NEG_THRES) & no_crowd_bool] = -1
+    rpn_match[np.argmax(overlaps, axis=0)] = 1
+    rpn_match[anchor_iou_max >= config.RPN.TARGET_POS_THRES] = 1
+
+    pos_ids = np.where(rpn_match == 1)[0]
+    return {
+        'pos_ids':      pos_ids.astype(np.int32),
+        'pos_gt_ids':   non_crowd_ix[anchor_iou_argmax[pos_ids]].astype(np.int32),
+        'neutral_ids':  np.where(rpn_match == 0)[0].astype(np.int32),
+        'anchor_num':   anchors.shape[0],
+        'gt_num':       gt_class_ids.shape[0],
+    }
+
+
+def sample_rpn_targets(match, anchors, gt_boxes, config):
+    """The random part of the numpy rpn targets: balance positive and negative anchors of a match_rpn_anchors()
+    result and compute the deltas of the kept positives. Returns: see build_rpn_targets()"""
+    anchors_per_image = config.RPN.TRAIN_ANCHORS_PER_IMAGE
+    rpn_match = np.full([match['anchor_num']], -1, dtype=np.int32)
+    rpn_match[match['neutral_ids']] = 0
+    rpn_match[match['pos_ids']] = 1
+    rpn_bbox = np.zeros((anchors_per_image, 4), dtype=np.float32)
+
+    # 4. Subsample to balance positive and negative anchors
+    pos_ids = match['pos_ids']
+    extra = len(pos_ids) - anchors_per_image // 2
+    if extra > 0:
+        rpn_match[np.random.choice(pos_ids, extra, replace=False)] = 0
+    neg_ids = np.where(rpn_match == -1)[0]
+    extra = len(neg_ids) - (anchors_per_image - np.sum(rpn_match == 1))
+    if extra > 0:
+        rpn_match[np.random.choice(neg_ids, extra, replace=False)] = 0
+
+    # For positive anchors, the deltas to their closest GT box (pos_ids is in anchor order)
+    kept = rpn_match[pos_ids] == 1
+    rpn_bbox[:np.sum(kept)] = np_box_refinement(anchors[pos_ids[kept]], gt_boxes[match['pos_gt_ids'][kept]])
+    rpn_bbox /= config.DATA.BBOX_STD_DEV
+    return rpn_match, rpn_bbox
+
+
+def build_rpn_targets(anchors, gt_class_ids, gt_boxes, config):
+    """numpy version of generate_target() in lib/layers.py for ONE image; runs in the data loader
+    workers when RPN.TARGET_IN_LOADER is True.
+    Args:
+        anchors:            [num_anchors, (y1, x1, y2, x2)]
+        gt_class_ids:       [instance_count] Integer class IDs; < 0 = crowd
+        gt_boxes:           [instance_count, (y1, x1, y2, x2)]
+    Returns:
+        rpn_match:          [num_anchors] int32; 1 = positive, -1 = negative, 0 = neutral
+        rpn_bbox:           [TRAIN_ANCHORS_PER_IMAGE, (dy, dx, log(dh), log(dw))] float32, divided by BBOX_STD_DEV
+    """
+    return sample_rpn_targets(match_rpn_anchors(anchors, gt_class_ids, gt_boxes, config), anchors, gt_boxes, config)
+
+
+def rpn_match_setting(config):
+    """short hash of every setting the anchor-gt match depends on (image size, anchors, iou thresholds);
+    part of the cache file name, so that a cache built under other settings is never picked up"""
+    shapes = tuple(tuple(int(v) for v in shape) for shape in config.MODEL.BACKBONE_SHAPES)
+    setting = (config.DATA.IMAGE_MIN_DIM, config.DATA.IMAGE_MAX_DIM, config.DATA.IMAGE_PADDING,
+               tuple(config.RPN.ANCHOR_SCALES), tuple(config.RPN.ANCHOR_RATIOS), config.RPN.ANCHOR_STRIDE,
+               tuple(config.MODEL.BACKBONE_STRIDES), shapes, config.RPN.TARGET_POS_THRES, config.RPN.TARGET_NEG_THRES)
+    return hashlib.md5(repr(setting).encode('utf-8')).hexdigest()[:8]
+
+
+def load_rpn_match(file_name, anchor_num, gt_num):
+    """cached match_rpn_anchors() result; None if missing or stale"""
+    if not os.path.exists(file_name):
+        return None
+    try:
+        with np.load(file_name) as data:
+            match = {key: data[key] for key in data.files}
+    except (IOError, ValueError, zipfile.BadZipFile):
+        return None
+    if int(match['anchor_num']) != anchor_num or int(match['gt_num']) != gt_num:
+        return None
+    match['anchor_num'], match['gt_num'] = anchor_num, gt_num
+    return match
+
+
+def save_rpn_match(file_name, match):
+    """write to a temp file first, so that concurrent loader workers never read a partial file"""
+    tmp_file = '{:s}.{:d}.tmp'.format(file_name, os.getpid())
+    with open(tmp_file, 'wb') as f:
+        np.savez(f, **match)
+    os.rename(tmp_file, file_name)
@@ -0,0 +1,236 @@
+"""Dynamic-batching inference server.
+
+Single-image requests are queued and grouped into batches of at most TEST.SERVE_MAX_BATCH_SIZE images;
+a batch is launched as soon as it is full or the oldest request in it has waited TEST.SERVE_MAX_WAIT_MS.
+One forward pass (MaskRCNN.detect) is run per batch and the results are fanned back out to the callers.
+Image decoding and rle encoding of the results run on a pool of TEST.SERVE_CODEC_WORKERS threads (separate from
+the forward thread), so that they never block the event loop that queues requests and launches batches.
+
+Wire protocol (TCP, one request per message, connection can be reused):
+    request:    4-byte big-endian length + encoded image bytes (jpg, png, ...)
+    response:   4-byte big-endian length + utf-8 json
+                {"rois", "class_ids", "scores", "masks" (coco rle; null below TEST.MASK_MIN_SCORE),
+                 "queue_ms", "compute_ms", "batch_size"}
+
+Usage:
+    python -m tools.inference_server --model_path datasets/pretrain_model/mask_rcnn_coco.pth --port 9999
+    # smoke check of a running server: a blank image (no detections) and, optionally, a real one
+    python -m tools.inference_server --smoke_check [--smoke_image demo/xxx.jpg] --port 9999
+"""
+import io
+import sys
+import json
+import time
+import socket
+import struct
+import asyncio
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import skimage.io
+import torch
+from PIL import Image
+
+from lib.config import CocoConfig
+from lib.model import MaskRCNN
+from lib.workflow import encode_detections
+from tools.utils import to_device, print_log
+
+LATENCY_REPORT_INTERVAL = 100   # print latency percentiles every N requests
+
+
+class _Request(object):
+    def __init__(self, image, future):
+        self.image = image
+        self.future = future
+        self.enqueue_time = time.time()
+
+
+class DynamicBatcher(object):
+    """Groups concurrent detect requests into batches under a latency deadline.
+        model:              MaskRCNN (bare module, not nn.DataParallel)
+        max_batch_size:     max images per forward pass
+        max_wait_ms:        max time the oldest request waits for the batch to fill
+        codec_workers:      threads for decoding requests and encoding results (see make_handler)
+    """
+    def __init__(self, model, max_batch_size, max_wait_ms, codec_workers=4, log_file=None):
+        self.model = model
+        self.max_batch_size = max(max_batch_size, 1)
+        self.max_wait = max_wait_ms / 1000.
+        self.log_file = log_file
+        self.queue = asyncio.Queue()
+        # forward runs in a worker thread so that the event loop keeps accepting requests
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.codec_executor = ThreadPoolExecutor(max_workers=max(codec_workers, 1))
+        self.queue_ms, self.compute_ms = [], []
+
+    async def detect(self, image):
+        """Queue one image; returns (result_dict, queue_ms, compute_ms, batch_size)."""
+        future = asyncio.get_event_loop().create_future()
+        await self.queue.put(_Request(image, future))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            batch = [await self.queue.get()]
+            # the deadline counts from the time the oldest request entered the queue
+            deadline = batch[0].enqueue_time + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            t_start = time.time()
+            try:
+                results = await loop.run_in_executor(
+                    self.executor, self.model.detect, [req.image for req in batch], len(batch))
+            except Exception as e:
+                for req in batch:
+                    if not req.future.done():
+                        req.future.set_exception(e)
+                continue
+            t_end = time.time()
+
+            compute_ms = (t_end - t_start) * 1000.
+            for req, result in zip(batch, results):
+                queue_ms = (t_start - req.enqueue_time) * 1000.
+                self._update_stats(queue_ms, compute_ms)
+                if not req.future.done():
+                    req.future.set_result((result, queue_ms, compute_ms, len(batch)))
+
+    def _update_stats(self, queue_ms, compute_ms):
+        self.queue_ms.append(queue_ms)
+        self.compute_ms.append(compute_ms)
+        if len(self.queue_ms) == LATENCY_REPORT_INTERVAL:
+            queue_ms, compute_ms = np.array(self.queue_ms), np.array(self.compute_ms)
+            total_ms = queue_ms + compute_ms
+            print_log('[SERVE] last {:d} requests (ms): queue p50 {:.1f} p99 {:.1f}; compute p50 {:.1f} p99 {:.1f}; '
+                      'total p50 {:.1f} p99 {:.1f}'.format(
+                        LATENCY_REPORT_INTERVAL,
+                        np.percentile(queue_ms, 50), np.percentile(queue_ms, 99),
+                        np.percentile(compute_ms, 50), np.percentile(compute_ms, 99),
+                        np.percentile(total_ms, 50), np.percentile(total_ms, 99)), self.log_file)
+            self.queue_ms, self.compute_ms = [], []
+
+
+def _encode_result(mask_min_score, result, queue_ms, compute_ms, batch_size):
+    output = encode_detections(result['rois'], result['class_ids'], result['scores'], result['masks'],
+                               mask_min_score)
+    output.update({'queue_ms': queue_ms, 'compute_ms': compute_ms, 'batch_size': batch_size})
+    return output
+
+
+def _decode_image(data):
+    image = skimage.io.imread(io.BytesIO(data))
+    if image.ndim != 3:
+        image = np.stack([image] * 3, axis=-1)
+    return image[:, :, :3]
+
+
+def make_handler(batcher):
+
+    async def handle(reader, writer):
+        loop = asyncio.get_event_loop()
+        try:
+            while True:
+                try:
+                    header = await reader.readexactly(4)
+                except asyncio.IncompleteReadError:
+                    break
+                data = await reader.readexactly(struct.unpack('>I', header)[0])
+                try:
+                    image = await loop.run_in_executor(batcher.codec_executor, _decode_image, data)
+                    result = await batcher.detect(image)
+                    output = await loop.run_in_executor(batcher.codec_executor, _encode_result,
+                                                        batcher.model.config.TEST.MASK_MIN_SCORE, *result)
+                except Exception as e:
+                    output = {'error': repr(e)}
+                payload = json.dumps(output).encode('utf-8')
+                writer.write(struct.pack('>I', len(payload)) + payload)
+                await writer.drain()
+        finally:
+            writer.close()
+
+    return handle
+
+
+def _request(sock, data):
+    sock.sendall(struct.pack('>I', len(data)) + data)
+    size = struct.unpack('>I', _recv_exactly(sock, 4))[0]
+    return json.loads(_recv_exactly(sock, size).decode('utf-8'))
+
+
+def _recv_exactly(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError('server closed the connection')
+        data += chunk
+    return data
+
+
+def smoke_check(host, port, image_file=None):
+    """Send a blank image (expected to have no detections) and optionally a real image to a running server;
+    raise if a response is an error or its masks do not match its boxes."""
+    buffer = io.BytesIO()
+    Image.fromarray(np.zeros((480, 640, 3), dtype=np.uint8)).save(buffer, format='png')
+    requests = [('blank', buffer.getvalue())]
+    if image_file is not None:
+        with open(image_file, 'rb') as f:
+            requests.append((image_file, f.read()))
+
+    with socket.create_connection((host, port)) as sock:
+        for name, data in requests:
+            output = _request(sock, data)
+            assert 'error' not in output, '[{:s}] server error: {:s}'.format(name, output['error'])
+            assert len(output['masks']) == len(output['rois']) == len(output['class_ids']) == len(output['scores'])
+            print('[{:s}] {:d} detections; queue {:.1f} ms, compute {:.1f} ms, batch size {:d}'.format(
+                name, len(output['rois']), output['queue_ms'], output['compute_ms'], output['batch_size']))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Mask R-CNN dynamic-batching server')
+    parser.add_argument('--model_path', default=None)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', default=9999, type=int)
+    parser.add_argument('--config_name', default='serve')
+    parser.add_argument('--config_file', default=None)
+    parser.add_argument('--device_id', default='0', type=str)
+    parser.add_argument('--smoke_check', action='store_true', help='query a running server instead of serving')
+    parser.add_argument('--smoke_image', default=None, help='real image sent in the smoke check after a blank one')
+    parser.add_argument('opts', help='See lib/config.py for all options', default=None, nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+    args.phase, args.debug = 'inference', 0
+    if args.smoke_check:
+        smoke_check(args.host, args.port, args.smoke_image)
+        sys.exit()
+    assert args.model_path is not None, '--model_path is required to serve'
+
+    config = CocoConfig(args)
+    model = MaskRCNN(config)
+    checkpoints = torch.load(args.model_path, map_location=lambda storage, loc: storage)
+    model.load_state_dict(checkpoints.get('state_dict', checkpoints), strict=False)
+    model = to_device(model, config)
+
+    batcher = DynamicBatcher(model, config.TEST.SERVE_MAX_BATCH_SIZE, config.TEST.SERVE_MAX_WAIT_MS,
+                             config.TEST.SERVE_CODEC_WORKERS)
+    loop = asyncio.get_event_loop()
+    server = loop.run_until_complete(asyncio.start_server(make_handler(batcher), args.host, args.port))
+    loop.create_task(batcher.run())
+    print('serving on {}:{:d} (max batch {:d}, max wait {} ms) ...'.format(
+        args.host, args.port, config.TEST.SERVE_MAX_BATCH_SIZE, config.TEST.SERVE_MAX_WAIT_MS))
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    server.close()
+    loop.run_until_complete(server.wait_closed())
+    loop.close()
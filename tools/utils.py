@@ -47,6 +47,13 @@ def intersect1d(variable1, variable2):
     return aux[:-1][(aux[1:] == aux[:-1])]
 
 
+def to_device(x, config):
+    """Move a Tensor/Variable/Module to the device designated by config.MISC.DEVICE."""
+    if config.MISC.DEVICE == 'cuda':
+        return x.cuda()
+    return x
+
+
 def log2(x):
     """Implementation of Log2. Pytorch doesn't have a native implementation."""
     ln2 = Variable(torch.log(torch.FloatTensor([2.0])), requires_grad=False)
@@ -300,7 +307,7 @@ def update_config_and_load_model(config, model, train_generator=None):
                 use_pretrain = True
 
         print('loading weights \t{:s}\n'.format(model_path))
-    elif phase == 'inference' or 'visualize':
+    elif phase == 'inference' or phase == 'visualize' or phase == 'stream':
         del config.MODEL['PRETRAIN_COCO_MODEL']
         del config.MODEL['PRETRAIN_IMAGENET_MODEL']
 
@@ -318,7 +325,7 @@ def update_config_and_load_model(config, model, train_generator=None):
     config.MODEL.INIT_MODEL = model_path
 
     # 2. LOAD MODEL (resumed or pretrain, all phases)
-    checkpoints = torch.load(model_path)
+    checkpoints = torch.load(model_path, map_location=lambda storage, loc: storage)
     try:
         model.load_state_dict(checkpoints['state_dict'], strict=False)
     except KeyError:
@@ -374,8 +381,8 @@ def update_config_and_load_model(config, model, train_generator=None):
         if config.DEV.SWITCH and not config.DEV.BASELINE:
             try:
                 # indicate this is a resumed model
-                model.buffer = torch.from_numpy(checkpoints['buffer']).cuda()
-                model.buffer_cnt = torch.from_numpy(checkpoints['buffer_cnt']).cuda()
+                model.buffer = to_device(torch.from_numpy(checkpoints['buffer']), config)
+                model.buffer_cnt = to_device(torch.from_numpy(checkpoints['buffer_cnt']), config)
                 buffer_size = model.buffer.size(0)
                 if buffer_size != config.DEV.BUFFER_SIZE:
                     print_log('[WARNING] loaded buffer size: {}, config size: {}\n'
@@ -389,17 +396,27 @@ def update_config_and_load_model(config, model, train_generator=None):
                 model.initialize_buffer(config.MISC.LOG_FILE)
                 # indicate this is a pretrain model; init buffer as instructed in config
 
-    elif phase == 'inference' or phase == 'visualize':
+    elif phase == 'inference' or phase == 'visualize' or phase == 'stream':
 
-        tiny_diff = 'inference' if phase == 'inference' else 'visualize'
+        tiny_diff = phase
         model_name = os.path.basename(model_path).replace('.pth', '')   # mask_rcnn_ep_0053_iter_001234
         model_suffix = os.path.basename(model_path).replace('mask_rcnn_', '')
 
         if phase == 'inference':
+            if config.TEST.SHARD_NUM > 1 and config.TEST.SHARD_ID >= 0:
+                # one log per shard process
+                tiny_diff = 'inference_shard_{:d}_of_{:d}'.format(config.TEST.SHARD_ID, config.TEST.SHARD_NUM)
+            # non-default nms method gets its own log and result file (otherwise the greedy result is reused)
+            nms_diff = '' if config.TEST.NMS_METHOD == 'greedy' else '{:s}nms_'.format(config.TEST.NMS_METHOD)
+            config.MISC.LOG_FILE = os.path.join(config.MISC.RESULT_FOLDER,
+                                                '{:s}_{:s}from_{:s}.txt'.format(tiny_diff, nms_diff, model_name))
+            config.MISC.DET_RESULT_FILE = os.path.join(config.MISC.RESULT_FOLDER,
+                                                       'det_result_{:s}{:s}'.format(nms_diff, model_suffix))
+        elif phase == 'stream':
             config.MISC.LOG_FILE = os.path.join(config.MISC.RESULT_FOLDER,
                                                 '{:s}_from_{:s}.txt'.format(tiny_diff, model_name))
             config.MISC.DET_RESULT_FILE = os.path.join(config.MISC.RESULT_FOLDER,
-                                                       'det_result_{:s}'.format(model_suffix))
+                                                       'stream_result_{:s}.jsonl'.format(model_name))
         elif phase == 'visualize':
             # NOTE: it is called *folder*; not file!
             # results/meta_105_quick_1_roipool/visualize/vis_result_ep_0013_iter_000619/
@@ -600,15 +617,16 @@ def check_max_mem(input_model, data_loader, MaskRCNN):
     print_log('\nchecking possibly MAX mem cost ...', config.MISC.LOG_FILE)
     # set optimizer
     optimizer = set_optimizer(model, config.TRAIN)
-    model.buffer = torch.zeros(model.config.DEV.BUFFER_SIZE, 1024, config.DATASET.NUM_CLASSES).cuda()
-    model.buffer_cnt = torch.zeros(config.DEV.BUFFER_SIZE, 1, config.DATASET.NUM_CLASSES).cuda()
+    model.buffer = to_device(torch.zeros(config.DEV.BUFFER_SIZE, 1024, config.DATASET.NUM_CLASSES), config)
+    model.buffer_cnt = to_device(torch.zeros(config.DEV.BUFFER_SIZE, 1, config.DATASET.NUM_CLASSES), config)
 
     for iter_ind, inputs in zip(range(1, 11), data_loader):
-        images = Variable(inputs[0].cuda())
-        image_metas = Variable(inputs[-1].cuda())
+        images = Variable(to_device(inputs[0], config))
+        image_metas = Variable(to_device(inputs[-1], config))
         gt_class_ids, gt_boxes, gt_masks, _ = model.adjust_input_gt(inputs[1], inputs[2], inputs[3])
         merged_loss, big_feat, big_cnt, small_feat, small_cnt, big_loss = \
-            input_model([images, gt_class_ids, gt_boxes, gt_masks, image_metas], 'train')
+            input_model([images, gt_class_ids, gt_boxes, gt_masks] + model.adjust_input_rpn_target(inputs) +
+                        [image_metas], 'train')
         detailed_loss = torch.mean(merged_loss, dim=0)
 
         if config.DEV.SWITCH and not config.DEV.BASELINE:
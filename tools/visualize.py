@@ -76,7 +76,7 @@ def apply_mask(image, mask, color, alpha=0.5):
 def display_instances(image, boxes, masks, class_ids, class_names, scores=None, title="", figsize=(16, 16), ax=None):
     """
     boxes: [num_instance, (y1, x1, y2, x2, class_id)] in image coordinates.
-    masks: [height, width, num_instances]
+    masks: [height, width, num_instances]; None to draw boxes only
     class_ids: [num_instances]
     class_names: list of class names of the dataset
     scores: (optional) confidence scores for each box
@@ -87,7 +87,8 @@ def display_instances(image, boxes, masks, class_ids, class_names, scores=None,
     if not N:
         print("\n*** No instances to display *** \n")
     else:
-        assert boxes.shape[0] == masks.shape[-1] == class_ids.shape[0]
+        assert boxes.shape[0] == class_ids.shape[0]
+        assert masks is None or masks.shape[-1] == boxes.shape[0]
 
     if not ax:
         _, ax = plt.subplots(1, figsize=figsize)
@@ -125,7 +126,9 @@ def display_instances(image, boxes, masks, class_ids, class_names, scores=None,
         ax.text(x1, y1 + 8, caption,
                 color='w', size=11, backgroundcolor="none")
 
-        # Mask
+        # Mask (None in boxes-only mode)
+        if masks is None:
+            continue
         mask = masks[:, :, i]
         masked_image = apply_mask(masked_image, mask, color)
 